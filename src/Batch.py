@@ -0,0 +1,131 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import pandas as pd
+import shutil
+import tempfile
+import time
+import Instrument as instrument
+from Urm import UPLOADABLES, parse, parse_sil_txt
+
+# processes the URM maintenance files of several stores in parallel from a manifest, e.g.
+# python Batch.py stores.json --jobs 4
+#
+# the manifest is json with a list of stores (paths are relative to the manifest) and optional
+# defaults for all of them:
+# {"defaults": {"min_tpr_margin": 40},
+#  "stores": [{"name": "store 1", "inventory": "store1/INV.csv", "sil": "SIL.TXT",
+#              "output_dir": "store1/uploadables", "db": "store1/urm.db"}, ...]}
+# every store needs its own db and output dir (the inventory snapshots and the fingerprints of the last
+# run in a db are those of its store, and the stores are run at the same time)
+#
+# a SIL file shared by several stores is parsed once. every store is done in its own scratch dir
+# in its output dir, whose files replace the old uploadables only once the store's run is done
+
+STORE_PATHS = ['inventory', 'sil', 'output_dir', 'db']
+STORE_OWN_PATHS = ['output_dir', 'db']  # paths no two stores can have
+STORE_DEFAULTS = {'min_tpr_margin': 0, 'only_do_if_cost_change': False, 'stored_zpl_format': False,
+                  'full_rebuild': False, 'trace_memory': False, 'price_printers': [], 'tpr_printers': []}
+
+# reads the stores of a manifest, with the defaults filled in and the paths made absolute
+def read_manifest(file):
+    with open(file) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(file))
+    stores = []
+    for store in manifest['stores']:
+        store = {**STORE_DEFAULTS, **manifest.get('defaults', {}), **store}
+        missing = [key for key in ['name'] + STORE_PATHS if key not in store]
+        if missing:
+            raise ValueError(f'store {store.get("name", len(stores) + 1)} is missing {", ".join(missing)}')
+        for key in STORE_PATHS:
+            store[key] = os.path.normpath(os.path.join(base, store[key]))
+        stores.append(store)
+
+    names = [store['name'] for store in stores]
+    if len(set(names)) != len(names):
+        raise ValueError('store names in the manifest are not unique')
+    for key in STORE_OWN_PATHS:
+        paths = [os.path.normcase(store[key]) for store in stores]
+        shared = sorted({path for path in paths if paths.count(path) > 1})
+        if shared:
+            raise ValueError(f'stores in the manifest share the {key} {", ".join(shared)} (every store needs its own)')
+    return stores
+
+# parses a SIL file and pickles it for the stores that get it
+def parse_sil_file(sil_file, cache_file):
+    pd.to_pickle(parse_sil_txt(sil_file), cache_file)
+    return cache_file
+
+# runs parse for one store in a scratch dir, its files are moved to the output dir once the run is done
+# (only the run report if it failed)
+def run_store(store, sil_cache, max_workers=None):
+    start = time.perf_counter()
+    os.makedirs(store['output_dir'], exist_ok=True)
+    os.makedirs(os.path.dirname(store['db']), exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='.scratch_', dir=store['output_dir'])
+    try:
+        try:
+            paths = {arg: os.path.join(scratch, name) for arg, name in UPLOADABLES.items()}
+            parse(store['inventory'], store['sil'], dbPath=store['db'], only_do_if_cost_change=store['only_do_if_cost_change'],
+                  min_tpr_margin=store['min_tpr_margin'], stored_zpl_format=store['stored_zpl_format'],
+                  price_printers=store['price_printers'], tpr_printers=store['tpr_printers'], full_rebuild=store['full_rebuild'],
+                  trace_memory=store['trace_memory'], max_workers=max_workers, sil=pd.read_pickle(sil_cache), **paths)
+        except Exception:
+            if os.path.exists(os.path.join(scratch, instrument.REPORT_FILE)):
+                os.replace(os.path.join(scratch, instrument.REPORT_FILE), os.path.join(store['output_dir'], instrument.REPORT_FILE))
+            raise
+        for name in os.listdir(scratch):
+            os.replace(os.path.join(scratch, name), os.path.join(store['output_dir'], name))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return time.perf_counter() - start
+
+# runs every store on a pool of jobs processes (threads threads each), a store starts as soon as its SIL file
+# is parsed. returns the seconds each store took and the errors of the stores that failed, by store name
+def run_manifest(stores, jobs=None, threads=None):
+    seconds, errors = {}, {}
+    stores_by_sil = {}
+    for store in stores:
+        stores_by_sil.setdefault(os.path.realpath(store['sil']), []).append(store)
+
+    with tempfile.TemporaryDirectory() as cache_dir, ProcessPoolExecutor(jobs) as pool:
+        sil_futures = {pool.submit(parse_sil_file, sil_file, os.path.join(cache_dir, f'sil_{idx}.pkl')): sil_file
+                       for idx, sil_file in enumerate(stores_by_sil)}
+        store_futures = {}
+        for future in as_completed(sil_futures):
+            sil_stores = stores_by_sil[sil_futures[future]]
+            try:
+                sil_cache = future.result()
+            except Exception as e:
+                errors.update({store['name']: f'{sil_futures[future]}: {e!r}' for store in sil_stores})
+                continue
+            for store in sil_stores:
+                store_futures[pool.submit(run_store, store, sil_cache, threads)] = store['name']
+
+        for future in as_completed(store_futures):
+            name = store_futures[future]
+            try:
+                seconds[name] = future.result()
+            except Exception as e:
+                errors[name] = repr(e)
+    return seconds, errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='process the URM maintenance files of the stores in a manifest')
+    parser.add_argument('manifest', help='json file of the stores to process')
+    parser.add_argument('--jobs', type=int, help='number of stores processed at the same time (default: number of cpus)')
+    parser.add_argument('--threads', type=int, help='number of threads for the stages of each store')
+    parser.add_argument('--full-rebuild', action='store_true', help='process every row, not only those changed since the last run')
+    args = parser.parse_args()
+
+    stores = read_manifest(args.manifest)
+    if args.full_rebuild:
+        for store in stores:
+            store['full_rebuild'] = True
+    seconds, errors = run_manifest(stores, args.jobs, args.threads)
+    for store in stores:
+        name = store['name']
+        print(f'{name}: failed: {errors[name]}' if name in errors else f'{name}: done in {seconds[name]:.2f}s')
+    raise SystemExit(1 if errors else 0)
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import pandas as pd
+import tempfile
+import time
+import tracemalloc
+import Urm as urm
+import Utils as utils
+from Generate import generate
+
+# times each stage of Urm.parse separately on synthetic stores of different sizes and reports wall time,
+# peak memory and rows/sec, e.g. python Benchmark.py 10000 100000 1000000 --json ../files/benchmark.json
+
+SIZES = [10000, 100000, 1000000]
+
+# runs fn once for its wall time and once more under tracemalloc for its peak memory (tracemalloc slows
+# python code down, so timing it would be off), returns fn's result and the stage's numbers
+def measure(name, fn, rows):
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {'stage': name, 'rows': rows, 'seconds': round(seconds, 4), 'peak mb': round(peak / 2 ** 20, 2),
+                    'rows per sec': round(rows / seconds) if seconds else None}
+
+# benchmarks every stage for a store with n items, the files are generated into work_dir
+def run_benchmark(n, work_dir, seed=0):
+    sil_file, st_file = generate(n, os.path.join(work_dir, str(n)), seed)
+    db_path = os.path.join(work_dir, f'{n}.db')
+    results = []
+
+    def stage(name, fn, rows):
+        result, numbers = measure(name, fn, rows)
+        results.append(numbers)
+        return result
+
+    # inventory: plain read, building the snapshot (a new db each time) and loading it
+    st = stage('process_storetender_file', lambda: utils.process_storetender_file(st_file, db_path, use_snapshot=False), n)
+    snapshot_dbs = iter(os.path.join(work_dir, f'{n}_snapshot_{i}.db') for i in range(2))
+    stage('process_storetender_file (build snapshot)', lambda: utils.process_storetender_file(st_file, next(snapshot_dbs)), n)
+    utils.process_storetender_file(st_file, db_path)
+    stage('process_storetender_file (load snapshot)', lambda: utils.process_storetender_file(st_file, db_path), n)
+
+    sil, numbers = measure('parse_sil_txt', lambda: urm.parse_sil_txt(sil_file), 0)
+    numbers['rows'] = sum(len(data) for data in sil.values())
+    numbers['rows per sec'] = round(numbers['rows'] / numbers['seconds'])
+    results.append(numbers)
+    new_ = pd.concat([sil['URM_NEW'], sil['URM_CHG']], ignore_index=True)
+
+    for table, process in [('URM_NEW', urm.process_new), ('URM_PCU', urm.process_pcu), ('URM_TPN', urm.process_tpr),
+                           ('URM_CPN', urm.process_ad)]:
+        stage(f'to_correct_format ({table})', lambda: process(sil[table].copy()), len(sil[table]))
+
+    new, pcu_with_new_format = stage('get_new', lambda: urm.get_new(sil['URM_NEW'].copy(), st, db_path, 'NEW', 'PCU (NEW FORMAT)'),
+                                     len(sil['URM_NEW']))
+    pcu = stage('get_pcu', lambda: urm.get_pcu(sil['URM_PCU'].copy(), st, new_, db_path, 'PCU'), len(sil['URM_PCU']))
+    tpr = stage('get_tpr', lambda: urm.get_tpr(sil['URM_TPN'].copy(), st, min_margin=40), len(sil['URM_TPN']))
+    ad = stage('get_ad', lambda: urm.get_ad(sil['URM_CPN'].copy(), st), len(sil['URM_CPN']))
+    pcu = pd.concat([pcu_with_new_format, pcu], ignore_index=True)
+    outputs = {'new': new, 'pcu': pcu, 'tpr': tpr, 'ad': ad}
+
+    csv_file = os.path.join(work_dir, 'out.csv')
+    for name, data in outputs.items():
+        stage(f'csv ({name})', lambda: urm.to_output_format(data).to_csv(csv_file, index=False, header=False), len(data))
+
+    # a whole run of tables in one transaction, as parse writes them
+    def write_db():
+        conn = urm.open_db(db_path)
+        try:
+            run_id = urm.start_run(conn, st_file, sil_file)
+            for name, data in outputs.items():
+                urm.to_sql_table(conn, urm.to_output_format(data), f'BENCHMARK {name.upper()}', run_id)
+            urm.finish_run(conn, run_id)
+        finally:
+            conn.close()
+    stage('sqlite', write_db, sum(len(data) for data in outputs.values()))
+
+    zpl_file = os.path.join(work_dir, 'tags.zpl')
+    price_tags = urm.to_output_format(urm.price_tag_rows(new, pcu))
+    tpr_tags = urm.to_output_format(tpr)
+    stage('zpl (price tags)', lambda: urm.write_tags(zpl_file, price_tags, urm.PRICE_ZPL_STORED_COMPILED, urm.PRICE_TAG_FIELDS,
+                                                     urm.PRICE_ZPL_HEADER, None), len(price_tags))
+    stage('zpl (tpr tags)', lambda: urm.write_tags(zpl_file, tpr_tags, urm.TPR_ZPL_STORED_COMPILED, urm.TPR_TAG_FIELDS,
+                                                   urm.TPR_ZPL_HEADER, None), len(tpr_tags))
+
+    for numbers in results:
+        numbers['items'] = n
+    return results
+
+def print_results(results):
+    print(f'{"items":>8}  {"stage":<45}{"rows":>9}{"seconds":>10}{"peak mb":>10}{"rows/sec":>12}')
+    for r in results:
+        print(f'{r["items"]:>8}  {r["stage"]:<45}{r["rows"]:>9}{r["seconds"]:>10.3f}{r["peak mb"]:>10.1f}'
+              f'{r["rows per sec"] or 0:>12}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the stages of the URM file processor on synthetic stores')
+    parser.add_argument('sizes', type=int, nargs='*', default=SIZES, help='numbers of items in the inventory')
+    parser.add_argument('--json', help='file to also write the results to as json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for n in args.sizes:
+            results += run_benchmark(n, work_dir, args.seed)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
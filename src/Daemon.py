@@ -0,0 +1,208 @@
+import argparse
+from datetime import datetime
+import fnmatch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import threading
+import time
+from Urm import UPLOADABLES, inventory_hashes, parse
+import Utils as utils
+
+# watches a drop directory and processes every SIL file that lands in it against the newest inventory
+# export there, e.g. python Daemon.py ../files/drop --output-dir ../files/uploadables --db ../db/urm.db
+#
+# the normalized inventory (and its UPC index) is kept in memory and only reloaded when the inventory
+# export changes, so a run only parses the SIL file and merges. processed SIL files are moved to
+# drop/processed. GET http://127.0.0.1:<port>/status reports the queue depth and the last run's latency
+
+SIL_PATTERN = '*.txt'
+INVENTORY_PATTERN = '*.csv'
+PROCESSED_DIR = 'processed'
+STATUS_PORT = 8765
+
+# polls the drop dir for files that landed (same size and mtime on two polls in a row): inventory exports
+# are loaded into memory and SIL files are queued and run one at a time. a SIL file whose run failed is
+# only run again once it or the inventory changes
+class Daemon:
+    def __init__(self, drop_dir, output_dir, dbPath, poll_interval=1.0, **parse_args):
+        self.drop_dir = drop_dir
+        self.output_dir = output_dir
+        self.dbPath = dbPath
+        self.poll_interval = poll_interval
+        self.parse_args = parse_args  # min_tpr_margin, only_do_if_cost_change, stored_zpl_format...
+        self.sil_files = queue.Queue()
+        self.seen = {}  # file -> (size, mtime) on the last poll
+        self.queued = set()
+        self.failed = {}  # SIL file whose run failed -> (its mtime, the inventory it was run against)
+        self.inventory = None  # (file, size, mtime) of the inventory in memory
+        self.bad_inventory = None  # (file, size, mtime) of an inventory that could not be loaded
+        self.warm = None  # stage results of the inventory in memory
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        os.makedirs(output_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(dbPath)), exist_ok=True)
+        self.status = {'started': datetime.now().isoformat(timespec='seconds'), 'running': None, 'runs': 0, 'failed runs': 0,
+                       'inventory': None, 'inventory loaded': None, 'inventory error': None, 'last run': None}
+
+    # files in the drop dir that match pattern (case insensitive), newest last
+    def files(self, pattern):
+        names = [name for name in os.listdir(self.drop_dir) if fnmatch.fnmatch(name.lower(), pattern)]
+        paths = [os.path.join(self.drop_dir, name) for name in names]
+        return sorted((path for path in paths if os.path.isfile(path)), key=os.path.getmtime)
+
+    # the files that have not changed since the last poll
+    def landed(self, paths):
+        landed = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if self.seen.get(path) == (stat.st_size, stat.st_mtime):
+                landed.append(path)
+            self.seen[path] = (stat.st_size, stat.st_mtime)
+        return landed
+
+    # queues the SIL files that landed and reloads the inventory if a newer export landed
+    def poll(self):
+        inventories = self.landed(self.files(INVENTORY_PATTERN))
+        if inventories:
+            file = inventories[-1]
+            stat = os.stat(file)
+            if (file, stat.st_size, stat.st_mtime) not in (self.inventory, self.bad_inventory):
+                self.load_inventory(file)
+        for file in self.landed(self.files(SIL_PATTERN)):
+            mtime = os.path.getmtime(file)
+            with self.lock:
+                if file in self.queued or self.failed.get(file) == (mtime, self.inventory):
+                    continue
+                self.queued.add(file)
+            self.sil_files.put((file, mtime))
+
+    # normalizes the inventory and builds its UPC index once for every run until the export changes,
+    # the runs keep the inventory that was in memory if the export can't be loaded
+    def load_inventory(self, file):
+        stat = os.stat(file)
+        try:
+            st = utils.process_storetender_file(file, self.dbPath)
+            warm = {'st': st, 'st hashes': inventory_hashes(st)}
+        except Exception as e:
+            self.bad_inventory = (file, stat.st_size, stat.st_mtime)
+            with self.lock:
+                self.status['inventory error'] = f'{file}: {e!r}'
+            return
+        with self.lock:
+            self.inventory = (file, stat.st_size, stat.st_mtime)
+            self.warm = warm
+            self.status['inventory'] = file
+            self.status['inventory loaded'] = datetime.now().isoformat(timespec='seconds')
+            self.status['inventory error'] = None
+
+    # processes a SIL file against the inventory in memory and moves it to the processed dir
+    def run(self, sil_file, landed_at):
+        with self.lock:
+            self.status['running'] = sil_file
+            inventory, warm = self.inventory, self.warm
+        start = time.time()
+        error = None
+        try:
+            if warm is None:
+                raise FileNotFoundError('no inventory export in ' + self.drop_dir)
+            paths = {arg: os.path.join(self.output_dir, name) for arg, name in UPLOADABLES.items()}
+            parse(inventory[0], sil_file, dbPath=self.dbPath, warm=warm, **paths, **self.parse_args)
+            processed_dir = os.path.join(self.drop_dir, PROCESSED_DIR)
+            os.makedirs(processed_dir, exist_ok=True)
+            os.replace(sil_file, os.path.join(processed_dir, os.path.basename(sil_file)))
+        except Exception as e:
+            error = repr(e)
+        end = time.time()
+        with self.lock:
+            self.status['running'] = None
+            self.status['runs'] += 1
+            self.status['failed runs'] += error is not None
+            self.status['last run'] = {'sil file': sil_file, 'finished': datetime.fromtimestamp(end).isoformat(timespec='seconds'),
+                                       'seconds': round(end - start, 3), 'latency seconds': round(end - landed_at, 3),
+                                       'error': error}
+            if error is not None:
+                self.failed[sil_file] = (landed_at, inventory)
+            else:
+                self.failed.pop(sil_file, None)
+            self.queued.discard(sil_file)
+
+    # the status reported by the status endpoint
+    def get_status(self):
+        with self.lock:
+            return {**self.status, 'queue depth': self.sil_files.qsize()}
+
+    # polls the drop dir on this thread and runs the queued SIL files one at a time on another
+    def serve(self, port=STATUS_PORT):
+        server = start_status_server(self, port) if port else None
+        worker = threading.Thread(target=self.run_queued, daemon=True)
+        worker.start()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.poll()
+                except OSError as e:  # e.g. a file removed while it was read, it is picked up on the next poll
+                    print('poll failed:', repr(e))
+                self.stopped.wait(self.poll_interval)
+        finally:
+            self.stopped.set()
+            self.sil_files.put(None)
+            worker.join()
+            if server:
+                server.shutdown()
+
+    def run_queued(self):
+        while True:
+            item = self.sil_files.get()
+            if item is None:
+                break
+            self.run(*item)
+
+    def stop(self):
+        self.stopped.set()
+
+# serves the daemon's status as json on localhost in a thread
+def start_status_server(daemon, port):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/status'):
+                self.send_error(404)
+                return
+            body = json.dumps(daemon.get_status(), indent=2).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # no line per request
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='process the SIL files and inventory exports dropped into a directory')
+    parser.add_argument('drop_dir', help='directory the SIL files and inventory exports are dropped into')
+    parser.add_argument('--output-dir', default='../files/uploadables', help='directory to write the uploadables and tags to')
+    parser.add_argument('--db', default='../db/urm.db')
+    parser.add_argument('--port', type=int, default=STATUS_PORT, help='port of the status endpoint (0 for none)')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between polls of the drop directory')
+    parser.add_argument('--min-tpr-margin', type=float, default=40)
+    parser.add_argument('--only-do-if-cost-change', action='store_true')
+    parser.add_argument('--stored-zpl-format', action='store_true')
+    parser.add_argument('--trace-memory', action='store_true', help='trace the peak memory of every stage (slower)')
+    args = parser.parse_args()
+
+    daemon = Daemon(args.drop_dir, args.output_dir, args.db, args.poll, min_tpr_margin=args.min_tpr_margin,
+                    only_do_if_cost_change=args.only_do_if_cost_change, stored_zpl_format=args.stored_zpl_format,
+                    trace_memory=args.trace_memory)
+    try:
+        daemon.serve(args.port)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,152 @@
+import argparse
+import numpy as np
+import os
+import pandas as pd
+import Utils as utils
+from Urm import NEW_FIELDS, PCU_FIELDS, TPR_FIELDS, AD_FIELDS, SIL_FIELD_TYPES
+
+# generates a synthetic URM maintenance file (SIL) and a matching POS inventory export of any size,
+# e.g. python Generate.py 100000 ../files/synthetic
+
+WORDS = ['CHKN', 'BEEF', 'PORK', 'APPLE', 'CHERRY', 'COFFEE', 'CREAMER', 'TISSUE', 'TOWEL', 'SOUP', 'BEAN',
+         'RICE', 'PASTA', 'SAUCE', 'CHEESE', 'MILK', 'JUICE', 'WATER', 'SODA', 'CHIPS', 'COOKIE', 'CANDY',
+         'BREAD', 'CEREAL', 'FROZEN', 'PIZZA', 'ORIG', 'LITE', 'FAMILY', 'SIZE', 'CLASSIC', 'ROAST']
+DEPTS = np.array([1, 2, 3, 4, 5, 6, 8, 9, 10])
+UOMS = np.array(['48', '32', '1', '86', '41', '22'])
+PACK_SIZES = np.array([1, 4, 6, 8, 12, 24])
+
+# share of the inventory in each SIL table
+SIL_SHARES = {'URM_NEW': 0.01, 'URM_CHG': 0.005, 'URM_PCU': 0.1, 'URM_PCD': 0.02, 'URM_CPN': 0.01, 'URM_TPN': 0.04}
+UPCE_SHARE = 0.05  # share of the inventory whose PLU is a zero suppressed UPC E
+PRICE_CHANGE_SHARE = 0.6  # share of the SIL rows whose price and cost differ from the inventory
+
+# random descriptions of a few words, cut to length
+def make_descriptions(rng, n, length):
+    words = np.array(WORDS, dtype=object)
+    desc = words[rng.integers(0, len(words), n)]
+    for _ in range(3):
+        desc = desc + ' ' + words[rng.integers(0, len(words), n)]
+    return pd.Series(desc).str[:length]
+
+# unique random items: UPC A without check digit (11 digits), UPC A with check digit and the PLU the POS uses
+def make_upcs(rng, n):
+    n_upcE = int(n * UPCE_SHARE)
+    bodies = np.unique(rng.integers(0, 10 ** 6, n_upcE * 2))
+    bodies = rng.permutation(bodies)[:n_upcE]
+    upcE = pd.Series(bodies).astype(str).str.zfill(6)
+    upcA_from_upcE = utils.upcE_to_upcA_batch('0' + upcE + '0').str[:11]  # check digit of the UPC E is the UPC A's
+
+    upcA = pd.Series(np.unique(rng.integers(10 ** 9, 10 ** 11, n * 2))).astype(str).str.zfill(11)
+    upcA = upcA[~upcA.isin(upcA_from_upcE)]
+    upcA = pd.Series(rng.permutation(upcA.to_numpy())[:n - len(upcA_from_upcE)])
+    upc11 = pd.concat([upcA_from_upcE, upcA], ignore_index=True)
+    upc12 = utils.add_check_digit_batch(upc11)
+
+    plu = upc12.copy()
+    plu[:len(upcE)] = '0' + upcE + upc12[:len(upcE)].str[-1]
+    return upc11, upc12, plu
+
+# makes the items of the store with prices and costs
+def make_items(rng, n):
+    upc11, upc12, plu = make_upcs(rng, n)
+    pack = PACK_SIZES[rng.integers(0, len(PACK_SIZES), n)]
+    price = np.round(rng.uniform(0.5, 25, n), 1) - 0.01
+    cost = np.round(price * pack * rng.uniform(0.55, 0.8, n), 2)
+    return pd.DataFrame({'UPC11': upc11, 'UPC12': upc12, 'PLU': plu,
+                         'DESCRIPTION': make_descriptions(rng, n, 30), 'DEPT': DEPTS[rng.integers(0, len(DEPTS), n)],
+                         'PACK': pack, 'PRICE': price, 'CASE COST': cost,
+                         'ITEM NO': pd.Series(rng.integers(1000, 99999, n)).astype(str)})
+
+# writes the POS inventory export (37 columns, no header)
+def write_inventory(items, file):
+    n = len(items)
+    blank = [''] * n
+    zero = ['0'] * n
+    food_stamps = items['DEPT'].isin([1, 2, 4, 5, 6])
+    cols = [items['PLU'], items['DESCRIPTION'].str[:20], items['DESCRIPTION'], blank, blank, zero,
+            items['DEPT'].astype(str), blank, zero, zero, blank, items['ITEM NO'], (~food_stamps).astype(int).astype(str),
+            zero, zero, blank, blank, items['PACK'].astype(str), items['CASE COST'].map('{:.4f}'.format), ['0.0000'] * n,
+            ['0.0000'] * n, ['1'] * n, items['PRICE'].map('{:.2f}'.format), zero, zero, ['0.000'] * n, zero, ['0.000'] * n,
+            ['0.000'] * n, blank, food_stamps.map(str), ['False'] * n, ['False'] * n, blank, blank, ['False'] * n, ['True'] * n]
+    inventory = pd.DataFrame({idx: pd.Series(col, index=items.index) for idx, col in enumerate(cols)})
+    inventory.to_csv(file, header=False, index=False)
+
+# julian yyyyddd dates
+def julian(day_of_year, year=2024):
+    return (year * 1000 + day_of_year).astype(str)
+
+# the VALUES rows of one SIL table for the given items
+def make_rows(rng, table, items):
+    n = len(items)
+    f01 = '00' + items['UPC11']
+    changed = rng.random(n) < PRICE_CHANGE_SHARE
+    price = (items['PRICE'] + np.where(changed, rng.choice([-0.5, 0.2, 0.5, 1.0], n), 0)).clip(lower=0.49)
+    price = price.map('{:.2f}'.format)
+    cost = (items['CASE COST'] * np.where(changed, rng.uniform(0.95, 1.1, n), 1)).map('{:.3f}'.format)
+    if table in ('URM_NEW', 'URM_CHG'):
+        dept = pd.Series(DEPTS[rng.integers(0, len(DEPTS), n)], index=items.index).astype(str).str.zfill(3)
+        group = pd.Series(rng.integers(100, 400, n), index=items.index).astype(str)
+        uom = pd.Series(UOMS[rng.integers(0, len(UOMS), n)], index=items.index)
+        size = pd.Series(rng.integers(1, 64, n), index=items.index).astype(str) + '.000'
+        vendor_item = pd.Series(rng.integers(10 ** 8, 10 ** 9, n), index=items.index).astype(str)
+        return ('(' + f01 + ",'" + items['DESCRIPTION'].str[:12] + "'," + dept + ',' + group + ',017,,'
+                + items['PACK'].astype(str) + ",'" + uom + "'," + size + ",'1','" + items['DESCRIPTION'] + "',1,"
+                + price + ",,'B'," + cost + ",0,0,0,0,0,0,0,0,'" + vendor_item + "',0,0)")
+    if table in ('URM_PCU', 'URM_PCD'):
+        return '(' + f01 + ",'1'," + price + ',1,' + cost + ')'
+
+    start = rng.integers(1, 300, n)
+    end = start + rng.integers(7, 60, n)
+    start = pd.Series(julian(start), index=items.index)
+    end = pd.Series(julian(end), index=items.index)
+    multiple = pd.Series(rng.choice([1, 1, 1, 2], n), index=items.index)
+    reduced = (items['PRICE'] * multiple * rng.uniform(0.7, 0.95, n)).map('{:.2f}'.format)
+    if table == 'URM_TPN':
+        return ('(' + f01 + ",'1'," + price + ',1,' + cost + ',' + multiple.astype(str) + ',' + reduced + ','
+                + start + ',' + end + ",'B')")
+    return ('(' + f01 + ",'1'," + price + ',1,' + cost + ',' + multiple.astype(str) + ',' + reduced + ','
+            + start + ',' + end + ')')
+
+# writes a SIL file with a CREATE TABLE of the field types and a section for each URM_* table
+def write_sil(rng, items, file):
+    views = {'URM_NEW': NEW_FIELDS, 'URM_CHG': NEW_FIELDS, 'URM_PCU': PCU_FIELDS, 'URM_PCD': PCU_FIELDS,
+             'URM_CPN': AD_FIELDS, 'URM_TPN': TPR_FIELDS}
+    with open(file, 'w') as f:
+        f.write("INSERT INTO HEADER_DCT VALUES (\n'HC','000001','URMMNT','000000','AUDLOG.POS','000000.POS',"
+                "2024236,1828,2024239,0000,       ,'LOAD','BATCH TO CREATE TABLES',,,,\n9,99999,'1/1.00','VER3','F01',);\n")
+        fields = ',\n'.join(f'{field} {kind}({size},{scale})' if scale else f'{field} {kind}({size})'
+                            for field, (kind, size, scale) in SIL_FIELD_TYPES.items())
+        f.write('CREATE TABLE ALLOW_DCT (\n' + fields + ')\n;\n')
+
+        for num, (table, share) in enumerate(SIL_SHARES.items(), start=2):
+            table_items = items.sample(frac=share, random_state=rng.integers(0, 2 ** 31))
+            if table in ('URM_NEW', 'URM_CHG'):  # half of the new items are not in the inventory yet
+                table_items = table_items.copy()
+                half = len(table_items) // 2
+                table_items.iloc[:half, table_items.columns.get_loc('UPC11')] = (
+                    '9' + table_items['UPC11'].iloc[:half].str[1:])
+            f.write(f"INSERT INTO HEADER_DCT VALUES (\n'HM','{num:06d}','URMMNT','000000','AUDLOG.POS','000000.POS',"
+                    f"2024236,1828,2024239,0000,       ,'CHANGE','Batch',,,,\n9,99999,'1/1.00','VER3','F01',);\n")
+            f.write(f'CREATE VIEW {table} AS SELECT\n ' + '  ,'.join(views[table].split(',')) + '\nFROM ITEM_DCT;\n')
+            f.write(f'INSERT INTO {table} VALUES\n')
+            rows = make_rows(rng, table, table_items)
+            f.write('\n,'.join(rows) + '\n;\n')
+
+# writes SIL.TXT and INV.csv for a store with n items into out_dir, returns their paths
+def generate(n, out_dir, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    items = make_items(rng, n)
+    sil_file = os.path.join(out_dir, 'SIL.TXT')
+    st_file = os.path.join(out_dir, 'INV.csv')
+    write_inventory(items, st_file)
+    write_sil(rng, items, sil_file)
+    return sil_file, st_file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='generate a synthetic SIL file and POS inventory export')
+    parser.add_argument('items', type=int, help='number of items in the inventory')
+    parser.add_argument('out_dir', help='directory to write SIL.TXT and INV.csv to')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(*generate(args.items, args.out_dir, args.seed))
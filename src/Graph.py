@@ -0,0 +1,46 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# a dependency graph of named stages, each a function of the results of the stages it depends on.
+# results are memoized, so every stage runs once however many stages use it, and stages whose
+# dependencies are done run concurrently: the run takes as long as its longest chain of stages
+class StageGraph:
+    def __init__(self, results=None):
+        self.stages = {}  # name -> (fn, names of the stages it depends on)
+        self.results = dict(results or {})  # stages already done are not run
+
+    # adds a stage, its dependencies must already be in the graph (so there are no cycles)
+    def add(self, name, fn, *deps):
+        if name in self.stages:
+            raise ValueError('stage already in the graph: ' + name)
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f'stage {name} depends on unknown stages: {", ".join(missing)}')
+        self.stages[name] = (fn, deps)
+
+    # the stages that still have to run for targets, in the order they were added
+    def needed(self, targets):
+        needed = set()
+        stack = [name for name in targets if name not in self.results]
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(dep for dep in self.stages[name][1] if dep not in self.results)
+        return [name for name in self.stages if name in needed]
+
+    # runs the stages needed for targets (every stage by default) on up to max_workers threads and returns
+    # the targets' results. the first stage to fail raises its error once the running stages are done
+    def run(self, targets=None, max_workers=None):
+        targets = list(self.stages) if targets is None else list(targets)
+        pending = self.needed(targets)
+        with ThreadPoolExecutor(max_workers) as pool:
+            running = {}
+            while pending or running:
+                for name in [name for name in pending if all(dep in self.results for dep in self.stages[name][1])]:
+                    fn, deps = self.stages[name]
+                    running[pool.submit(fn, *(self.results[dep] for dep in deps))] = name
+                    pending.remove(name)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.results[running.pop(future)] = future.result()
+        return {name: self.results[name] for name in targets}
@@ -0,0 +1,156 @@
+import argparse
+import pandas as pd
+import sqlite3
+import time
+
+# price history of every UPC over the runs, in tables of the db kept next to the tables each run writes:
+# prices in cents, dates as yyyy-mm-dd and indexes for the questions asked of it, e.g.
+# python History.py ../db/urm.db upc 036000543087       (price and cost history of a UPC)
+# python History.py ../db/urm.db tprs 2024-08-20        (TPRs active on a date, also: sales)
+# python History.py ../db/urm.db margin 30 --since 2024-08-01  (price changes that put a margin below 30%)
+# python History.py ../db/urm.db rebuild                (history of every run again, e.g. for runs from before it)
+#
+# a run's rows are added from the tables it wrote (FINAL NEW, FINAL PCU, ALL TPR, ALL SALE) in its transaction.
+# the price history has a row per UPC and run, the TPR and sale history a row per promotion (UPC and window)
+# with the first and last run that had it, as a promotion is in every file until it ends. ALL TPR and ALL SALE
+# have every promotion of the SIL file, also those a delta run left out of the uploadables as unchanged
+
+PRICE_HISTORY_TABLE = 'PRICE HISTORY'
+TPR_HISTORY_TABLE = 'TPR HISTORY'
+SALE_HISTORY_TABLE = 'SALE HISTORY'
+RUNS_TABLE = 'RUNS'
+
+# date columns of the promotion tables a run writes
+PROMOTION_DATES = {'ALL TPR': ['TPR START DATE', 'TPR END DATE'], 'ALL SALE': ['SALE START DATE', 'SALE END DATE']}
+
+# sql of a price text ('1.99') in cents, of a mm/dd/yyyy date as yyyy-mm-dd and of a margin % from a unit cost and a price
+def cents(col):
+    return f'CAST(ROUND(CAST({col} AS REAL) * 100) AS INTEGER)'
+
+def iso_date(col):
+    return f"substr({col}, 7, 4) || '-' || substr({col}, 1, 2) || '-' || substr({col}, 4, 2)"
+
+def margin(unit_cost, price):
+    return f'ROUND((1 - ROUND({unit_cost}, 2) / CAST({price} AS REAL)) * 100, 2)'
+
+HISTORY_SCHEMA = [
+    f'''CREATE TABLE IF NOT EXISTS "{PRICE_HISTORY_TABLE}" ("RUN ID" INTEGER, "UPC" TEXT, "SOURCE" TEXT, "OLD PRICE" INTEGER,
+        "PRICE" INTEGER, "OLD CASE COST" REAL, "CASE COST" REAL, "CASE PACK" INTEGER, "OLD MARGIN" REAL, "MARGIN" REAL)''',
+    f'CREATE INDEX IF NOT EXISTS "{PRICE_HISTORY_TABLE} UPC" ON "{PRICE_HISTORY_TABLE}" ("UPC", "RUN ID")',
+    f'CREATE INDEX IF NOT EXISTS "{PRICE_HISTORY_TABLE} MARGIN" ON "{PRICE_HISTORY_TABLE}" ("MARGIN", "OLD MARGIN", "RUN ID")',
+    f'CREATE INDEX IF NOT EXISTS "{PRICE_HISTORY_TABLE} RUN ID" ON "{PRICE_HISTORY_TABLE}" ("RUN ID")',
+    f'''CREATE TABLE IF NOT EXISTS "{TPR_HISTORY_TABLE}" ("UPC" TEXT, "START DATE" TEXT, "END DATE" TEXT, "PRICE" INTEGER,
+        "TPR PRICE" INTEGER, "MARGIN" REAL, "FIRST RUN ID" INTEGER, "LAST RUN ID" INTEGER, PRIMARY KEY ("UPC", "START DATE", "END DATE"))''',
+    f'CREATE INDEX IF NOT EXISTS "{TPR_HISTORY_TABLE} DATES" ON "{TPR_HISTORY_TABLE}" ("END DATE", "START DATE")',
+    f'''CREATE TABLE IF NOT EXISTS "{SALE_HISTORY_TABLE}" ("UPC" TEXT, "START DATE" TEXT, "END DATE" TEXT, "PRICE" INTEGER,
+        "SALE PRICE MULTIPLE" INTEGER, "SALE PRICE" INTEGER, "MARGIN" REAL, "FIRST RUN ID" INTEGER, "LAST RUN ID" INTEGER,
+        PRIMARY KEY ("UPC", "START DATE", "END DATE"))''',
+    f'CREATE INDEX IF NOT EXISTS "{SALE_HISTORY_TABLE} DATES" ON "{SALE_HISTORY_TABLE}" ("END DATE", "START DATE")',
+]
+
+# a promotion already in the history gets the run as its first or last run and the prices of its last run
+def upsert_promotion(cols):
+    updates = ', '.join(f'"{col}" = CASE WHEN excluded."LAST RUN ID" >= "LAST RUN ID" THEN excluded."{col}" ELSE "{col}" END' for col in cols)
+    return f'''ON CONFLICT ("UPC", "START DATE", "END DATE") DO UPDATE SET {updates},
+        "FIRST RUN ID" = min("FIRST RUN ID", excluded."FIRST RUN ID"), "LAST RUN ID" = max("LAST RUN ID", excluded."LAST RUN ID")'''
+
+# table of the run -> (history table made from it, the select of its rows from the table, what is done with a
+# row the history already has)
+HISTORY_SOURCES = {
+    'FINAL NEW': (PRICE_HISTORY_TABLE, f'''SELECT "RUN ID", "UPC", 'NEW', NULL, {cents('"PRICE"')}, NULL, "CASE COST", "CASE PACK",
+        NULL, {margin('"CASE COST" / "CASE PACK"', '"PRICE"')} FROM "FINAL NEW"''', ''),
+    'FINAL PCU': (PRICE_HISTORY_TABLE, f'''SELECT "RUN ID", "UPC", 'PCU', {cents('"OLD PRICE"')}, {cents('"PRICE"')}, "OLD CASE COST",
+        "CASE COST", "CASE PACK", {margin('"OLD CASE COST" / "CASE PACK"', '"OLD PRICE"')}, "MARGIN" FROM "FINAL PCU"''', ''),
+    'ALL TPR': (TPR_HISTORY_TABLE, f'''SELECT "UPC", {iso_date('"TPR START DATE"')}, {iso_date('"TPR END DATE"')}, {cents('"PRICE"')},
+        {cents('"TPR PRICE"')}, "MARGIN", "RUN ID", "RUN ID" FROM "ALL TPR"''', upsert_promotion(['PRICE', 'TPR PRICE', 'MARGIN'])),
+    'ALL SALE': (SALE_HISTORY_TABLE, f'''SELECT "UPC", {iso_date('"SALE START DATE"')}, {iso_date('"SALE END DATE"')}, {cents('"PRICE"')},
+        "SALE PRICE MULTIPLE", {cents('"SALE PRICE"')}, CAST("MARGIN" AS REAL), "RUN ID", "RUN ID" FROM "ALL SALE"''',
+                 upsert_promotion(['PRICE', 'SALE PRICE MULTIPLE', 'SALE PRICE', 'MARGIN'])),
+}
+
+# adds the rows a run wrote to the history (replacing the price history it already has of the run), in the
+# caller's transaction. rows without a UPC or promotion dates are left out
+def record_run(conn, run_id):
+    for sql in HISTORY_SCHEMA:
+        conn.execute(sql)
+    conn.execute(f'DELETE FROM "{PRICE_HISTORY_TABLE}" WHERE "RUN ID" = ?', (run_id,))
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for source, (table, select, on_conflict) in HISTORY_SOURCES.items():
+        if source in existing:
+            where = ' AND '.join(['"RUN ID" = ?', '"UPC" IS NOT NULL'] + [f'"{col}" IS NOT NULL' for col in PROMOTION_DATES.get(source, [])])
+            conn.execute(f'INSERT INTO "{table}" {select} WHERE {where} {on_conflict}', (run_id,))
+
+# the history of every finished run again, from the tables the runs wrote
+def rebuild(dbPath):
+    conn = sqlite3.connect(dbPath, isolation_level=None)
+    try:
+        conn.execute('BEGIN')
+        for table in [PRICE_HISTORY_TABLE, TPR_HISTORY_TABLE, SALE_HISTORY_TABLE]:
+            conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+        run_ids = [row[0] for row in conn.execute(f'SELECT "RUN ID" FROM "{RUNS_TABLE}" WHERE "FINISHED" IS NOT NULL ORDER BY "RUN ID"')]
+        for run_id in run_ids:
+            record_run(conn, run_id)
+        conn.execute('COMMIT')
+        return len(run_ids)
+    finally:
+        conn.close()
+
+# the price and cost changes of a UPC, oldest first
+def price_history(conn, upc, limit=None):
+    return pd.read_sql(f'''SELECT substr(r."STARTED", 1, 10) AS "RUN DATE", h."RUN ID", h."SOURCE", h."OLD PRICE" / 100.0 AS "OLD PRICE",
+        h."PRICE" / 100.0 AS "PRICE", h."OLD CASE COST", h."CASE COST", h."CASE PACK", h."OLD MARGIN", h."MARGIN"
+        FROM "{PRICE_HISTORY_TABLE}" h JOIN "{RUNS_TABLE}" r ON r."RUN ID" = h."RUN ID"
+        WHERE h."UPC" = ? ORDER BY h."RUN ID" LIMIT ?''', conn, params=(upc, -1 if limit is None else limit))
+
+# the TPRs (or sales) active on a date (yyyy-mm-dd), with the prices of the last run that had them
+def active_promotions(conn, date, table=TPR_HISTORY_TABLE, limit=None):
+    price = '"TPR PRICE" / 100.0 AS "TPR PRICE"' if table == TPR_HISTORY_TABLE else \
+        '"SALE PRICE MULTIPLE", "SALE PRICE" / 100.0 AS "SALE PRICE"'
+    return pd.read_sql(f'''SELECT "UPC", "START DATE", "END DATE", "PRICE" / 100.0 AS "PRICE", {price}, "MARGIN", "FIRST RUN ID", "LAST RUN ID"
+        FROM "{table}" WHERE "END DATE" >= ? AND "START DATE" <= ? ORDER BY "UPC", "START DATE" LIMIT ?''',
+                       conn, params=(date, date, -1 if limit is None else limit))
+
+# the price changes that put the margin of an item below `below` % (from at or above it), in the runs since a date (yyyy-mm-dd)
+def margin_drops(conn, below, since=None, limit=None):
+    return pd.read_sql(f'''SELECT substr(r."STARTED", 1, 10) AS "RUN DATE", h."RUN ID", h."UPC", h."OLD PRICE" / 100.0 AS "OLD PRICE",
+        h."PRICE" / 100.0 AS "PRICE", h."OLD CASE COST", h."CASE COST", h."OLD MARGIN", h."MARGIN"
+        FROM "{PRICE_HISTORY_TABLE}" h JOIN "{RUNS_TABLE}" r ON r."RUN ID" = h."RUN ID"
+        WHERE h."MARGIN" < ? AND h."OLD MARGIN" >= ?
+        AND h."RUN ID" >= (SELECT coalesce(min("RUN ID"), 1 << 62) FROM "{RUNS_TABLE}" WHERE "STARTED" >= ?)
+        ORDER BY h."RUN ID", h."UPC" LIMIT ?''', conn, params=(below, below, since or '', -1 if limit is None else limit))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='query the price history of the runs in a db')
+    parser.add_argument('db', help='db of the runs, e.g. ../db/urm.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = argparse.ArgumentParser(add_help=False)
+    query.add_argument('--limit', type=int, default=1000, help='most rows to print (-1 for all)')
+    commands.add_parser('upc', parents=[query], help='price and cost history of a UPC').add_argument('upc')
+    commands.add_parser('tprs', parents=[query], help='TPRs active on a date').add_argument('date', help='yyyy-mm-dd')
+    commands.add_parser('sales', parents=[query], help='sales active on a date').add_argument('date', help='yyyy-mm-dd')
+    margin_parser = commands.add_parser('margin', parents=[query], help='price changes that put a margin below a %%')
+    margin_parser.add_argument('below', type=float)
+    margin_parser.add_argument('--since', help='only runs since this date (yyyy-mm-dd)')
+    commands.add_parser('rebuild', help='history of every run again from the tables the runs wrote')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'rebuild':
+        print(f'history of {rebuild(args.db)} runs rebuilt in {time.perf_counter() - start:.2f}s')
+        raise SystemExit(0)
+
+    limit = None if args.limit < 0 else args.limit
+
+    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    try:
+        if args.command == 'upc':
+            result = price_history(conn, args.upc, limit)
+        elif args.command == 'margin':
+            result = margin_drops(conn, args.below, args.since, limit)
+        else:
+            result = active_promotions(conn, args.date, TPR_HISTORY_TABLE if args.command == 'tprs' else SALE_HISTORY_TABLE, limit)
+    finally:
+        conn.close()
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(result.to_string(index=False))
+    print(f'{len(result)} rows{" (--limit)" if len(result) == limit else ""} in {(time.perf_counter() - start) * 1000:.1f} ms')
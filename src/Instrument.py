@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import threading
+import time
+import tracemalloc
+
+# per stage instrumentation of a run: wall and cpu time, peak memory (tracemalloc) and rows in/out of
+# every stage timed with stage(), and the errors that did not fail the run (error()). stages only record
+# anything between start() and stop()
+
+STAGES_TABLE = 'RUN STAGES'
+REPORT_FILE = 'run_report.json'
+
+current = None  # profile of the run being instrumented
+
+# the stages recorded in one run
+class Profile:
+    def __init__(self, trace_memory=False):
+        self.started = time.perf_counter()
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.trace_memory = trace_memory
+        self.started_tracing = False
+        self.stages = []
+        self.errors = []  # {'STAGE', 'ERROR'} of the errors the run went on after
+        self.local = threading.local()  # peaks of the stages open in each thread, innermost last
+
+    def open_peaks(self):
+        if not hasattr(self.local, 'peaks'):
+            self.local.peaks = []
+        return self.local.peaks
+
+    # times the stage in the with block, the record it yields gets its 'ROWS OUT' set by the caller.
+    # nested stages are recorded too and count towards the peak of the stages they are in. tracemalloc has one
+    # peak for the process, so the peaks are only those of the stage when the stages run one at a time
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        record = {'STAGE': name, 'ROWS IN': rows_in, 'ROWS OUT': None}
+        peaks = self.open_peaks()
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            memory, peak = tracemalloc.get_traced_memory()
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak)  # the peak so far of the stage this one is in
+            tracemalloc.reset_peak()
+            peaks.append(memory)
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield record
+        finally:
+            record['START SECONDS'] = round(start - self.started, 4)
+            record['WALL SECONDS'] = round(time.perf_counter() - start, 4)
+            record['CPU SECONDS'] = round(time.thread_time() - cpu_start, 4)
+            record['PEAK MB'] = None
+            if tracing:
+                memory = peaks.pop()
+                peak = max(tracemalloc.get_traced_memory()[1], memory)
+                record['PEAK MB'] = round((peak - memory) / 2 ** 20, 2)  # on top of what was in use at the start
+            self.stages.append(record)
+
+    # combines the records of the stages with the same name (e.g. one per chunk of a table) into one:
+    # rows, wall and cpu time added up, the first start and the highest peak
+    def merge_stages(self):
+        merged = {}
+        for record in self.stages:
+            total = merged.get(record['STAGE'])
+            if total is None:
+                merged[record['STAGE']] = dict(record)
+                continue
+            for col in ['ROWS IN', 'ROWS OUT', 'WALL SECONDS', 'CPU SECONDS']:
+                if record[col] is not None:
+                    total[col] = round((total[col] or 0) + record[col], 4)
+            total['START SECONDS'] = min(total['START SECONDS'], record['START SECONDS'])
+            if record['PEAK MB'] is not None:
+                total['PEAK MB'] = max(total['PEAK MB'] or 0, record['PEAK MB'])
+        self.stages = list(merged.values())
+
+    # the machine readable report of the run
+    def report(self, **info):
+        return {**info, 'STARTED': self.started_at, 'WALL SECONDS': round(time.perf_counter() - self.started, 4),
+                'ERRORS': self.errors, 'STAGES': sorted(self.stages, key=lambda record: record['START SECONDS'])}
+
+# starts instrumenting a run, with trace_memory the peak memory of each stage is traced too (slower)
+def start(trace_memory=False):
+    global current
+    current = Profile(trace_memory)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        current.started_tracing = True
+    return current
+
+# stops instrumenting and returns the run's profile
+def stop():
+    global current
+    profile, current = current, None
+    if profile is not None and profile.started_tracing:
+        tracemalloc.stop()
+    return profile
+
+# times a stage of the run being instrumented, does nothing (but yield a record) if there is none
+@contextmanager
+def stage(name, rows_in=None):
+    profile = current
+    if profile is None:
+        yield {}
+        return
+    with profile.stage(name, rows_in) as record:
+        yield record
+
+# records an error the run being instrumented went on after (e.g. a printer that could not be reached)
+def error(name, message):
+    profile = current
+    if profile is not None:
+        profile.errors.append({'STAGE': name, 'ERROR': message})
+
+# writes the report of a run as json
+def write_report(profile, file, **info):
+    with open(file, 'w') as f:
+        json.dump(profile.report(**info), f, indent=2)
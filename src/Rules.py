@@ -0,0 +1,106 @@
+import argparse
+import json
+import numpy as np
+import pandas as pd
+import sqlite3
+
+# the department, tax, EBT, UOM and margin rules of a run as data instead of code. the defaults below can
+# be overridden per key in the RULES table of the db, e.g. from a json config with
+# python Rules.py ../db/urm.db --import rules.json (--export prints the rules a run would use)
+#
+# every rule set is compiled to a lookup of its keys, so a column is looked up in one pass however many
+# rules the set has
+
+RULES_TABLE = 'RULES'
+
+# rule set -> (type of its keys, type of its values), keys and values are kept as text in the db and config
+RULE_SETS = {'GROUP DEPARTMENTS': (int, int),  # GROUP -> POS DEPARTMENT of the new items
+             'DEPARTMENT FOOD STAMP': (int, str),  # POS DEPARTMENT -> FOOD STAMP of the new items
+             'DEPARTMENT TAX FLAG 1': (int, str),  # POS DEPARTMENT -> TAX FLAG 1 of the new items
+             'UOM CODES': (str, str),  # SIL unit of measure code -> UOM in the new items' DESCRIPTION
+             'TPR MIN MARGINS': (str, float)}  # inventory DEPT NO -> min margin of its TPRs (instead of the run's)
+
+# rule set -> the inventory column its keys are looked up in (the other rule sets look up SIL values)
+ST_KEY_COLUMNS = {'TPR MIN MARGINS': 'DEPT NO'}
+
+# 1: GROCERY (EBT, NO TAX)
+# 3: GROCERY (NO EBT, TAX)
+# 4: NA BEVERAGES (EBT, TAX)
+# 10: HOT DELI (NO EBT, TAX)
+DEFAULT_RULES = {'GROUP DEPARTMENTS': {'317': '3'},  # puts feminine products into taxable
+                 'DEPARTMENT FOOD STAMP': {'1': 'True', '3': 'False', '4': 'True', '10': 'False'},
+                 'DEPARTMENT TAX FLAG 1': {'1': '0', '3': '1', '4': '1', '10': '1'},
+                 'UOM CODES': {'48': 'OZ', '32': 'SQFT', '1': 'EA', '86': 'G', '41': 'FLOZ', '22': 'LINFT'},
+                 'TPR MIN MARGINS': {}}
+
+# the rules of the db: the defaults with the keys in its RULES table added or replaced (or removed if their
+# value is NULL), sorted so that the same rules always compare and hash the same
+def load_rules(dbPath=None):
+    rules = {name: dict(rule_set) for name, rule_set in DEFAULT_RULES.items()}
+    if dbPath is not None:
+        conn = sqlite3.connect(dbPath)
+        try:
+            if conn.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('table', RULES_TABLE)).fetchone():
+                for name, key, value in conn.execute(f'SELECT "RULE SET", "KEY", "VALUE" FROM "{RULES_TABLE}" ORDER BY rowid'):
+                    if name not in RULE_SETS:
+                        raise ValueError(f'unknown rule set in {RULES_TABLE}: {name}')
+                    if value is None:
+                        rules[name].pop(key, None)
+                    else:
+                        rules[name][key] = value
+        finally:
+            conn.close()
+    return {name: dict(sorted(rule_set.items())) for name, rule_set in rules.items()}
+
+# replaces the RULES table of the db with rules ({rule set: {key: value or None}}, e.g. from a json config)
+def save_rules(dbPath, rules):
+    unknown = [name for name in rules if name not in RULE_SETS]
+    if unknown:
+        raise ValueError('unknown rule sets: ' + ', '.join(unknown))
+    compile_rules({name: {k: v for k, v in rule_set.items() if v is not None} for name, rule_set in rules.items()})  # type check
+    conn = sqlite3.connect(dbPath)
+    try:
+        with conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{RULES_TABLE}" ("RULE SET" TEXT, "KEY" TEXT, "VALUE" TEXT)')
+            conn.execute(f'DELETE FROM "{RULES_TABLE}"')
+            conn.executemany(f'INSERT INTO "{RULES_TABLE}" VALUES (?, ?, ?)',
+                             [(name, str(key), None if value is None else str(value))
+                              for name, rule_set in rules.items() for key, value in rule_set.items()])
+    finally:
+        conn.close()
+
+# compiles every rule set to (index of its keys, array of its values with a last slot for the rows that
+# match no key), so that get_indexer's -1 for those rows picks the last slot. keys that are the same once
+# typed (e.g. '01' and '1') are an error
+def compile_rules(rules):
+    compiled = {}
+    for name, (key_type, value_type) in RULE_SETS.items():
+        rule_set = rules.get(name, {})
+        keys = pd.Index([key_type(key) for key in rule_set], dtype=object if key_type is str else None)
+        if not keys.is_unique:  # also builds the index's lookup table now, the stages share it across threads
+            raise ValueError(f'rule set {name} has the same key more than once: {list(keys[keys.duplicated()])}')
+        values = np.array([value_type(value) for value in rule_set.values()] + [None], dtype=object)
+        compiled[name] = (keys, values)
+    return compiled
+
+# looks every row of data up in a compiled rule set, the rows that match no key get otherwise
+# (a scalar or a Series like data)
+def apply_rules(compiled_set, data, otherwise):
+    keys, values = compiled_set
+    pos = keys.get_indexer(np.asarray(data, dtype=object) if keys.dtype == object else data)
+    return pd.Series(values[pos], index=data.index).where(pos >= 0, otherwise)
+
+DEFAULT_COMPILED = compile_rules(load_rules())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='import or export the pricing and tax rules of a db')
+    parser.add_argument('db', help='db of the runs, e.g. ../db/urm.db')
+    parser.add_argument('--import', dest='import_file', help='json config of the rule sets to store in the db')
+    parser.add_argument('--export', action='store_true', help='print the rules the runs use as json')
+    args = parser.parse_args()
+
+    if args.import_file:
+        with open(args.import_file) as f:
+            save_rules(args.db, json.load(f))
+    if args.export or not args.import_file:
+        print(json.dumps(load_rules(args.db), indent=2))
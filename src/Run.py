@@ -1,4 +1,5 @@
 
+from Stream import parse_streaming
 from Urm import parse
 
 # runs the URM Maintenance file processor based based on the parameters below
@@ -19,5 +20,15 @@ uploadable_new_items = "../files/uploadables/uploadable_new.csv"
 uploadable_pcu_items = "../files/uploadables/uploadable_pcu.csv"
 uploadable_tprs = "../files/uploadables/uploadable_tprs.csv"
 uploadable_ads = "../files/uploadables/uploadable_ads.csv"
+stored_zpl_format = False  # True stores the logo on the printer once per tag file and recalls it on every tag (smaller files)
+price_printers = []  # Zebra printers ('host' or 'host:port') to stream the tags to, e.g. ['192.168.1.50']
+tpr_printers = []
+delta = False  # True only processes the rows of the SIL file that changed since the last run (the outputs then only have those rows)
+chunk_rows = None  # e.g. 50000 reads the SIL file that many rows at a time (memory bounded by the chunk size, not the file)
 
-parse(stFile, silFile, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads, dbPath, only_do_if_cost_change=False, min_tpr_margin=40)
\ No newline at end of file
+if chunk_rows:
+    parse_streaming(stFile, silFile, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads, dbPath, only_do_if_cost_change=False, min_tpr_margin=40,
+                    stored_zpl_format=stored_zpl_format, price_printers=price_printers, tpr_printers=tpr_printers, full_rebuild=not delta, chunk_rows=chunk_rows)
+else:
+    parse(stFile, silFile, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads, dbPath, only_do_if_cost_change=False, min_tpr_margin=40, stored_zpl_format=stored_zpl_format,
+          price_printers=price_printers, tpr_printers=tpr_printers, full_rebuild=not delta)
\ No newline at end of file
@@ -0,0 +1,108 @@
+import queue
+import socket
+import threading
+import time
+
+ZEBRA_PORT = 9100  # raw printing port of Zebra printers
+
+# streams ZPL labels to one or more Zebra printers over raw TCP while they are being written.
+# labels are grouped into batches, batches are given to the printers round robin and each printer
+# has a bounded queue of batches, so send() blocks (backpressure) when the printers fall behind.
+# a printer whose connection drops is reconnected and the batches that may not have arrived are sent again
+class ZplSpooler:
+    def __init__(self, printers, header='', batch_size=50, max_pending=4, retries=5, retry_delay=1.0, timeout=10.0):
+        if not printers:
+            raise ValueError('no printers to spool to')
+        self.header = header.encode() if header else b''  # sent on every (re)connect, e.g. stored formats
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.batch = []
+        self.next_printer = 0
+        self.errors = []
+        self.queues = []
+        self.threads = []
+        for printer in printers:
+            host, _, port = printer.partition(':')
+            batches = queue.Queue(maxsize=max_pending)
+            thread = threading.Thread(target=self.send_batches, args=(host, int(port or ZEBRA_PORT), batches), daemon=True)
+            thread.start()
+            self.queues.append(batches)
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # adds a label, a full batch is handed to the next printer
+    def send(self, label):
+        self.batch.append(label if label.endswith('\n') else label + '\n')
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    # hands the labels not yet sent to the next printer
+    def flush(self):
+        if self.errors:
+            raise ConnectionError('printer failed: ' + '; '.join(self.errors))
+        if not self.batch:
+            return
+        data = ''.join(self.batch).encode()
+        self.batch = []
+        self.queues[self.next_printer].put(data)  # blocks while that printer's queue is full
+        self.next_printer = (self.next_printer + 1) % len(self.queues)
+
+    # sends the last labels and waits for every printer to receive all of its batches
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for batches in self.queues:
+                batches.put(None)
+            for thread in self.threads:
+                thread.join()
+        if self.errors:
+            raise ConnectionError('printer failed: ' + '; '.join(self.errors))
+
+    def connect(self, host, port):
+        conn = socket.create_connection((host, port), timeout=self.timeout)
+        if self.header:
+            conn.sendall(self.header)
+        return conn
+
+    # sender thread of one printer: sends its batches in order, reconnecting on errors. a send only fails
+    # after the connection dropped, so the batch before it is resent too (labels may print twice, not never)
+    def send_batches(self, host, port, batches):
+        conn = None
+        last = b''
+        failed = False
+        while True:
+            data = batches.get()
+            if data is None:
+                break
+            if failed:
+                continue  # keep draining so send() does not block forever
+
+            pending = data
+            for attempt in range(self.retries + 1):
+                try:
+                    if conn is None:
+                        conn = self.connect(host, port)
+                    conn.sendall(pending)
+                    last = data
+                    break
+                except OSError as e:
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    pending = last + data
+                    if attempt == self.retries:
+                        self.errors.append(f'{host}:{port} {e}')
+                        failed = True
+                    else:
+                        time.sleep(self.retry_delay)
+
+        if conn is not None:
+            conn.close()
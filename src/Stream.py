@@ -0,0 +1,268 @@
+import argparse
+from contextlib import ExitStack
+from datetime import datetime
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import tempfile
+import Instrument as instrument
+import Rules as rules
+import Urm as urm
+import Utils as utils
+
+# processes a SIL file in chunks of rows, so that the memory a run needs depends on the chunk size and not on
+# the size of the SIL file, e.g. python Stream.py ../files/INV08272024.csv ../files/SIL.TXT --chunk-rows 50000
+#
+# every chunk of a SIL table is formatted, looked up in the inventory (indexed once), filtered and spooled
+# to disk as it is read. the price changes are spooled until the file is read, as they leave out the UPCs
+# of every new item in it. the spooled chunks are then written to the uploadables, the db and the tags one
+# at a time in the order parse writes them, so the outputs are the same as parse's
+
+CHUNK_ROWS = 50000
+NEW_TABLES = {'URM_NEW': ('NEW', 'PCU (NEW FORMAT)'), 'URM_CHG': ('NEW_CHG', 'PCU (NEW FORMAT)_CHG')}
+PCU_TABLES = {'URM_PCU': 'PCU', 'URM_PCD': 'PCD'}
+
+# pickled chunks of dfs appended to a file per name in a scratch dir, read back one at a time
+class Spool:
+    def __init__(self, spool_dir):
+        self.dir = spool_dir
+        self.files = {}
+
+    def write(self, name, data):
+        if name not in self.files:
+            self.files[name] = os.path.join(self.dir, f'{len(self.files)}.pkl')
+        with open(self.files[name], 'ab') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read(self, name):
+        if name not in self.files:
+            return
+        with open(self.files[name], 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    # the chunks of names one after the other
+    def read_all(self, names):
+        for name in names:
+            yield from self.read(name)
+
+# writes chunks of rows to an uploadable csv and a table of the db as they come. empty chunks are left out
+# unless every chunk is empty (the table is still created, with the columns of the first one)
+class OutputWriter:
+    def __init__(self, csv_file, conn, table_name, run_id):
+        self.csv_file = csv_file
+        self.conn = conn
+        self.table_name = table_name
+        self.run_id = run_id
+        self.is_empty = True
+        self.empty = None  # the first empty chunk
+
+    def __enter__(self):
+        self.file = open(self.csv_file, 'w', newline='')
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None and self.is_empty and self.empty is not None:
+            self.write_chunk(*self.empty)
+        self.file.close()
+
+    # the db table gets db_data if given (the TPR and sale tables have their rows from before the dropna)
+    def write(self, data, db_data=None):
+        if data.empty and (db_data is None or db_data.empty):
+            if self.empty is None:
+                self.empty = (data, db_data)
+            return
+        self.write_chunk(data, db_data)
+        self.is_empty = False
+
+    # only the db table gets the rows (the unchanged promotions)
+    def write_db(self, db_data):
+        if not db_data.empty:
+            urm.write_table(self.conn, db_data, self.table_name, self.run_id)
+
+    def write_chunk(self, data, db_data):
+        out = urm.to_output_format(data)
+        with instrument.stage('CSV: ' + os.path.basename(self.csv_file), len(out)) as stage:
+            out.to_csv(self.file, index=False, header=False)
+            stage['ROWS OUT'] = len(out)
+        urm.write_table(self.conn, data if db_data is None else db_data, self.table_name, self.run_id)
+
+# formats, looks up, filters and spools every chunk of the SIL file, returns the keys of the UPCs of every new item
+def read_chunks(silFile, chunk_rows, st, index, st_hashes, compiled, settings, previous, conn, run_id, spool, min_tpr_margin):
+    columns = {}
+    field_types = dict(urm.SIL_FIELD_TYPES)
+    seen = {table: set() for table in NEW_TABLES}  # item nos of the new items (the first row of an item is the one kept)
+    new_keys = []
+    chunks = sil_chunks(silFile, chunk_rows, columns, field_types)
+    while True:
+        with instrument.stage('SIL: read') as stage:
+            table, rows = next(chunks, (None, []))
+            stage['ROWS OUT'] = len(rows)
+        if table is None:
+            break
+        with instrument.stage('SIL: extract ' + table, len(rows)) as stage:
+            data = urm.sil_table(table, rows, columns, field_types)
+            stage['ROWS OUT'] = len(data)
+        del rows
+
+        if table in NEW_TABLES:
+            new_name, pcu_name = NEW_TABLES[table]
+            new, is_first = urm.format_new_items(data, new_name, compiled, seen[table])
+            new_keys.append(utils.upc_keys(new['UPC']).to_numpy())
+            data = urm.first_of_items(new, is_first)
+        elif table in PCU_TABLES:
+            data = urm.format_table(urm.process_pcu, data, PCU_TABLES[table])
+        elif table == 'URM_TPN':
+            data = urm.format_table(urm.process_tpr, data, 'TPR')
+        else:
+            data = urm.format_table(urm.process_ad, data, 'SALE')
+
+        fingerprints = urm.fingerprint_rows(data, st_hashes, settings)
+        urm.insert_fingerprints(conn, table, fingerprints, data, run_id)
+        changed = urm.skip_unchanged(data, fingerprints, previous, table)
+        if table == 'URM_TPN':  # the unchanged promotions are only written to the db (see urm.build_graph)
+            spool.write((table, 'unchanged'), urm.get_tpr(urm.unchanged_rows(data, changed), st, min_margin=min_tpr_margin,
+                                                          is_processed=True, compiled=compiled, index=index))
+        elif table == 'URM_CPN':
+            spool.write((table, 'unchanged'), urm.get_ad(urm.unchanged_rows(data, changed), st, is_processed=True, index=index))
+        data = changed
+
+        if table in NEW_TABLES:
+            new, pcu = urm.get_new(data, st, None, new_name, pcu_name, is_processed=True, index=index)
+            spool.write((table, 'new'), new)
+            spool.write((table, 'pcu'), pcu)
+        elif table in PCU_TABLES:
+            spool.write((table, 'formatted'), data)  # once every new item is read
+        elif table == 'URM_TPN':
+            spool.write(table, urm.get_tpr(data, st, min_margin=min_tpr_margin, is_processed=True, compiled=compiled, index=index))
+        else:
+            spool.write(table, urm.get_ad(data, st, is_processed=True, index=index))
+
+    return np.unique(np.concatenate(new_keys)) if new_keys else np.array([], dtype=np.int64)
+
+# the chunks of rows of the SIL tables that are processed, and no rows for a table that is not in the SIL file
+# (so that its outputs are still written)
+def sil_chunks(silFile, chunk_rows, columns, field_types):
+    tables = set()
+    for table, rows in urm.iter_sil_rows(silFile, columns, field_types, chunk_rows):
+        if table in urm.FINGERPRINT_TABLES and rows:
+            tables.add(table)
+            yield table, rows
+    for table in urm.FINGERPRINT_TABLES:
+        if table not in tables:
+            yield table, []
+
+# looks up the spooled price changes in the inventory, leaving out the UPCs of the new items
+def read_price_changes(st, index, new_keys, spool, only_do_if_cost_change):
+    new_keys = pd.Index(new_keys)
+    new_keys.is_unique  # builds the index's lookup table once
+    for table, name in PCU_TABLES.items():
+        for data in spool.read((table, 'formatted')):
+            spool.write(table, urm.get_pcu(data, st, None, None, name, only_do_if_cost_change=only_do_if_cost_change,
+                                           new_keys=new_keys, is_processed=True, index=index))
+
+# writes the spooled chunks to the uploadables, the db and the tags in the order parse writes them
+def write_chunks(spool, conn, run_id, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads,
+                 stored_zpl_format, price_printers, tpr_printers):
+    tag_dir = os.path.dirname(uploadable_new_items)
+    with ExitStack() as stack:
+        price_tags = stack.enter_context(urm.TagWriter(os.path.join(tag_dir, urm.PRICE_TAGS_FILE), urm.PRICE_TAG_FIELDS,
+                                                       *urm.price_tag_format(stored_zpl_format), price_printers))
+        tpr_tags = stack.enter_context(urm.TagWriter(os.path.join(tag_dir, urm.TPR_TAGS_FILE), urm.TPR_TAG_FIELDS,
+                                                     *urm.tpr_tag_format(stored_zpl_format), tpr_printers))
+        new_out = stack.enter_context(OutputWriter(uploadable_new_items, conn, 'FINAL NEW', run_id))
+        pcu_out = stack.enter_context(OutputWriter(uploadable_pcu_items, conn, 'FINAL PCU', run_id))
+        tpr_out = stack.enter_context(OutputWriter(uploadable_tprs, conn, 'ALL TPR', run_id))
+        ad_out = stack.enter_context(OutputWriter(uploadable_ads, conn, 'ALL SALE', run_id))
+
+        for data in spool.read_all([(table, 'new') for table in NEW_TABLES]):
+            new = urm.finish_new(data)
+            new_out.write(new)
+            price_tags.write(urm.to_output_format(new))
+        for data in spool.read_all([(table, 'pcu') for table in NEW_TABLES] + list(PCU_TABLES)):
+            pcu = urm.finish_pcu(data)
+            pcu_out.write(pcu)
+            price_tags.write(urm.to_output_format(pcu[pcu['PRICE DIF'] != 0.0]))
+        for data in spool.read('URM_TPN'):
+            tpr = urm.drop_missing(data, ['UPC', 'PRICE', 'TPR PRICE'], 'TPR')
+            tpr_out.write(tpr, data)
+            tpr_tags.write(urm.to_output_format(tpr))
+        for data in spool.read(('URM_TPN', 'unchanged')):
+            tpr_out.write_db(data)
+        for data in spool.read('URM_CPN'):
+            ad_out.write(urm.drop_missing(data, ['UPC', 'PRICE', 'SALE PRICE MULTIPLE', 'SALE PRICE'], 'SALE'), data)
+        for data in spool.read(('URM_CPN', 'unchanged')):
+            ad_out.write_db(data)
+
+# does what parse does, reading the SIL file in chunks of chunk_rows rows (see parse for the other arguments)
+def parse_streaming(stFile, silFile, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads, dbPath,
+                    only_do_if_cost_change, min_tpr_margin, stored_zpl_format=False, price_printers=None, tpr_printers=None,
+                    trace_memory=False, full_rebuild=False, chunk_rows=CHUNK_ROWS):
+    started = datetime.now()
+    profile = instrument.start(trace_memory)
+    run_id = None
+    is_finished = False
+    try:
+        st = urm.load_inventory(stFile, dbPath)
+        with instrument.stage('inventory index', len(st)) as stage:
+            index = urm.InventoryIndex(st)
+            st_hashes = urm.inventory_hashes(st)
+            stage['ROWS OUT'] = len(st)
+        rule_sets = rules.load_rules(dbPath)
+        compiled = rules.compile_rules(rule_sets)
+        settings = urm.fingerprint_settings(only_do_if_cost_change, min_tpr_margin, rule_sets)
+        previous = urm.load_fingerprints(dbPath, full_rebuild)
+
+        spool_dir = tempfile.mkdtemp(prefix='.spool_', dir=os.path.dirname(os.path.abspath(uploadable_new_items)))
+        conn = urm.open_db(dbPath)
+        try:
+            run_id = urm.start_run(conn, stFile, silFile, started)
+            urm.clear_fingerprints(conn, urm.FINGERPRINT_TABLES)
+            spool = Spool(spool_dir)
+            new_keys = read_chunks(silFile, chunk_rows, st, index, st_hashes, compiled, settings, previous, conn, run_id, spool,
+                                   min_tpr_margin)
+            del previous
+            read_price_changes(st, index, new_keys, spool, only_do_if_cost_change)
+            write_chunks(spool, conn, run_id, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads,
+                         stored_zpl_format, price_printers, tpr_printers)
+            urm.record_history(conn, run_id)
+            profile.merge_stages()
+            urm.to_sql_table(conn, pd.DataFrame(profile.stages), instrument.STAGES_TABLE, run_id)
+            urm.finish_run(conn, run_id)
+            is_finished = True
+        finally:
+            conn.close()  # a run that failed is rolled back
+            for name in os.listdir(spool_dir):
+                os.remove(os.path.join(spool_dir, name))
+            os.rmdir(spool_dir)
+    finally:
+        instrument.stop()
+        profile.merge_stages()
+        report_file = os.path.join(os.path.dirname(uploadable_new_items), instrument.REPORT_FILE)
+        instrument.write_report(profile, report_file, **{'RUN ID': run_id, 'FINISHED': is_finished,
+                                                          'INVENTORY FILE': stFile, 'SIL FILE': silFile,
+                                                          'CHUNK ROWS': chunk_rows})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='process a SIL file in chunks of rows (bounded memory)')
+    parser.add_argument('inventory', help='inventory export of the store')
+    parser.add_argument('sil', help='SIL file from URM')
+    parser.add_argument('--output-dir', default='../files/uploadables', help='directory to write the uploadables and tags to')
+    parser.add_argument('--db', default='../db/urm.db')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='rows of the SIL file processed at a time')
+    parser.add_argument('--min-tpr-margin', type=float, default=40)
+    parser.add_argument('--only-do-if-cost-change', action='store_true')
+    parser.add_argument('--stored-zpl-format', action='store_true')
+    parser.add_argument('--full-rebuild', action='store_true', help='process every row, not only those changed since the last run')
+    parser.add_argument('--trace-memory', action='store_true', help='trace the peak memory of every stage (slower)')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    paths = {arg: os.path.join(args.output_dir, name) for arg, name in urm.UPLOADABLES.items()}
+    parse_streaming(args.inventory, args.sil, dbPath=args.db, only_do_if_cost_change=args.only_do_if_cost_change,
+                    min_tpr_margin=args.min_tpr_margin, stored_zpl_format=args.stored_zpl_format, trace_memory=args.trace_memory,
+                    full_rebuild=args.full_rebuild, chunk_rows=args.chunk_rows, **paths)
@@ -1,102 +1,305 @@
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import datetime
+import numpy as np
+import os
 import pandas as pd
+import hashlib
 import re
 import sqlite3
+from Graph import StageGraph
+import History as history
+import Instrument as instrument
+import Rules as rules
+from Spooler import ZplSpooler
 import Utils as utils
-from zpl import PRICE_ZPL, TPR_ZPL
+from zpl import (PRICE_ZPL_COMPILED, PRICE_ZPL_HEADER, PRICE_ZPL_STORED_COMPILED, TPR_ZPL_COMPILED, TPR_ZPL_HEADER,
+                 TPR_ZPL_STORED_COMPILED, render_labels)
 
 print_debug = False
 
-def parse_sil_txt(txt_file, header, sql_table_filter, dbPath):
-    is_item_info = False
-    temp_csv = "../files/temp.csv"
-    w = open(temp_csv, 'w')
-    w.write(header + '\n')
+# column names for the URM_* tables used from the SIL file (in the order of their CREATE VIEW)
+NEW_HEADER = 'UPC,POS DESCRIPTION,POS DEPARTMENT,GROUP,SUB GROUP,REPORT CODE,CASE PACK,UNIT OF MEASURE CODE,SIZE,VENDOR NUMBER,DESCRIPTION,PRICE MULTIPLE,PRICE,MIX MATCH CODE,PRICE METHOD,CASE COST,FOOD STAMP,TAX FLAG 1,SCALE FLAG,PRICE REQUIRED FLAG,VISUAL VERIFY FLAG,QUANTITY REQUIRED FLAG,QUANTITY PROHIBIT FLAG,WIC FLAG,VENDOR ITEM NUMBER,ITEMIZER 6,ITEMIZER 7'
+PCU_HEADER = 'UPC,VENDOR NO,PRICE,PRICE MULTIPLE,CASE COST'
+TPR_HEADER = 'UPC,VENDOR NUMBER,PRICE,PRICE MULTIPLE,CASE COST,TPR PRICE MULTIPLE,TPR PRICE,TPR START DATE,TPR END DATE,PRICE METHOD'
+AD_HEADER = 'UPC,VENDOR NUMBER,PRICE,PRICE MULTIPLE,CASE COST,SALE PRICE MULTIPLE,SALE PRICE,SALE START DATE,SALE END DATE'
+
+SIL_HEADERS = {'URM_NEW': NEW_HEADER, 'URM_CHG': NEW_HEADER,
+               'URM_PCU': PCU_HEADER, 'URM_PCD': PCU_HEADER,
+               'URM_TPN': TPR_HEADER, 'URM_CPN': AD_HEADER}
+
+# fields of the URM_* views, used for the tables whose CREATE VIEW is not in the SIL file
+NEW_FIELDS = 'F01,F02,F03,F16,F17,F18,F19,F23,F24,F27,F29,F31,F30,F32,F33,F38,F79,F81,F82,F83,F84,F85,F102,F178,F180,F922,F923'
+PCU_FIELDS = 'F01,F27,F30,F31,F38'
+TPR_FIELDS = 'F01,F27,F30,F31,F38,F182,F181,F183,F184,F221'
+AD_FIELDS = 'F01,F27,F30,F31,F38,F135,F136,F137,F138'
+
+SIL_VIEWS = {'URM_NEW': NEW_FIELDS, 'URM_CHG': NEW_FIELDS,
+             'URM_PCU': PCU_FIELDS, 'URM_PCD': PCU_FIELDS,
+             'URM_TPN': TPR_FIELDS, 'URM_CPN': AD_FIELDS}
+
+# types of the SIL fields as (type, size, scale), used for the fields whose CREATE TABLE is not in the SIL file
+SIL_FIELD_TYPES = {'F01': ('GPC', 14, 0), 'F02': ('CHAR', 20, 0), 'F03': ('NUMBER', 4, 0), 'F16': ('NUMBER', 3, 0),
+                   'F17': ('NUMBER', 3, 0), 'F18': ('NUMBER', 2, 0), 'F19': ('NUMBER', 4, 0), 'F23': ('CHAR', 4, 0),
+                   'F24': ('NUMBER', 7, 3), 'F27': ('CHAR', 9, 0), 'F29': ('CHAR', 30, 0), 'F30': ('NUMBER', 6, 2),
+                   'F31': ('NUMBER', 3, 0), 'F32': ('NUMBER', 3, 0), 'F33': ('CHAR', 1, 0), 'F38': ('NUMBER', 9, 5),
+                   'F79': ('FLAG', 1, 0), 'F81': ('FLAG', 1, 0), 'F82': ('FLAG', 1, 0), 'F83': ('FLAG', 1, 0),
+                   'F84': ('FLAG', 1, 0), 'F85': ('FLAG', 1, 0), 'F102': ('FLAG', 1, 0), 'F178': ('FLAG', 1, 0),
+                   'F180': ('CHAR', 13, 0), 'F922': ('FLAG', 1, 0), 'F923': ('FLAG', 1, 0), 'F135': ('NUMBER', 3, 0),
+                   'F136': ('NUMBER', 7, 2), 'F137': ('DATE', 7, 0), 'F138': ('DATE', 7, 0), 'F182': ('NUMBER', 3, 0),
+                   'F181': ('NUMBER', 7, 2), 'F183': ('DATE', 7, 0), 'F184': ('DATE', 7, 0), 'F221': ('CHAR', 1, 0)}
+
+# SIL price fields (PRICE, SALE PRICE, TPR PRICE) are decoded to Int64 cents whatever scale their CREATE TABLE
+# declares, and written back as the SIL has them. F38 (CASE COST) is not decoded: the uploadables have the SIL's
+# text of it (e.g. 22.120), the process_* functions add it as a number (CASE COST VALUE) for the math
+SIL_PRICE_FIELDS = ['F30', 'F136', 'F181']
+SIL_TEXT_FIELDS = ['F38']
+CASE_COST_VALUE = 'CASE COST VALUE'
+
+# the columns the SIL price fields are in (by the headers of the tables)
+SIL_CENTS_COLUMNS = sorted({header.split(',')[idx] for name, header in SIL_HEADERS.items()
+                            for idx, field in enumerate(SIL_VIEWS[name].split(',')) if field in SIL_PRICE_FIELDS})
+DATE_FORMAT = '%m/%d/%Y'
+
+# columns of each SIL table that are used after to_correct_format (the rest are not formatted)
+FORMAT_COLUMNS = {'new': ['UPC', 'DESCRIPTION', 'POS DEPARTMENT', 'GROUP', 'UNIT OF MEASURE CODE', 'SIZE',
+                          'VENDOR ITEM NUMBER', 'CASE PACK', 'CASE COST', 'PRICE'],
+                  'pcu': ['UPC', 'PRICE', 'CASE COST'],
+                  'tpr': ['UPC', 'PRICE', 'TPR PRICE', 'TPR START DATE', 'TPR END DATE'],
+                  'ad': ['UPC', 'PRICE', 'SALE PRICE MULTIPLE', 'SALE PRICE', 'SALE START DATE', 'SALE END DATE']}
+SIL_FORMATS = {'URM_NEW': 'new', 'URM_CHG': 'new', 'URM_PCU': 'pcu', 'URM_PCD': 'pcu', 'URM_TPN': 'tpr', 'URM_CPN': 'ad'}
+
+INSERT_INTO = re.compile(r'\s*INSERT INTO (\w+) VALUES')
+CREATE_VIEW = re.compile(r'\s*CREATE VIEW (\w+) AS SELECT')
+CREATE_TABLE = re.compile(r'\s*CREATE TABLE (\w+)')
+FIELD_TYPE = re.compile(r'\s*(\w+)\s+(\w+)\((\d+)(?:,(\d+))?\)')
+# one SQL literal inside a VALUES tuple: a quoted string ('' is an escaped quote) or a bare value,
+# followed by the ',' or ')' that ends it
+SQL_LITERAL = re.compile(r"\s*(?:'((?:[^']|'')*)'|([^,()']*))\s*([,)])")
+
+# tokenizes the complete tuples in buf starting at pos, returns the rows found, the position
+# after the last complete tuple and whether the statement's terminating ';' was reached
+def read_sql_tuples(buf, pos=0):
+    rows = []
+    while True:
+        # skip the separators between tuples
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ','):
+            pos += 1
+        if pos >= len(buf):
+            return rows, pos, False
+        if buf[pos] == ';':
+            return rows, pos + 1, True
+        if buf[pos] != '(':
+            raise ValueError('unexpected SQL text: ' + buf[pos:pos + 40])
+
+        row = []
+        end = pos + 1
+        while True:
+            literal = SQL_LITERAL.match(buf, end)
+            if literal is None:
+                return rows, pos, False  # tuple continues on the next line
+            quoted, bare, delimiter = literal.groups()
+            if quoted is not None:
+                row.append(quoted.replace("''", "'"))
+            else:
+                bare = bare.strip()
+                row.append(bare if bare and bare != 'NULL' else np.nan)
+            end = literal.end()
+            if delimiter == ')':
+                break
+        rows.append(row)
+        pos = end
+
+# decodes the SIL text values of a column into the native type of its field: a price field -> Int64 cents,
+# NUMBER(n) -> Int64, other NUMBER -> float, DATE (yyyyddd) -> datetime64, FLAG -> boolean. a value that is not
+# one of its type (e.g. 1.5 in a NUMBER(3)) is NA, as the other rows of the SIL file can still be done
+def decode_sil_column(values, field_type, is_price=False):
+    kind, size, scale = field_type
+    if not is_price and kind not in ('NUMBER', 'DATE', 'FLAG'):
+        return values
+    numbers = pd.to_numeric(values, errors='coerce')
+
+    if is_price:
+        return (numbers * 100).round().astype('Int64')
+    if kind == 'NUMBER' and scale == 0:
+        return numbers.where(numbers % 1 == 0).astype('Int64')
+    if kind == 'NUMBER':
+        return numbers.astype(float)
+    if kind == 'FLAG':
+        return numbers.where(numbers.isin([0, 1])).astype('boolean')
+
+    # yyyyddd -> first day of the year + (ddd - 1) days
+    dates = np.full(len(numbers), np.datetime64('NaT'), dtype='datetime64[D]')
+    valid = numbers.notna().to_numpy()
+    julian = numbers[valid].to_numpy(dtype=np.int64)
+    dates[valid] = (julian // 1000 - 1970).astype('datetime64[Y]') + (julian % 1000 - 1).astype('timedelta64[D]')
+    return pd.Series(dates.astype('datetime64[ns]'), index=values.index)
+
+# decodes the columns of a SIL table (every column if columns is None) by the types of the view's fields (but the
+# text fields)
+def decode_sil_table(data, fields, field_types, columns=None):
+    data = data.copy()
+    for idx, col in enumerate(data.columns[:len(fields)]):
+        if columns is not None and col not in columns:
+            continue
+        if fields[idx] in field_types and fields[idx] not in SIL_TEXT_FIELDS:
+            data[col] = decode_sil_column(data[col], field_types[fields[idx]], fields[idx] in SIL_PRICE_FIELDS)
+    return data
+
+# reads the SIL file line by line and yields (table, rows) for the rows of every INSERT INTO section, in lists of
+# at most chunk_rows rows (a section at once if None). the fields of the views and the field types of the
+# CREATE VIEW and CREATE TABLE statements are added to columns and field_types as they are read
+def iter_sil_rows(txt_file, columns, field_types, chunk_rows=None):
+    table = None  # table whose VALUES are being read
+    view = None  # view whose fields are being read
+    is_create_table = False  # CREATE TABLE fields are being read
+    buf = ''
+    rows = []
     with open(txt_file, 'r') as f:
         for line in f:
-            # necessary item info is after the INSERT INTO... statement in txt file
-            if 'INSERT INTO ' + sql_table_filter + ' VALUES' in line:
-                is_item_info = True
-                continue
-
-            # sql insert statement has ended so after ';' there is no item info
-            if ';' in line:
-                is_item_info = False
-            
-            # if item info, parse the line into a csv
-            if is_item_info:
-                pattern = r'\((.*?)\)'  # reg ex to get text inside parentheses
-                item_info = re.search(pattern, line)
-                pattern = r"'(.*?)'"  # reg ex to get text inside single quotes
-                # remove ',' from single quotes to preserve correct structure of csv file
-                item_info = re.sub(pattern, lambda x: x.group(0).replace(',', ''),
-                                    item_info.group(1))
-                if print_debug:
-                    print(item_info)
-                w.write(item_info + '\n')  # write line to csv file
-    w.close()
-
-    data = pd.read_csv(temp_csv, dtype=str)  # make the returnable df from the csv
+            if table is None:
+                # necessary item info is after the INSERT INTO... statement in txt file
+                insert = INSERT_INTO.match(line)
+                if insert is None:
+                    view, is_create_table = read_sil_definition(line, columns, field_types, view, is_create_table)
+                    continue
+                table = insert.group(1)
+                buf = line[insert.end():]
+            else:
+                buf += line
+
+            found, pos, is_done = read_sql_tuples(buf)
+            rows.extend(found)
+            buf = buf[pos:]
+            while chunk_rows and len(rows) >= chunk_rows:
+                yield table, rows[:chunk_rows]
+                rows = rows[chunk_rows:]
+            if is_done:
+                if rows or not chunk_rows:
+                    yield table, rows
+                table = None
+                buf = ''
+                rows = []
+
+    if table is not None and buf.strip():
+        raise ValueError('SIL file ended inside INSERT INTO ' + table)
+    if rows:
+        yield table, rows
+
+# reads a line of the SIL file outside the INSERT INTO sections: the fields of a CREATE VIEW (listed up to FROM)
+# or the field types of a CREATE TABLE (listed up to the ';'), returns the view and whether a CREATE TABLE is
+# being read after the line
+def read_sil_definition(line, columns, field_types, view, is_create_table):
+    if CREATE_TABLE.match(line):
+        return view, True
+    if is_create_table:
+        field = FIELD_TYPE.match(line)
+        if field:
+            name, kind, size, scale = field.groups()
+            field_types[name] = (kind, int(size), int(scale or 0))
+        return view, ';' not in line
+
+    create = CREATE_VIEW.match(line)
+    if create:
+        columns[create.group(1)] = []
+        return create.group(1), False
+    if view is not None:
+        if line.lstrip().startswith('FROM'):
+            return None, False
+        columns[view] += [field.strip() for field in line.split(',') if field.strip()]
+    return view, False
+
+# the df of rows of a SIL table, named by headers (or by the view's fields) and if typed decoded by the field types
+# (only the columns that are used after, for the URM_* tables)
+def sil_table(name, rows, columns, field_types, headers=SIL_HEADERS, typed=True):
+    df = pd.DataFrame(rows, dtype=object)
+    fields = columns.get(name) or SIL_VIEWS.get(name, '').split(',')
+    if name in headers:
+        header = headers[name].split(',')
+        if df.empty:
+            df = pd.DataFrame(columns=header, dtype=object)  # table not in this SIL file
+        df.columns = header[:df.shape[1]]
+    elif len(fields) == df.shape[1]:
+        df.columns = fields
+    if typed:
+        df = decode_sil_table(df, fields, field_types, FORMAT_COLUMNS.get(SIL_FORMATS.get(name)))
+    return df
+
+# reads the SIL file once and returns a dict of table name -> df for every INSERT INTO section,
+# sections of the same table are concatenated and named by headers (or by their view's fields),
+# if typed the columns are decoded by the CREATE TABLE field types (else they are all str)
+def parse_sil_txt(txt_file, headers=SIL_HEADERS, typed=True):
+    rows = defaultdict(list)
+    columns = {}
+    field_types = dict(SIL_FIELD_TYPES)
+    with instrument.stage('SIL: read') as read_stage:
+        for table, found in iter_sil_rows(txt_file, columns, field_types):
+            rows[table].extend(found)
+        read_stage['ROWS OUT'] = sum(len(table_rows) for table_rows in rows.values())
+
+    data = {}
+    for name in list(headers) + [name for name in rows if name not in headers]:
+        with instrument.stage('SIL: extract ' + name, len(rows[name])) as extract_stage:
+            df = sil_table(name, rows[name], columns, field_types, headers, typed)
+            extract_stage['ROWS OUT'] = len(df)
+        if print_debug:
+            print(name, len(df), 'rows')
+        data[name] = df
 
     return data
 
 # formats and processes the temporary price reductions (TPR)
 def process_tpr(tpr):
-    tpr = to_correct_format(tpr)  # format df
+    tpr = to_correct_format(tpr, FORMAT_COLUMNS['tpr'])  # format df
     tpr = tpr[['UPC', 'PRICE','TPR PRICE', 'TPR START DATE', 'TPR END DATE']]  # filter cols
 
-    # convert yyyyddd to mm/dd/yyyy
-    tpr['TPR START DATE'] = pd.to_datetime(tpr['TPR START DATE'], format='%Y%j')
-    tpr['TPR END DATE'] = pd.to_datetime(tpr['TPR END DATE'], format='%Y%j')
-    tpr['TPR START DATE'] = tpr['TPR START DATE'].dt.strftime('%m/%d/%Y')
-    tpr['TPR END DATE'] = tpr['TPR END DATE'].dt.strftime('%m/%d/%Y')
-
-    # remove rows with 'nan' values for price or tpr price
-    tpr = tpr[tpr['PRICE'].str.lower() != 'nan']
-    tpr = tpr[tpr['TPR PRICE'].str.lower() != 'nan']
+    # remove rows with missing values for price or tpr price
+    tpr = tpr.dropna(subset=['PRICE', 'TPR PRICE'])
 
     return tpr
 
-# formats and processes new items not yet in the store db
-def process_new(new, is_drop_duplicates = True):
+# formats and processes new items not yet in the store db (with the default rules if compiled is None)
+def process_new(new, is_drop_duplicates = True, compiled=None):
+    new, is_first = format_new(new, compiled)
+    if is_drop_duplicates:  # remove duplicates (keep first occurance of item no)
+        new = first_of_items(new, is_first)
+    return new
+
+# the processed new items that are the first row of their item no
+def first_of_items(new, is_first):
+    return new[is_first[new.index]]
+
+# formats and processes every new item, also returns which rows are the first of their item no (primary UPC).
+# the processing is row by row, so dropping the duplicates after it is the same as before it.
+# seen has the item nos of the chunks of the table done before (and gets this chunk's) if it is read in chunks
+def format_new(new, compiled=None, seen=None):
+    compiled = compiled or rules.DEFAULT_COMPILED
     # replace all non-alphanumeric ch (except space and .) from DESCRIPTION with a space
     new['DESCRIPTION'] = new['DESCRIPTION'].replace(r'[^0-9a-zA-Z\s.]', ' ', regex=True)
 
-    new = to_correct_format(new)  # format df
+    new = to_correct_format(new, FORMAT_COLUMNS['new'])  # format df
+
+    is_first = ~new.duplicated(subset='VENDOR ITEM NUMBER', keep='first')  # duplicates based on ITEM NO, before it is cut
+    if seen is not None:
+        is_first &= ~new['VENDOR ITEM NUMBER'].isin(seen)
+        seen.update(new.loc[is_first, 'VENDOR ITEM NUMBER'])
 
-    if is_drop_duplicates:  # remove duplicates (keep first occurance of item no)
-        new = new.drop_duplicates(subset='VENDOR ITEM NUMBER', keep='first')  # remove duplicates based on ITEM NO, keep first row (primary UPC)
-
-
-    # set EBT and Tax flags based on the department numbers
-    # 1: GROCERY (EBT, NO TAX)
-    # 3: GROCERY (NO EBT, TAX)
-    # 4: NA BEVERAGES (EBT, TAX)
-    # 10: HOT DELI (NO EBT, TAX)
-    new.loc[new['GROUP'] == '317', 'POS DEPARTMENT'] = '3'  # puts feminine products into taxable
-    new['FOOD STAMP'] = 'False'
-    new['TAX FLAG 1'] = '0'
-    new.loc[new['POS DEPARTMENT'] == '1', 'FOOD STAMP'] = 'True'
-    new.loc[new['POS DEPARTMENT'] == '1', 'TAX FLAG 1'] = '0'
-    new.loc[new['POS DEPARTMENT'] == '4', 'FOOD STAMP'] = 'True'
-    new.loc[new['POS DEPARTMENT'] == '4', 'TAX FLAG 1'] = '1'
-    new.loc[new['POS DEPARTMENT'] == '3', 'FOOD STAMP'] = 'False'
-    new.loc[new['POS DEPARTMENT'] == '3', 'TAX FLAG 1'] = '1'
-    new.loc[new['POS DEPARTMENT'] == '10', 'FOOD STAMP'] = 'False'
-    new.loc[new['POS DEPARTMENT'] == '10', 'TAX FLAG 1'] = '1'
-    
-    new['VENDOR ITEM NUMBER'] = new['VENDOR ITEM NUMBER'].apply(lambda x: x[:-2])  # remove last two ch of ITEM NO
+
+    # department overrides by group, then the EBT and Tax flags by department (rule sets in Rules.py),
+    # departments without flag rules are no EBT, no tax
+    new['POS DEPARTMENT'] = rules.apply_rules(compiled['GROUP DEPARTMENTS'], new['GROUP'], new['POS DEPARTMENT']).astype('Int64')
+    new['FOOD STAMP'] = rules.apply_rules(compiled['DEPARTMENT FOOD STAMP'], new['POS DEPARTMENT'], 'False')
+    new['TAX FLAG 1'] = rules.apply_rules(compiled['DEPARTMENT TAX FLAG 1'], new['POS DEPARTMENT'], '0')
+
+    new['VENDOR ITEM NUMBER'] = new['VENDOR ITEM NUMBER'].str[:-2]  # remove last two ch of ITEM NO
 
     new['POS DESCRIPTION'] = new['DESCRIPTION'].str[:19]  # make SHORT DESCRIPTION the first 19 ch of LONG DESCRIPTION
 
-    new.loc[new['UNIT OF MEASURE CODE'] == '48', 'UNIT OF MEASURE CODE'] = 'OZ'
-    new.loc[new['UNIT OF MEASURE CODE'] == '32', 'UNIT OF MEASURE CODE'] = 'SQFT'
-    new.loc[new['UNIT OF MEASURE CODE'] == '1', 'UNIT OF MEASURE CODE'] = 'EA'
-    new.loc[new['UNIT OF MEASURE CODE'] == '86', 'UNIT OF MEASURE CODE'] = 'G'
-    new.loc[new['UNIT OF MEASURE CODE'] == '41', 'UNIT OF MEASURE CODE'] = 'FLOZ'
-    new.loc[new['UNIT OF MEASURE CODE'] == '22', 'UNIT OF MEASURE CODE'] = 'LINFT'
+    uom = new['UNIT OF MEASURE CODE']
+    new['UNIT OF MEASURE CODE'] = rules.apply_rules(compiled['UOM CODES'], uom, uom)  # codes without a rule are kept
 
     # include item size and uom in LONG DESCRIPTION
-    new['DESCRIPTION'] = new['DESCRIPTION'] + ' ' + new['SIZE'].astype(float).astype(str) + new['UNIT OF MEASURE CODE']
+    new['DESCRIPTION'] = new['DESCRIPTION'] + ' ' + new['SIZE'].astype(str) + new['UNIT OF MEASURE CODE']
 
     # filter columns
     req_cols = ['UPC', 'DESCRIPTION', 'POS DESCRIPTION', 'POS DEPARTMENT',
@@ -104,164 +307,333 @@ def process_new(new, is_drop_duplicates = True):
     
     new = new[req_cols]
 
-    # remove rows with case cost or price 'nan' values
+    # remove rows with missing case cost or price values
     new = new[new['CASE COST'].str.lower() != 'nan']
-    new = new[new['PRICE'].str.lower() != 'nan']
+    new = new.dropna(subset=['PRICE'])
+    new[CASE_COST_VALUE] = case_cost(new)
 
-    return new
+    return new, is_first
 
 # formats and processes price change items already in the store db
 def process_pcu(pcu):
 
-    pcu = to_correct_format(pcu)  # format df
+    pcu = to_correct_format(pcu, FORMAT_COLUMNS['pcu'])  # format df
 
-    req_cols = ['UPC', 'VENDOR NO', 'PRICE', 'PRICE MULTIPLE', 'CASE COST']
     req_cols = ['UPC', 'PRICE', 'CASE COST']  # filter cols
     pcu = pcu[req_cols]
 
-    # remove rows with case cost or price 'nan' values
+    # remove rows with missing case cost or price values
     pcu = pcu[pcu['CASE COST'].str.lower() != 'nan']
-    pcu = pcu[pcu['PRICE'].str.lower() != 'nan']
+    pcu = pcu.dropna(subset=['PRICE'])
+    pcu[CASE_COST_VALUE] = case_cost(pcu)
 
     return pcu
 
 # formats and processes sale/ad items already in the store db
 def process_ad(ad):
-    ad = to_correct_format(ad)  # format df
+    ad = to_correct_format(ad, FORMAT_COLUMNS['ad'])  # format df
     ad = ad[['UPC', 'PRICE', 'SALE PRICE MULTIPLE', 'SALE PRICE', 'SALE START DATE', 'SALE END DATE']]  # filter cols
 
-    # convert yyyyddd to mm/dd/yyyy
-    ad['SALE START DATE'] = pd.to_datetime(ad['SALE START DATE'], format='%Y%j')
-    ad['SALE END DATE'] = pd.to_datetime(ad['SALE END DATE'], format='%Y%j')
-    ad['SALE START DATE'] = ad['SALE START DATE'].dt.strftime('%m/%d/%Y')
-    ad['SALE END DATE'] = ad['SALE END DATE'].dt.strftime('%m/%d/%Y')
-
-    # remove rows with 'nan' values for price or tpr price
-    ad = ad[ad['PRICE'].str.lower() != 'nan']
-    ad = ad[ad['SALE PRICE'].str.lower() != 'nan']
+    # remove rows with missing values for price or sale price
+    ad = ad.dropna(subset=['PRICE', 'SALE PRICE'])
 
     return ad
 
+# runs a process_* function on a SIL table as a stage of the run
+def format_table(process, data, name):
+    with instrument.stage(name + ': format', len(data)) as stage:
+        data = process(data)
+        stage['ROWS OUT'] = len(data)
+    return data
+
+# the inventory's rows sorted by UPC KEY once, for runs that look up the SIL rows of many chunks in it
+# without building the merge's hash table of st for every chunk
+class InventoryIndex:
+    def __init__(self, st):
+        self.st = st
+        keys = st['UPC KEY'].to_numpy()
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    # positions of every (row of keys, row of st) with the same key: in the order of keys, then of st (as merge)
+    def lookup(self, keys):
+        start = np.searchsorted(self.keys, keys, 'left')
+        counts = np.searchsorted(self.keys, keys, 'right') - start
+        rows = np.repeat(np.arange(len(keys)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return rows, self.order[np.repeat(start, counts) + offsets]
+
+    # whether each key is in the inventory
+    def contains(self, keys):
+        return np.searchsorted(self.keys, keys, 'right') > np.searchsorted(self.keys, keys, 'left')
+
+# inner merge of SIL rows with cols of the inventory (renamed by renames) on the int64 keys of their UPCs,
+# the keys are looked up in index if there is one
+def merge_on_upc(data, st, cols, renames=None, index=None):
+    keys = utils.upc_keys(data['UPC'])
+    if index is None:
+        st = st[['UPC KEY'] + cols].rename(columns=renames or {})
+        return data.assign(**{'UPC KEY': keys}).merge(st, on='UPC KEY').drop(columns='UPC KEY')
+    rows, st_rows = index.lookup(keys.to_numpy())
+    st = index.st.take(st_rows)[cols].rename(columns=renames or {})
+    return pd.concat([data.take(rows).reset_index(drop=True), st.reset_index(drop=True)], axis=1)
+
+# whether the UPC of each SIL row is in the inventory (looked up in index if there is one)
+def in_inventory(data, st, index=None):
+    keys = utils.upc_keys(data['UPC'])
+    if index is None:
+        return keys.isin(st['UPC KEY'])
+    return pd.Series(index.contains(keys.to_numpy()), index=data.index)
+
 # merges tprs from the wholesales file with the store db
-def get_tpr(tpr, st, dbPath, min_margin=0):
-    st['ORG'] = st['UPC']
-    st['UPC'] = st['UPC'].apply(utils.upcE_to_upcA)
-    st = st[['UPC', 'ORG', 'ITEM NO', 'LONG DESCRIPTION', 'PACK SIZE', 'CASE COST']]
-    tpr = process_tpr(tpr) 
-    tpr = tpr.merge(st, on='UPC')  # only keep rows whose UPC exists in st
+# (with is_processed tpr is already processed by process_tpr, index is the InventoryIndex of st if there is one).
+# the TPR MIN MARGINS rules replace min_margin for their departments
+def get_tpr(tpr, st, min_margin=0, is_processed=False, compiled=None, index=None):
+    compiled = compiled or rules.DEFAULT_COMPILED
+    if not is_processed:
+        tpr = format_table(process_tpr, tpr, 'TPR')
+    with instrument.stage('TPR: merge', len(tpr)) as stage:
+        cols = ['ORG', 'ITEM NO', 'LONG DESCRIPTION', 'PACK SIZE', 'CASE COST', rules.ST_KEY_COLUMNS['TPR MIN MARGINS']]
+        tpr = merge_on_upc(tpr, st, cols, index=index)  # only keep rows whose UPC exists in st
+        stage['ROWS OUT'] = len(tpr)
     tpr['UPC'] = tpr['ORG']
-    tpr['SAVE'] = (pd.to_numeric(tpr['PRICE']) - pd.to_numeric(tpr['TPR PRICE'])).round(2)
+    tpr['SAVE'] = (tpr['PRICE'] - tpr['TPR PRICE']) / 100
     tpr['SAVE'] = tpr['SAVE'].apply(lambda x: f'{x:.2f}')
-    tpr['UNIT COST'] = (pd.to_numeric(tpr['CASE COST']) / pd.to_numeric(tpr['PACK SIZE'])).round(2)
-    tpr['MARGIN'] = ((1 - (pd.to_numeric(tpr['UNIT COST']) / pd.to_numeric(tpr['TPR PRICE']))) * 100).round(2)
-    if (min_margin > 0):  # only keep TPR whose margins are > min_margin
-        tpr = tpr[tpr['MARGIN'] > min_margin]
-    to_sql_table(dbPath, tpr, "ALL TPR")
+    tpr['UNIT COST'] = (tpr['CASE COST'] / tpr['PACK SIZE']).round(2)
+    tpr['MARGIN'] = ((1 - (tpr['UNIT COST'] / (tpr['TPR PRICE'] / 100))) * 100).round(2)
+    min_margins = rules.apply_rules(compiled['TPR MIN MARGINS'], tpr.pop(rules.ST_KEY_COLUMNS['TPR MIN MARGINS']), min_margin).astype(float)
+    if (min_margin > 0) or len(compiled['TPR MIN MARGINS'][0]):  # only keep TPR whose margins are > their min margin (if > 0)
+        with instrument.stage('TPR: min margin filter', len(tpr)) as stage:
+            tpr = tpr[(min_margins <= 0) | (tpr['MARGIN'] > min_margins)]
+            stage['ROWS OUT'] = len(tpr)
     return tpr
 
 # merges sales/ads from the wholesales file with the store db
-def get_ad(ad, st, dbPath):
-    st['ORG'] = st['UPC']
-    st['UPC'] = st['UPC'].apply(utils.upcE_to_upcA)
-    st = st[['UPC', 'ORG', 'ITEM NO', 'LONG DESCRIPTION', 'CASE COST', 'PACK SIZE']]
-    ad = process_ad(ad) 
-    ad = ad.merge(st, on='UPC')  # only keep rows whose UPC exists in st
+# (with is_processed ad is already processed by process_ad, index is the InventoryIndex of st if there is one)
+def get_ad(ad, st, is_processed=False, index=None):
+    if not is_processed:
+        ad = format_table(process_ad, ad, 'SALE')
+    with instrument.stage('SALE: merge', len(ad)) as stage:
+        cols = ['ORG', 'ITEM NO', 'LONG DESCRIPTION', 'CASE COST', 'PACK SIZE']
+        ad = merge_on_upc(ad, st, cols, index=index)  # only keep rows whose UPC exists in st
+        stage['ROWS OUT'] = len(ad)
     ad['UPC'] = ad['ORG']
 
-    ad['SAVE'] = (pd.to_numeric(ad['SALE PRICE MULTIPLE']) * pd.to_numeric(ad['PRICE']) - pd.to_numeric(ad['SALE PRICE'])).round(2)
+    ad['SAVE'] = (ad['SALE PRICE MULTIPLE'] * ad['PRICE'] - ad['SALE PRICE']) / 100
     ad['SAVE'] = ad['SAVE'].apply(lambda x: f'{x:.2f}')
 
-    ad['MARGIN'] = ((1 - ((pd.to_numeric(ad['CASE COST']) / pd.to_numeric(ad['PACK SIZE']) * pd.to_numeric(ad['SALE PRICE MULTIPLE'])) / pd.to_numeric(ad['SALE PRICE']))) * 100).round(2)
+    ad['MARGIN'] = ((1 - ((ad['CASE COST'] / ad['PACK SIZE'] * ad['SALE PRICE MULTIPLE']) / (ad['SALE PRICE'] / 100))) * 100).round(2)
     ad['MARGIN'] = ad['MARGIN'].apply(lambda x: f'{x:.2f}')
 
-    to_sql_table(dbPath, ad, "ALL SALE")
     return ad
 
-# writes a ZPL file for the Zebra tag printer for the TPR items
-def write_tpr_tags(tpr):
-    with open('../files/uploadables/tpr_tags.zpl', 'w') as file:
-        for idx, row in tpr.iterrows():
-            formatted_string = TPR_ZPL.format(LONG_DESCRIPTION=row['LONG DESCRIPTION'],
-                                              UPC=row['UPC'],
-                                              ITEM_NO=row['ITEM NO'],
-                                              TPR_PRICE=row['TPR PRICE'],
-                                              TPR_START_DATE=row['TPR START DATE'],
-                                              TPR_END_DATE=row['TPR END DATE'],
-                                              SAVE=row['SAVE'],
-                                              PRICE=row['PRICE'])
-            file.write(formatted_string + '\n')
-
-# writes a ZPL file for the Zebra tag printer for the new and price change items
-def write_price_tags(data):
-    with open('../files/uploadables/price_tags.zpl', 'w') as file:
-        for idx, row in data.iterrows():
-            formatted_string = PRICE_ZPL.format(LONG_DESCRIPTION=row['DESCRIPTION'],
-                                              UPC=row['UPC'],
-                                              ITEM_NO=row['VENDOR ITEM NUMBER'],
-                                              PRICE=row['PRICE'])
-            file.write(formatted_string + '\n')
+# ZPL template fields -> columns of the TPR df and the new/price change df
+TPR_TAG_FIELDS = {'LONG_DESCRIPTION': 'LONG DESCRIPTION', 'UPC': 'UPC', 'ITEM_NO': 'ITEM NO', 'TPR_PRICE': 'TPR PRICE',
+                  'TPR_START_DATE': 'TPR START DATE', 'TPR_END_DATE': 'TPR END DATE', 'SAVE': 'SAVE', 'PRICE': 'PRICE'}
+PRICE_TAG_FIELDS = {'LONG_DESCRIPTION': 'DESCRIPTION', 'UPC': 'UPC', 'ITEM_NO': 'VENDOR ITEM NUMBER', 'PRICE': 'PRICE'}
+# uploadable files of a run in an output dir (arguments of parse -> file name)
+UPLOADABLES = {'uploadable_new_items': 'uploadable_new.csv', 'uploadable_pcu_items': 'uploadable_pcu.csv',
+               'uploadable_tprs': 'uploadable_tprs.csv', 'uploadable_ads': 'uploadable_ads.csv'}
+# ZPL files written next to the uploadables
+PRICE_TAGS_FILE = 'price_tags.zpl'
+TPR_TAGS_FILE = 'tpr_tags.zpl'
+
+# writes a ZPL file for the Zebra tag printer for the TPR items, with stored_format the graphic and
+# label format are sent once at the start of the file and each label only has its fields.
+# labels are also streamed to the printers (host or host:port)
+def write_tpr_tags(tpr, zpl_file, stored_format=False, printers=None):
+    template, header = tpr_tag_format(stored_format)
+    write_tags(zpl_file, tpr, template, TPR_TAG_FIELDS, header, printers)
+
+# writes a ZPL file for the Zebra tag printer for the new and price change items, with stored_format the
+# graphic and label format are sent once at the start of the file and each label only has its fields.
+# labels are also streamed to the printers (host or host:port)
+def write_price_tags(data, zpl_file, stored_format=False, printers=None):
+    template, header = price_tag_format(stored_format)
+    write_tags(zpl_file, data, template, PRICE_TAG_FIELDS, header, printers)
+
+# the rows of the dfs in one df (empty ones are left out of the concat, pandas is deprecating their part in the
+# dtypes of the result)
+def concat_rows(frames):
+    rows = [data for data in frames if len(data)]
+    return pd.concat(rows) if rows else frames[0]
+
+# the new items and the price changes whose price changed
+def price_tag_rows(new, pcu):
+    return concat_rows([new, pcu[pcu['PRICE DIF'] != 0.0]])
+
+# the (label template, header) of the TPR tags and of the price tags
+def tpr_tag_format(stored_format=False):
+    return (TPR_ZPL_STORED_COMPILED, TPR_ZPL_HEADER) if stored_format else (TPR_ZPL_COMPILED, '')
+
+def price_tag_format(stored_format=False):
+    return (PRICE_ZPL_STORED_COMPILED, PRICE_ZPL_HEADER) if stored_format else (PRICE_ZPL_COMPILED, '')
+
+TAG_BLOCK_ROWS = 1000  # labels rendered, written and sent to the printers at a time
+
+# renders a label for every row of data, TAG_BLOCK_ROWS rows at a time, so that the printers get the first
+# labels while the rest are rendered
+def write_tags(zpl_file, data, template, tag_fields, header, printers):
+    with TagWriter(zpl_file, tag_fields, template, header, printers) as writer:
+        for start in range(0, max(len(data), 1), TAG_BLOCK_ROWS):
+            writer.write(data.iloc[start:start + TAG_BLOCK_ROWS])
+
+# writes blocks of rows to a ZPL file (and the printers) as they come, the header once at the start
+class TagWriter:
+    def __init__(self, zpl_file, tag_fields, template, header, printers):
+        self.zpl_file = zpl_file
+        self.tag_fields = tag_fields
+        self.template = template
+        self.header = header
+        self.printers = printers
+
+    def __enter__(self):
+        self.stack = ExitStack()
+        self.file = self.stack.enter_context(open(self.zpl_file, 'w'))
+        self.file.write(self.header)
+        self.spooler = self.stack.enter_context(TagSpooler(self.zpl_file, self.printers, self.header))
+        return self
+
+    def __exit__(self, *exc):
+        self.stack.close()
+
+    def write(self, data):
+        fields = {field: data[col] for field, col in self.tag_fields.items()}
+        with instrument.stage('ZPL: ' + os.path.basename(self.zpl_file), len(data)) as stage:
+            labels = render_labels(self.template, fields, len(data))
+            self.file.write(''.join(label + '\n' for label in labels))
+            stage['ROWS OUT'] = len(labels)
+        self.spooler.send(labels)
+
+# how the tags are sent to the printers: a printer that can't be reached is tried retries + 1 times, each
+# connect waiting up to timeout seconds, before its labels are given up (about 16s for a tag file)
+SPOOLER_SETTINGS = {'retries': 2, 'retry_delay': 0.5, 'timeout': 5.0}
+
+# sends the labels of a ZPL file to its printers (if any). printing is optional, so a printer that can't be
+# reached doesn't fail the run: its error is recorded in the run report and no more labels are sent (they
+# are still in the ZPL file)
+class TagSpooler:
+    def __init__(self, zpl_file, printers, header):
+        self.name = 'ZPL: ' + os.path.basename(zpl_file)
+        self.spooler = ZplSpooler(printers, header=header, **SPOOLER_SETTINGS) if printers else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, labels):
+        if self.spooler is None:
+            return
+        try:
+            for label in labels:
+                self.spooler.send(label)
+        except OSError:
+            self.close()  # the spooler raises the printer's error again as it stops
+
+    def close(self):
+        spooler, self.spooler = self.spooler, None
+        if spooler is None:
+            return
+        try:
+            spooler.close()
+        except OSError as e:
+            if print_debug:
+                print(self.name, 'not printed:', e)
+            instrument.error(self.name, f'not printed: {e}')
     
-# merges new items from the wholesales file with the store db
-def get_new(new, st, dbPath, new_table_name, pcu_table_name, do_price_filter=True):
-    st['ORG'] = st['UPC']
-    st['UPC'] = st['UPC'].apply(utils.upcE_to_upcA)
-    new = process_new(new)
-
-    new_ = new[~new['UPC'].isin(st['UPC'])]  # actually new items that don't exist in st
+# the inventory's price and case cost next to those of the SIL rows
+OLD_PRICE_RENAMES = {'PRICE': 'OLD PRICE', 'CASE COST': 'OLD CASE COST'}
 
-    st = st.rename(columns={'PRICE': 'OLD PRICE', 'CASE COST': 'OLD CASE COST'})
-    st = st[['UPC', 'ORG', 'DEPT NO', 'FOOD STAMPS', 'TAX 1 NO', 'OLD PRICE', 'OLD CASE COST']]
-    pcu_with_new_format = new.merge(st, on='UPC')
+# merges new items from the wholesales file with the store db
+# (with is_processed new is already processed by process_new, index is the InventoryIndex of st if there is one)
+def get_new(new, st, dbPath, new_table_name, pcu_table_name, do_price_filter=True, is_processed=False, index=None):
+    if not is_processed:
+        new = format_table(process_new, new, new_table_name)
+
+    with instrument.stage(new_table_name + ': not in inventory filter', len(new)) as stage:
+        new_ = new[~in_inventory(new, st, index)].drop(columns=CASE_COST_VALUE)  # actually new items that don't exist in st
+        stage['ROWS OUT'] = len(new_)
+
+    with instrument.stage(pcu_table_name + ': merge', len(new)) as stage:
+        cols = ['ORG', 'DEPT NO', 'FOOD STAMPS', 'TAX 1 NO', 'PRICE', 'CASE COST']
+        pcu_with_new_format = merge_on_upc(new, st, cols, OLD_PRICE_RENAMES, index)
+        stage['ROWS OUT'] = len(pcu_with_new_format)
     pcu_with_new_format['UPC'] = pcu_with_new_format['ORG']
 
     req_cols = ['UPC', 'DESCRIPTION', 'POS DESCRIPTION', 'DEPT NO',
                  'FOOD STAMPS', 'TAX 1 NO', 'VENDOR ITEM NUMBER', 'CASE PACK', 'CASE COST', 'PRICE', 'OLD PRICE', 'OLD CASE COST']
+    case_costs = pcu_with_new_format[CASE_COST_VALUE]
     pcu_with_new_format = pcu_with_new_format[req_cols]  # filter cols
 
-    pcu_with_new_format['PRICE DIF'] = pd.to_numeric(pcu_with_new_format['PRICE']) - pd.to_numeric(pcu_with_new_format['OLD PRICE'])
-    pcu_with_new_format['CASE COST DIF'] = pd.to_numeric(pcu_with_new_format['CASE COST']) - pd.to_numeric(pcu_with_new_format['OLD CASE COST'])
+    pcu_with_new_format['PRICE DIF'] = price_dif(pcu_with_new_format)
+    pcu_with_new_format['CASE COST DIF'] = case_costs - pcu_with_new_format['OLD CASE COST']
 
-    if do_price_filter:
-        mask = (pcu_with_new_format['PRICE DIF'] != 0) | (pcu_with_new_format['CASE COST DIF'] != 0)  # only keep rows where the price or the case cost has changed
-        pcu_with_new_format = pcu_with_new_format[mask]
+    if do_price_filter:  # only keep rows where the price or the case cost has changed
+        pcu_with_new_format = price_change_filter(pcu_with_new_format, pcu_table_name)
 
-    pcu_with_new_format['UNIT COST'] = (pd.to_numeric(pcu_with_new_format['CASE COST']) / pd.to_numeric(pcu_with_new_format['CASE PACK'])).round(2)
-    pcu_with_new_format['MARGIN'] = ((1 - (pd.to_numeric(pcu_with_new_format['UNIT COST']) / pd.to_numeric(pcu_with_new_format['PRICE']))) * 100).round(2)
+    pcu_with_new_format['UNIT COST'] = (case_costs[pcu_with_new_format.index] / pcu_with_new_format['CASE PACK']).round(2)
+    pcu_with_new_format['MARGIN'] = ((1 - (pcu_with_new_format['UNIT COST'] / (pcu_with_new_format['PRICE'] / 100))) * 100).round(2)
 
     renames = {'DEPT NO': 'POS DEPARTMENT', 'FOOD STAMPS': 'FOOD STAMP', 'TAX 1 NO': 'TAX FLAG 1'}
     pcu_with_new_format = pcu_with_new_format.rename(columns=renames)
 
     return (new_, pcu_with_new_format)
 
+# the SIL's case cost (text) of the rows as a number, done once by the process_* functions (CASE COST VALUE)
+def case_cost(data):
+    return pd.to_numeric(data['CASE COST'], errors='coerce')
+
+# the change of price in dollars, as the difference of the dollar prices (e.g. 10.39 - 10.69 = -0.29999999999999893)
+def price_dif(data):
+    return data['PRICE'].astype('Float64') / 100 - data['OLD PRICE'].astype('Float64') / 100
+
+# only keeps the rows whose price or case cost changed (only those whose case cost changed with only_cost_change)
+def price_change_filter(data, name, only_cost_change=False):
+    with instrument.stage(name + ': price diff filter', len(data)) as stage:
+        mask = data['CASE COST DIF'] != 0
+        if not only_cost_change:
+            mask |= data['PRICE DIF'] != 0
+        data = data[mask]
+        stage['ROWS OUT'] = len(data)
+    return data
+
+# the UPC keys of the new items (see utils.upc_keys), that the price changes' UPCs are looked up in
+def new_item_keys(upcs):
+    keys = pd.Index(np.unique(utils.upc_keys(upcs).to_numpy()))
+    keys.is_unique  # builds the index's lookup table now
+    return keys
+
 # merges price change items from the wholesales file with the store db
-def get_pcu(pcu, st, new, dbPath, table_name, do_price_filter=True, only_do_if_cost_change=False):
-    new = process_new(new, is_drop_duplicates=False)
-    st['ORG'] = st['UPC']
-    st['UPC'] = st['UPC'].apply(utils.upcE_to_upcA)
-    st = st.rename(columns={'PRICE': 'OLD PRICE', 'CASE COST': 'OLD CASE COST'})
-    st = st[['UPC', 'ORG', 'PLU DESCRIPTION', 'LONG DESCRIPTION', 'DEPT NO', 'ITEM NO', 'FOOD STAMPS', 'TAX 1 NO', 'PACK SIZE', 'OLD PRICE', 'OLD CASE COST']]
-    pcu = process_pcu(pcu)
-    pcu = pcu.merge(st, on='UPC')  # only keep rows whose UPC is in st
-    pcu = pcu[~pcu['UPC'].isin(new['UPC'])]  # only keep rows whose UPC is not already in 'new' format
+# (new_keys are the new_item_keys of the processed new items, if given new is not processed again,
+# with is_processed pcu is already processed by process_pcu, index is the InventoryIndex of st if there is one)
+def get_pcu(pcu, st, new, dbPath, table_name, do_price_filter=True, only_do_if_cost_change=False, new_keys=None, is_processed=False,
+            index=None):
+    if new_keys is None:
+        new_keys = new_item_keys(format_table(lambda new: process_new(new, is_drop_duplicates=False), new, table_name + ' NEW')['UPC'])
+    if not is_processed:
+        pcu = format_table(process_pcu, pcu, table_name)
+    with instrument.stage(table_name + ': merge', len(pcu)) as stage:
+        cols = ['ORG', 'PLU DESCRIPTION', 'LONG DESCRIPTION', 'DEPT NO', 'ITEM NO', 'FOOD STAMPS', 'TAX 1 NO', 'PACK SIZE', 'PRICE', 'CASE COST']
+        pcu = pcu[new_keys.get_indexer(utils.upc_keys(pcu['UPC'])) < 0]  # only keep rows whose UPC is not already in 'new' format
+        pcu = merge_on_upc(pcu, st, cols, OLD_PRICE_RENAMES, index)  # only keep rows whose UPC is in st
+        stage['ROWS OUT'] = len(pcu)
     pcu['UPC'] = pcu['ORG']
 
     req_cols = ['UPC', 'LONG DESCRIPTION', 'PLU DESCRIPTION', 'DEPT NO',
                  'FOOD STAMPS', 'TAX 1 NO', 'ITEM NO', 'PACK SIZE', 'CASE COST', 'PRICE', 'OLD PRICE', 'OLD CASE COST']
+    case_costs = pcu[CASE_COST_VALUE]
     pcu = pcu[req_cols]  # filter cols
 
-    pcu['PRICE DIF'] = pd.to_numeric(pcu['PRICE']) - pd.to_numeric(pcu['OLD PRICE'])
-    pcu['CASE COST DIF'] = pd.to_numeric(pcu['CASE COST']) - pd.to_numeric(pcu['OLD CASE COST'])
-
-    if do_price_filter:
-        mask = (pcu['PRICE DIF'] != 0) | (pcu['CASE COST DIF'] != 0)
-        pcu = pcu[mask]
+    pcu['PRICE DIF'] = price_dif(pcu)
+    pcu['CASE COST DIF'] = case_costs - pcu['OLD CASE COST']
 
-    if only_do_if_cost_change:
-        mask = pcu['CASE COST DIF'] != 0
-        pcu = pcu[mask]
+    if do_price_filter or only_do_if_cost_change:
+        pcu = price_change_filter(pcu, table_name, only_do_if_cost_change)
 
-    pcu['UNIT COST'] = (pd.to_numeric(pcu['CASE COST']) / pd.to_numeric(pcu['PACK SIZE'])).round(2)
-    pcu['MARGIN'] = ((1 - (pd.to_numeric(pcu['UNIT COST']) / pd.to_numeric(pcu['PRICE']))) * 100).round(2)
+    pcu['UNIT COST'] = (case_costs[pcu.index] / pcu['PACK SIZE']).round(2)
+    pcu['MARGIN'] = ((1 - (pcu['UNIT COST'] / (pcu['PRICE'] / 100))) * 100).round(2)
 
     renames = {'LONG DESCRIPTION': 'DESCRIPTION', 'PLU DESCRIPTION': 'POS DESCRIPTION', 'DEPT NO': 'POS DEPARTMENT',
                'FOOD STAMPS': 'FOOD STAMP', 'TAX 1 NO': 'TAX FLAG 1', 'ITEM NO': 'VENDOR ITEM NUMBER',
@@ -270,74 +642,351 @@ def get_pcu(pcu, st, new, dbPath, table_name, do_price_filter=True, only_do_if_c
 
     return pcu
 
-def to_correct_format(data):
+def to_correct_format(data, columns=None):
+    if columns is not None:
+        data = data[columns]  # only format the columns that are used after
+    text_cols = [col for col in data.columns if data[col].dtype == object]  # typed columns are already clean
     data = data.copy()
-    data = data.applymap(lambda x: str(x).strip())  # strip leading and trailing spaces
-    data = data.replace(r'[^0-9a-zA-Z\s.]', '', regex=True)  # remove all non-alphanumeric ch (except space and .)
-    data = data.applymap(lambda x: str(x).lstrip('0'))  # remove leading zeroes
-    data['UPC'] = data['UPC'].apply(utils.add_check_digit)  # make UPC full 12 digits with zeroes and check digit
+    data[text_cols] = utils.clean_columns(data[text_cols], strip_zeros=True)  # strip spaces, non-alphanumeric ch and leading zeroes
+    data['UPC'] = utils.add_check_digit_batch(data['UPC'])  # make UPC full 12 digits with zeroes and check digit
     return data
 
-def to_sql_table(dbPath, data, tableName):
-    conn = sqlite3.connect(dbPath)
-    data.to_sql(tableName, con=conn, if_exists='replace', index=False)
-    conn.commit()
-    conn.close()
+# the columns the inventory price (cents) is in
+ST_CENTS_COLUMNS = [OLD_PRICE_RENAMES['PRICE']]
+
+# converts the typed columns back to the text the uploadables, db and tags use: dates -> mm/dd/yyyy and cents ->
+# dollars as the SIL has them for its prices (2 decimals without a leading zero, e.g. .49) and as a number for the
+# inventory's (e.g. 10.5)
+def to_output_format(data):
+    data = data.copy()
+    for col in data.columns:
+        if col in SIL_CENTS_COLUMNS:
+            dollars = data[col].astype('Float64') / 100
+            data[col] = dollars.map(lambda x: f'{x:.2f}'.lstrip('0'), na_action='ignore').astype(object)
+        elif col in ST_CENTS_COLUMNS:
+            dollars = data[col].astype('Float64') / 100
+            data[col] = dollars.map(str, na_action='ignore').astype(object)
+        elif pd.api.types.is_datetime64_any_dtype(data[col]):
+            data[col] = data[col].dt.strftime(DATE_FORMAT)
+    return data
+
+RUNS_TABLE = 'RUNS'
+
+# opens the db for a run: one connection in WAL mode whose transactions are begun and committed explicitly
+def open_db(dbPath):
+    conn = sqlite3.connect(dbPath, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS "{RUNS_TABLE}" ("RUN ID" INTEGER PRIMARY KEY AUTOINCREMENT,
+                    "STARTED" TEXT, "FINISHED" TEXT, "INVENTORY FILE" TEXT, "SIL FILE" TEXT)''')
+    return conn
+
+# begins the run's transaction and returns its run id, every table written in the run is tagged with it
+def start_run(conn, stFile, silFile, started=None):
+    started = started or datetime.now()
+    conn.execute('BEGIN')
+    cur = conn.execute(f'INSERT INTO "{RUNS_TABLE}" ("STARTED", "INVENTORY FILE", "SIL FILE") VALUES (?, ?, ?)',
+                       (started.isoformat(timespec='seconds'), os.path.abspath(stFile), os.path.abspath(silFile)))
+    return cur.lastrowid
+
+# marks the run as finished and commits everything written in it
+def finish_run(conn, run_id):
+    conn.execute(f'UPDATE "{RUNS_TABLE}" SET "FINISHED" = ? WHERE "RUN ID" = ?',
+                 (datetime.now().isoformat(timespec='seconds'), run_id))
+    conn.execute('COMMIT')
+
+# sql column type for a df column
+def sql_type(values):
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(values):
+        return 'REAL'
+    return 'TEXT'
+
+# appends the rows of data to the table tagged with the run id, the table (with indexes on RUN ID and UPC)
+# is created the first time and gets any columns it is missing added
+def to_sql_table(conn, data, tableName, run_id):
+    existing = [row[1] for row in conn.execute(f'PRAGMA table_info("{tableName}")')]
+    if not existing:
+        cols = ', '.join(f'"{col}" {sql_type(data[col])}' for col in data.columns)
+        conn.execute(f'CREATE TABLE "{tableName}" ("RUN ID" INTEGER, {cols})')
+    else:  # tables from older runs may be missing columns
+        for col in ['RUN ID'] + [col for col in data.columns if col not in existing]:
+            if col not in existing:
+                conn.execute(f'ALTER TABLE "{tableName}" ADD COLUMN "{col}" {sql_type(data[col]) if col in data else "INTEGER"}')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "{tableName} RUN ID" ON "{tableName}" ("RUN ID")')
+    if 'UPC' in data.columns:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{tableName} UPC" ON "{tableName}" ("UPC", "RUN ID")')
+
+    cols = ', '.join(f'"{col}"' for col in ['RUN ID'] + list(data.columns))
+    params = ', '.join('?' * (len(data.columns) + 1))
+    values = data.astype(object).where(data.notna(), None)
+    conn.executemany(f'INSERT INTO "{tableName}" ({cols}) VALUES ({params})',
+                     ((run_id,) + row for row in values.itertuples(index=False, name=None)))
     if print_debug:
         print("done adding ",tableName, "to db")
 
-def parse(stFile, silFile, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads, dbPath, only_do_if_cost_change, min_tpr_margin):
-    st = utils.process_storetender_file(stFile, dbPath)
-    
-    new_header = 'UPC,POS DESCRIPTION,POS DEPARTMENT,GROUP,SUB GROUP,REPORT CODE,CASE PACK,UNIT OF MEASURE CODE,SIZE,VENDOR NUMBER,DESCRIPTION,PRICE MULTIPLE,PRICE,MIX MATCH CODE,PRICE METHOD,CASE COST,FOOD STAMP,TAX FLAG 1,SCALE FLAG,PRICE REQUIRED FLAG,VISUAL VERIFY FLAG,QUANTITY REQUIRED FLAG,QUANTITY PROHIBIT FLAG,WIC FLAG,VENDOR ITEM NUMBER,ITEMIZER 6,ITEMIZER 7'
-    new_unprocessed = parse_sil_txt(silFile, new_header, 'URM_NEW', dbPath)
-    new, pcu_with_new_format = get_new(new_unprocessed.copy(), st.copy(), dbPath, 'NEW', 'PCU (NEW FORMAT)')
-    new_2_unprocessed = parse_sil_txt(silFile, new_header, 'URM_CHG', dbPath)
-    new_2, pcu_with_new_format_2 = get_new(new_2_unprocessed.copy(), st.copy(), dbPath, 'NEW_CHG', 'PCU (NEW FORMAT)_CHG')
-    new = pd.concat([new, new_2], ignore_index=True)
-    new.insert(10, "ITEM VENDOR ID", "1")
-    numerical_cols = ['UPC', 'POS DEPARTMENT', 'TAX FLAG 1', 'VENDOR ITEM NUMBER', 'CASE PACK', 'CASE COST', 'PRICE']
-    new = new.replace('nan', pd.NA)
-    new = new.dropna(subset=numerical_cols)
-
-    new.to_csv(uploadable_new_items, index=False, header=False)
-    to_sql_table(dbPath, new, "FINAL NEW")
-
-    pcu_header = 'UPC,VENDOR NO,PRICE,PRICE MULTIPLE,CASE COST'
-    pcu_unprocessed = parse_sil_txt(silFile, pcu_header, 'URM_PCU', dbPath)
-    new_ = pd.concat([new_unprocessed, new_2_unprocessed], ignore_index=True)
-    pcu = get_pcu(pcu_unprocessed.copy(), st.copy(), new_.copy(), dbPath, 'PCU',only_do_if_cost_change=only_do_if_cost_change)
-    pcu_2_unprocessed = parse_sil_txt(silFile, pcu_header, 'URM_PCD', dbPath)
-    pcu_2 = get_pcu(pcu_2_unprocessed.copy(), st.copy(), new_.copy(), dbPath, 'PCD', only_do_if_cost_change=only_do_if_cost_change)
-    pcu = pd.concat([pcu_with_new_format, pcu_with_new_format_2, pcu, pcu_2], ignore_index=True)
-    pcu.insert(10, "ITEM VENDOR ID", "1")
-    numerical_cols = ['UPC', 'POS DEPARTMENT', 'TAX FLAG 1', 'CASE PACK', 'CASE COST', 'PRICE']
-    pcu = pcu.replace('nan', pd.NA)
-    pcu = pcu.dropna(subset=numerical_cols)
-
-    pcu.to_csv(uploadable_pcu_items, index=False, header=False)
-    to_sql_table(dbPath, pcu, "FINAL PCU")
+FINGERPRINTS_TABLE = 'FINGERPRINTS'
+FINGERPRINT_TABLES = ['URM_NEW', 'URM_CHG', 'URM_PCU', 'URM_PCD', 'URM_TPN', 'URM_CPN']
+PROMOTION_TABLES = ['URM_TPN', 'URM_CPN']  # every promotion is written to the db, also the unchanged ones
+ST_FILTER_COLUMNS = ['PRICE', 'CASE COST', 'PACK SIZE']  # inventory values the price change and margin filters read
+# inventory values the processing of a SIL row depends on: the ones the filters read and the ones the rules look up
+ST_FINGERPRINT_COLUMNS = ST_FILTER_COLUMNS + [col for col in rules.ST_KEY_COLUMNS.values() if col not in ST_FILTER_COLUMNS]
+
+# hash of each inventory item's values that the SIL rows are compared against, by UPC KEY (first row of a UPC)
+def inventory_hashes(st):
+    hashes = pd.Series(pd.util.hash_pandas_object(st[ST_FINGERPRINT_COLUMNS], index=False).to_numpy(), index=st['UPC KEY'])
+    hashes = hashes[~hashes.index.duplicated()]
+    hashes.index.is_unique  # builds the index's lookup table now, the fingerprint stages share it across threads
+    return hashes
+
+# the run's settings that the fingerprints depend on, typed so that the same settings always hash the same
+# (a min_tpr_margin of 40 or 40.0, a rule value of '40' or '40.0')
+def fingerprint_settings(only_do_if_cost_change, min_tpr_margin, rule_sets):
+    typed = {name: sorted((key_type(key), value_type(value)) for key, value in rule_sets.get(name, {}).items())
+             for name, (key_type, value_type) in rules.RULE_SETS.items()}
+    return bool(only_do_if_cost_change), float(min_tpr_margin), typed
+
+# fingerprint of each processed SIL row: its values, the inventory values of its UPC and the run's settings,
+# so a row only has the same fingerprint as in the last run if nothing its output depends on changed
+def fingerprint_rows(data, st_hashes, settings):
+    salt = np.uint64(int.from_bytes(hashlib.sha1(repr(settings).encode()).digest()[:8], 'little'))
+    rows = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    pos = st_hashes.index.get_indexer(utils.upc_keys(data['UPC']))
+    items = np.where(pos >= 0, st_hashes.to_numpy()[pos], np.uint64(0))
+    with np.errstate(over='ignore'):
+        fingerprints = (rows * np.uint64(0x100000001B3)) ^ items ^ salt
+    return pd.Series(fingerprints.view(np.int64), index=data.index)  # sqlite integers are signed
+
+# fingerprints of the rows processed in the last run, by SIL table (none with full_rebuild or no db yet)
+def load_fingerprints(dbPath, full_rebuild=False):
+    if full_rebuild or not os.path.exists(dbPath):
+        return {}
+    conn = sqlite3.connect(dbPath)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (FINGERPRINTS_TABLE,)).fetchone():
+            return {}
+        previous = defaultdict(list)
+        for table, fingerprint in conn.execute(f'SELECT "SIL TABLE", "FINGERPRINT" FROM "{FINGERPRINTS_TABLE}"'):
+            previous[table].append(fingerprint)
+        return {table: np.array(fingerprints, dtype=np.int64) for table, fingerprints in previous.items()}
+    finally:
+        conn.close()
+
+# only keeps the rows whose fingerprint is not one of the last run's (a row that is unchanged was already done)
+def skip_unchanged(data, fingerprints, previous, table):
+    with instrument.stage(table + ': unchanged filter', len(data)) as stage:
+        if table in previous:
+            data = data[~np.isin(fingerprints[data.index].to_numpy(), previous[table])]
+        stage['ROWS OUT'] = len(data)
+    return data
 
-    tpr_header = 'UPC,VENDOR NUMBER,PRICE,PRICE MULTIPLE,CASE COST,TPR PRICE MULTIPLE,TPR PRICE,TPR START DATE,TPR END DATE,PRICE METHOD'
-    tpr = parse_sil_txt(silFile, tpr_header, 'URM_TPN', dbPath)
-    tpr = get_tpr(tpr.copy(), st.copy(), dbPath, min_margin=min_tpr_margin)
-    numerical_cols = ['UPC', 'PRICE', 'TPR PRICE']
-    tpr = tpr.replace('nan', pd.NA)
-    tpr = tpr.dropna(subset=numerical_cols)
+# the rows skip_unchanged left out (the promotions among them are still looked up for the db, see build_graph)
+def unchanged_rows(data, changed):
+    return data[~data.index.isin(changed.index)]
+
+# replaces the fingerprints of the SIL tables with those of this run's rows
+def write_fingerprints(conn, fingerprints, data, run_id):
+    for table, table_fingerprints in fingerprints.items():
+        with instrument.stage('SQLITE: ' + FINGERPRINTS_TABLE + ' ' + table, len(table_fingerprints)) as stage:
+            clear_fingerprints(conn, [table])
+            insert_fingerprints(conn, table, table_fingerprints, data[table], run_id)
+            stage['ROWS OUT'] = len(table_fingerprints)
+
+# deletes the fingerprints of the SIL tables (the table is created the first time)
+def clear_fingerprints(conn, tables):
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS "{FINGERPRINTS_TABLE}" ("SIL TABLE" TEXT, "UPC" TEXT, "FINGERPRINT" INTEGER,
+                    "RUN ID" INTEGER)''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "{FINGERPRINTS_TABLE} SIL TABLE" ON "{FINGERPRINTS_TABLE}" ("SIL TABLE")')
+    for table in tables:
+        conn.execute(f'DELETE FROM "{FINGERPRINTS_TABLE}" WHERE "SIL TABLE" = ?', (table,))
+
+# adds the fingerprints of rows of a SIL table
+def insert_fingerprints(conn, table, fingerprints, data, run_id):
+    upcs = data['UPC'].astype(object).where(data['UPC'].notna(), None)
+    conn.executemany(f'INSERT INTO "{FINGERPRINTS_TABLE}" VALUES (?, ?, ?, ?)',
+                     zip([table] * len(upcs), upcs, fingerprints.tolist(), [run_id] * len(upcs)))
+
+# writes a df to an uploadable csv
+def write_csv(data, csv_file):
+    out = to_output_format(data)
+    with instrument.stage('CSV: ' + os.path.basename(csv_file), len(out)) as stage:
+        out.to_csv(csv_file, index=False, header=False)
+        stage['ROWS OUT'] = len(out)
+
+# writes a df to its table in the db
+def write_table(conn, data, table_name, run_id):
+    out = to_output_format(data)
+    with instrument.stage('SQLITE: ' + table_name, len(out)) as stage:
+        to_sql_table(conn, out, table_name, run_id)
+        stage['ROWS OUT'] = len(out)
+
+# drops the rows missing any of the numerical columns, 'nan' (a missing value once cleaned) in the text columns is
+# missing too. the categoricals (from the inventory) have their missing values as NA already
+def drop_missing(data, numerical_cols, name):
+    with instrument.stage(name + ': dropna', len(data)) as stage:
+        text_cols = [col for col in data.columns if data[col].dtype == object]
+        data = data.copy()
+        data[text_cols] = data[text_cols].replace('nan', pd.NA)
+        data = data.dropna(subset=numerical_cols)
+        stage['ROWS OUT'] = len(data)
+    return data
 
-    tpr.to_csv(uploadable_tprs, index=False, header=False)
+# formats the new items of a SIL table once for get_new (first row of each item) and get_pcu (every row)
+def format_new_items(new, name, compiled=None, seen=None):
+    with instrument.stage(name + ': format', len(new)) as stage:
+        new, is_first = format_new(new.copy(), compiled, seen)
+        stage['ROWS OUT'] = len(new)
+    return new, is_first
 
-    ad_header = 'UPC,VENDOR NUMBER,PRICE,PRICE MULTIPLE,CASE COST,SALE PRICE MULTIPLE,SALE PRICE,SALE START DATE,SALE END DATE'
-    ad = parse_sil_txt(silFile, ad_header, 'URM_CPN', dbPath)
-    ad = get_ad(ad.copy(), st.copy(), dbPath)
-    numerical_cols = ['UPC', 'PRICE', 'SALE PRICE MULTIPLE','SALE PRICE']
-    ad = ad.replace('nan', pd.NA)
-    ad = ad.dropna(subset=numerical_cols)
+# the final new items from both new item tables
+def final_new(new, new_2):
+    return finish_new(pd.concat([new[0], new_2[0]], ignore_index=True))
 
-    ad.to_csv(uploadable_ads, index=False, header=False)
+# the final price changes from both new item tables (items already in the store db) and both price change tables
+def final_pcu(new, new_2, pcu, pcu_2):
+    return finish_pcu(pd.concat([new[1], new_2[1], pcu, pcu_2], ignore_index=True))
 
-    pcu_only_price_dif = pcu[pd.to_numeric(pcu['PRICE DIF']) != 0.0]
+# adds the vendor id to the new items and drops those missing numbers
+def finish_new(new):
+    new.insert(10, "ITEM VENDOR ID", "1")
+    numerical_cols = ['UPC', 'POS DEPARTMENT', 'TAX FLAG 1', 'VENDOR ITEM NUMBER', 'CASE PACK', 'CASE COST', 'PRICE']
+    return drop_missing(new, numerical_cols, 'FINAL NEW')
 
-    write_price_tags(pd.concat([new, pcu_only_price_dif]))
-    write_tpr_tags(tpr)
-    
\ No newline at end of file
+# adds the vendor id to the price changes and drops those missing numbers
+def finish_pcu(pcu):
+    pcu.insert(10, "ITEM VENDOR ID", "1")
+    numerical_cols = ['UPC', 'POS DEPARTMENT', 'TAX FLAG 1', 'CASE PACK', 'CASE COST', 'PRICE']
+    return drop_missing(pcu, numerical_cols, 'FINAL PCU')
+
+# the stages of a run as a dependency graph: the inventory and the SIL file are read once and shared by
+# the NEW, PCU, TPR and AD branches, which only depend on each other through them. unless full_rebuild,
+# the rows that are unchanged since the last run are skipped (delta mode). the unchanged TPRs and sales are
+# still looked up for ALL TPR and ALL SALE (not for the uploadables and tags), which have every promotion of the
+# SIL file so that the promotion history has them in every run until they end
+def build_graph(stFile, silFile, dbPath, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads,
+                only_do_if_cost_change, min_tpr_margin, stored_zpl_format, price_printers, tpr_printers, full_rebuild=False, sil=None,
+                warm=None):
+    graph = StageGraph(warm)
+    graph.add('st', lambda: load_inventory(stFile, dbPath))
+    graph.add('sil', lambda: parse_sil_txt(silFile) if sil is None else sil)  # sil: the SIL file already parsed
+
+    graph.add('rules', lambda: rules.load_rules(dbPath))
+    graph.add('compiled rules', rules.compile_rules, 'rules')
+
+    # every SIL table is processed once (the new items for both get_new and get_pcu)
+    graph.add('URM_NEW formatted', lambda sil, compiled: format_new_items(sil['URM_NEW'], 'NEW', compiled), 'sil', 'compiled rules')
+    graph.add('URM_CHG formatted', lambda sil, compiled: format_new_items(sil['URM_CHG'], 'NEW_CHG', compiled), 'sil', 'compiled rules')
+    graph.add('URM_PCU formatted', lambda sil: format_table(process_pcu, sil['URM_PCU'], 'PCU'), 'sil')
+    graph.add('URM_PCD formatted', lambda sil: format_table(process_pcu, sil['URM_PCD'], 'PCD'), 'sil')
+    graph.add('URM_TPN formatted', lambda sil: format_table(process_tpr, sil['URM_TPN'], 'TPR'), 'sil')
+    graph.add('URM_CPN formatted', lambda sil: format_table(process_ad, sil['URM_CPN'], 'SALE'), 'sil')
+
+    # the fingerprints of the processed rows, the rows (first of each item for the new items) with the same
+    # fingerprint as in the last run are skipped (the rules are part of the run's settings)
+    graph.add('settings', lambda rule_sets: fingerprint_settings(only_do_if_cost_change, min_tpr_margin, rule_sets), 'rules')
+    graph.add('previous fingerprints', lambda: load_fingerprints(dbPath, full_rebuild))
+    graph.add('st hashes', inventory_hashes, 'st')
+    for table in FINGERPRINT_TABLES:
+        graph.add(table + ' rows', lambda data: first_of_items(*data) if isinstance(data, tuple) else data, table + ' formatted')
+        graph.add(table + ' fingerprints', fingerprint_rows, table + ' rows', 'st hashes', 'settings')
+        graph.add(table + ' changed', lambda data, fingerprints, previous, table=table: skip_unchanged(data, fingerprints, previous, table),
+                  table + ' rows', table + ' fingerprints', 'previous fingerprints')
+    for table in PROMOTION_TABLES:
+        graph.add(table + ' unchanged', unchanged_rows, table + ' rows', table + ' changed')
+
+    graph.add('new', lambda new, st: get_new(new, st, dbPath, 'NEW', 'PCU (NEW FORMAT)', is_processed=True),
+              'URM_NEW changed', 'st')
+    graph.add('new_2', lambda new, st: get_new(new, st, dbPath, 'NEW_CHG', 'PCU (NEW FORMAT)_CHG', is_processed=True),
+              'URM_CHG changed', 'st')
+    graph.add('final new', final_new, 'new', 'new_2')
+    graph.add('new csv', lambda new: write_csv(new, uploadable_new_items), 'final new')
+
+    # price changes of items not already in 'new' format (every new item, not only the changed ones)
+    graph.add('new keys', lambda new, new_2: new_item_keys(pd.concat([new[0]['UPC'], new_2[0]['UPC']], ignore_index=True)),
+              'URM_NEW formatted', 'URM_CHG formatted')
+    graph.add('pcu', lambda pcu, st, new_keys: get_pcu(pcu, st, None, dbPath, 'PCU', only_do_if_cost_change=only_do_if_cost_change,
+                                                      new_keys=new_keys, is_processed=True), 'URM_PCU changed', 'st', 'new keys')
+    graph.add('pcu_2', lambda pcu, st, new_keys: get_pcu(pcu, st, None, dbPath, 'PCD', only_do_if_cost_change=only_do_if_cost_change,
+                                                        new_keys=new_keys, is_processed=True), 'URM_PCD changed', 'st', 'new keys')
+    graph.add('final pcu', final_pcu, 'new', 'new_2', 'pcu', 'pcu_2')
+    graph.add('pcu csv', lambda pcu: write_csv(pcu, uploadable_pcu_items), 'final pcu')
+
+    graph.add('tpr', lambda tpr, st, compiled: get_tpr(tpr, st, min_margin=min_tpr_margin, is_processed=True, compiled=compiled),
+              'URM_TPN changed', 'st', 'compiled rules')
+    graph.add('unchanged tpr', lambda tpr, st, compiled: get_tpr(tpr, st, min_margin=min_tpr_margin, is_processed=True, compiled=compiled),
+              'URM_TPN unchanged', 'st', 'compiled rules')
+    graph.add('final tpr', lambda tpr: drop_missing(tpr, ['UPC', 'PRICE', 'TPR PRICE'], 'TPR'), 'tpr')
+    graph.add('tpr csv', lambda tpr: write_csv(tpr, uploadable_tprs), 'final tpr')
+
+    graph.add('ad', lambda ad, st: get_ad(ad, st, is_processed=True), 'URM_CPN changed', 'st')
+    graph.add('unchanged ad', lambda ad, st: get_ad(ad, st, is_processed=True), 'URM_CPN unchanged', 'st')
+    graph.add('final ad', lambda ad: drop_missing(ad, ['UPC', 'PRICE', 'SALE PRICE MULTIPLE','SALE PRICE'], 'SALE'), 'ad')
+    graph.add('ad csv', lambda ad: write_csv(ad, uploadable_ads), 'final ad')
+
+    tag_dir = os.path.dirname(uploadable_new_items)
+    graph.add('price tags', lambda new, pcu: write_price_tags(to_output_format(price_tag_rows(new, pcu)),
+                                                             os.path.join(tag_dir, PRICE_TAGS_FILE), stored_format=stored_zpl_format,
+                                                             printers=price_printers),
+              'final new', 'final pcu')
+    graph.add('tpr tags', lambda tpr: write_tpr_tags(to_output_format(tpr), os.path.join(tag_dir, TPR_TAGS_FILE),
+                                                     stored_format=stored_zpl_format, printers=tpr_printers),
+              'final tpr')
+    return graph
+
+# adds the rows the run wrote to the price history
+def record_history(conn, run_id):
+    with instrument.stage('SQLITE: history'):
+        history.record_run(conn, run_id)
+
+# loads the inventory (the st df shared by every branch, which none of them changes)
+def load_inventory(stFile, dbPath):
+    with instrument.stage('inventory load') as stage:
+        st = utils.process_storetender_file(stFile, dbPath)
+        stage['ROWS OUT'] = len(st)
+    return st
+
+# the independent branches of the run are done on up to max_workers threads (1 runs them in sequence).
+# with trace_memory the peak memory of every stage is traced (several times slower), the stages are then run
+# one at a time as tracemalloc has one peak for the whole process (a stage that starts resets it for the stages
+# running alongside it). the stage report of the run is written
+# as json next to the uploadables and to the RUN STAGES table.
+# the uploadables and tags only have the rows that changed since the last run (ALL TPR and ALL SALE have every
+# promotion), full_rebuild does every row again.
+# the ZPL tags are written next to the uploadables, sil is the SIL file already parsed by parse_sil_txt (if shared)
+# and warm has the results of stages that are already done, e.g. {'st': st, 'st hashes': inventory_hashes(st)}
+# for an inventory kept in memory
+def parse(stFile, silFile, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads, dbPath, only_do_if_cost_change, min_tpr_margin, stored_zpl_format=False,
+          price_printers=None, tpr_printers=None, trace_memory=False, max_workers=None, full_rebuild=False, sil=None, warm=None):
+    started = datetime.now()
+    profile = instrument.start(trace_memory)
+    run_id = None
+    is_finished = False
+    try:
+        graph = build_graph(stFile, silFile, dbPath, uploadable_new_items, uploadable_pcu_items, uploadable_tprs, uploadable_ads,
+                            only_do_if_cost_change, min_tpr_margin, stored_zpl_format, price_printers, tpr_printers, full_rebuild, sil, warm)
+        results = graph.run(max_workers=1 if trace_memory else max_workers)
+
+        # the db is written after the graph (sqlite connections stay on their thread), in one transaction
+        conn = open_db(dbPath)
+        try:
+            run_id = start_run(conn, stFile, silFile, started)
+            write_table(conn, results['final new'], "FINAL NEW", run_id)
+            write_table(conn, results['final pcu'], "FINAL PCU", run_id)
+            write_table(conn, concat_rows([results['tpr'], results['unchanged tpr']]), "ALL TPR", run_id)
+            write_table(conn, concat_rows([results['ad'], results['unchanged ad']]), "ALL SALE", run_id)
+            write_fingerprints(conn, {table: graph.results[table + ' fingerprints'] for table in FINGERPRINT_TABLES},
+                               {table: graph.results[table + ' rows'] for table in FINGERPRINT_TABLES}, run_id)
+            record_history(conn, run_id)
+            profile.merge_stages()  # e.g. the blocks of a tag file
+            to_sql_table(conn, pd.DataFrame(profile.stages), instrument.STAGES_TABLE, run_id)
+            finish_run(conn, run_id)
+            is_finished = True
+        finally:
+            conn.close()  # a run that failed is rolled back
+    finally:
+        instrument.stop()
+        profile.merge_stages()
+        report_file = os.path.join(os.path.dirname(uploadable_new_items), instrument.REPORT_FILE)
+        instrument.write_report(profile, report_file, **{'RUN ID': run_id, 'FINISHED': is_finished,
+                                                          'INVENTORY FILE': stFile, 'SIL FILE': silFile})
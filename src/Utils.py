@@ -1,5 +1,8 @@
 from collections import defaultdict
 from datetime import datetime
+import numpy as np
+import hashlib
+import os
 import pandas as pd
 import re
 import sqlite3
@@ -53,23 +56,229 @@ def upcE_to_upcA(upcE):
     else:
         return '0' + firstFive + '0000' + secondLast + upcE[7]
 
-# processes the inventory file from the POS system
-def process_storetender_file(file, dbPath):
+# digit positions of the UPC A built from each UPC E rule (-1 is a literal '0'), the rule is picked
+# by the second last digit of the UPC E: 0-2, 3, 4 and 5-9
+UPCE_TO_UPCA_POSITIONS = np.array([
+    [-1, 1, 2, 6, -1, -1, -1, -1, 3, 4, 5, 7],
+    [-1, 1, 2, 3, -1, -1, -1, -1, -1, 4, 5, 7],
+    [-1, 1, 2, 3, 4, -1, -1, -1, -1, -1, 5, 7],
+    [-1, 1, 2, 3, 4, 5, -1, -1, -1, -1, 6, 7],
+])
+UPCE_RULES = np.array([0, 0, 0, 1, 2, 3, 3, 3, 3, 3])
+
+# makes a series of UPC strings out of a series/array of UPC strings or ints (ints are written in base 10)
+def to_upc_series(upcs):
+    upcs = pd.Series(upcs, copy=False)
+    if pd.api.types.is_integer_dtype(upcs.dtype):
+        upcs = upcs.astype(str)
+    return upcs
+
+# finds the UPCs that are strings (others are returned as is) and turns them into a fixed width str array
+def to_str_array(upcs):
+    values = upcs.to_numpy(dtype=object)
+    if pd.api.types.infer_dtype(values, skipna=False) == 'string':
+        is_str = np.ones(len(values), dtype=bool)
+    else:
+        is_str = np.fromiter((type(x) == str for x in values), dtype=bool, count=len(values))
+    return is_str, values[is_str].astype(str)
+
+# turns equal length strings into an (n, length) array of their ch codes
+def to_ch_codes(strs, length):
+    return np.ascontiguousarray(strs, dtype='U' + str(length)).view(np.int32).reshape(-1, length)
+
+# turns an (n, length) array of ch codes back into strings
+def from_ch_codes(codes):
+    return np.ascontiguousarray(codes, dtype=np.int32).view('U' + str(codes.shape[1])).ravel()
+
+# batch version of add_check_digit for a whole series/array of UPCs at once
+def add_check_digit_batch(upcs):
+    upcs = to_upc_series(upcs)
+    result = upcs.astype(object)
+    is_str, strs = to_str_array(upcs)
+    if not is_str.any():
+        return result
+
+    strs = np.char.zfill(strs, 11)  # UPCs shorter than 11 digits get leading zeroes
+    lengths = np.char.str_len(strs)
+    upcs_with_check = np.empty(len(strs), dtype=object)
+    for length in np.unique(lengths):  # digits are summed in blocks of the same length
+        block = lengths == length
+        digits = to_ch_codes(strs[block], length) - ord('0')
+        if ((digits < 0) | (digits > 9)).any():
+            raise ValueError('UPC has non-digit characters')
+
+        weights = np.where(np.arange(length) % 2 == 0, 3, 1)  # odd positions (1st, 3rd, ...) count 3 times
+        check_digits = (10 - (digits @ weights) % 10) % 10
+        codes = np.column_stack([digits, check_digits]) + ord('0')
+        upcs_with_check[block] = from_ch_codes(codes)
+    result[is_str] = upcs_with_check
+    return result
+
+# batch version of upcE_to_upcA for a whole series/array of UPCs at once
+def upcE_to_upcA_batch(upcs):
+    upcs = to_upc_series(upcs)
+    result = upcs.astype(object)
+    is_str, strs = to_str_array(upcs)
+    is_upcE = np.zeros(len(upcs), dtype=bool)
+    is_upcE[is_str] = np.char.str_len(strs) == 8
+    if not is_upcE.any():
+        return result
+
+    upcE = to_ch_codes(strs[is_upcE[is_str]], 8)
+    rules = np.full(len(upcE), 3)
+    is_digit = (upcE[:, 6] >= ord('0')) & (upcE[:, 6] <= ord('9'))
+    rules[is_digit] = UPCE_RULES[upcE[is_digit, 6] - ord('0')]
+
+    positions = UPCE_TO_UPCA_POSITIONS[rules]
+    upcA = np.take_along_axis(upcE, np.maximum(positions, 0), axis=1)
+    upcA[positions < 0] = ord('0')
+    result[is_upcE] = from_ch_codes(upcA)
+    return result
+
+UPC_KEY_DIGITS = 14  # codes of up to 14 digits (GTIN-14) get an exact key
+MISSING_UPC_KEY = np.iinfo(np.int64).min
+
+# int64 keys to merge and look up UPCs by instead of hashing their strings: a code of up to 14 digits is its
+# number plus its length * 10**14 (so '0123' and '123' stay apart), any other str gets a negative hash of it
+def upc_keys(upcs):
+    upcs = to_upc_series(upcs)
+    keys = np.full(len(upcs), MISSING_UPC_KEY, dtype=np.int64)
+    is_str, strs = to_str_array(upcs)
+    if not is_str.any():
+        return pd.Series(keys, index=upcs.index)
+
+    lengths = np.char.str_len(strs)
+    is_number = (lengths <= UPC_KEY_DIGITS) & np.char.isdigit(strs)
+    str_keys = np.empty(len(strs), dtype=np.int64)
+    str_keys[is_number] = strs[is_number].astype(np.int64) + lengths[is_number] * 10 ** UPC_KEY_DIGITS
+    hashes = pd.util.hash_array(strs[~is_number].astype(object))
+    str_keys[~is_number] = -(hashes >> np.uint64(1)).astype(np.int64) - 1
+    keys[is_str] = str_keys
+    return pd.Series(keys, index=upcs.index)
+
+ST_HEADERS = ['PLU NUMBER','PLU DESCRIPTION','LONG DESCRIPTION','SIZE','UOM',
+              'BRAND NO','DEPT NO','SUB DEPT NO','FAMILY NO','SCALE USAGE',
+              'VENDOR NO','ITEM NO','TAX 1 NO','TAX 2 NO','TAX 3 NO','CASE PLU',
+              'LINK PLU','PACK SIZE','CASE COST','MARGIN','MARKUP','MULTIPLIER',
+              'PRICE','FORMULA NO','WIC FOOD GROUP','MIN ON HAND','MAX ON HAND',
+              'ON ORDER','ON HAND','OPENING BALANCE','FOOD STAMPS','WIC','WIC FV',
+              'KIT','FOOD SERVICE ITEM','TAG NEEDED','CARRIES']
+
+# the only inventory columns used when merging with the SIL file
+ST_COLUMNS = ['PLU NUMBER', 'PLU DESCRIPTION', 'LONG DESCRIPTION', 'DEPT NO', 'ITEM NO', 'TAX 1 NO',
+              'PACK SIZE', 'CASE COST', 'PRICE', 'FOOD STAMPS']
+
+# low cardinality inventory columns kept as categoricals
+ST_CATEGORY_COLUMNS = ['DEPT NO', 'TAX 1 NO', 'FOOD STAMPS']
+
+ST_SNAPSHOT_TABLE = 'INVENTORY SNAPSHOT'  # + a hash of the export's path, one snapshot per export
+ST_SNAPSHOT_INFO_TABLE = 'INVENTORY SNAPSHOT INFO'  # one row per export
+ST_SNAPSHOT_VERSION = 1  # bump when read_storetender_file cleans differently, older snapshots are then rebuilt
+ST_SNAPSHOTS_KEPT = 3  # newest snapshots kept when one is built (exports are named by date, so most are used once)
+
+# cleans every column as a str column: strips leading and trailing spaces, removes all non-alphanumeric ch
+# (except space and .) and if strip_zeros also removes leading zeroes
+def clean_columns(data, strip_zeros=False):
+    cleaned = {}
+    for col in data.columns:
+        values = data[col].astype(str).str.strip().str.replace(r'[^0-9a-zA-Z\s.]', '', regex=True)
+        if strip_zeros:
+            values = values.str.lstrip('0')
+        cleaned[col] = values
+    return pd.DataFrame(cleaned, index=data.index)
+
+# decodes the inventory columns used in the price math: PRICE -> Int64 cents, CASE COST -> float, PACK SIZE -> number,
+# makes the low cardinality columns categoricals (a missing value, 'nan' once cleaned, is NA and not a category)
+# and adds the int64 UPC KEY of each UPC A
+def decode_storetender_columns(data):
+    data['PRICE'] = (pd.to_numeric(data['PRICE'], errors='coerce') * 100).round().astype('Int64')
+    data['CASE COST'] = pd.to_numeric(data['CASE COST'], errors='coerce')
+    pack_size = pd.to_numeric(data['PACK SIZE'], errors='coerce')
+    if (pack_size.dropna() % 1 == 0).all():
+        pack_size = pack_size.astype('Int64')
+    data['PACK SIZE'] = pack_size
+    for col in ST_CATEGORY_COLUMNS:
+        data[col] = data[col].mask(data[col] == 'nan').astype('category')
+    data['UPC KEY'] = upc_keys(data['UPC'])
+    return data
+
+# hashes the contents of a file
+def file_hash(file):
+    sha = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+# reads and cleans the needed columns of the inventory file from the POS system
+def read_storetender_file(file):
     dtypes = defaultdict(lambda: str)
     dtypes['CASE COST'] = float
-    dtypes['MARGIN'] = float
-    dtypes['MARKUP'] = float
     dtypes['PRICE'] = float
-    headers = ['PLU NUMBER','PLU DESCRIPTION','LONG DESCRIPTION','SIZE','UOM',
-               'BRAND NO','DEPT NO','SUB DEPT NO','FAMILY NO','SCALE USAGE',
-               'VENDOR NO','ITEM NO','TAX 1 NO','TAX 2 NO','TAX 3 NO','CASE PLU',
-               'LINK PLU','PACK SIZE','CASE COST','MARGIN','MARKUP','MULTIPLIER',
-               'PRICE','FORMULA NO','WIC FOOD GROUP','MIN ON HAND','MAX ON HAND',
-               'ON ORDER','ON HAND','OPENING BALANCE','FOOD STAMPS','WIC','WIC FV',
-               'KIT','FOOD SERVICE ITEM','TAG NEEDED','CARRIES']
-    data = pd.read_csv(file, on_bad_lines="skip", dtype=dtypes, names=headers)
+    # all columns are read (as str) since with usecols pandas keeps lines with too many fields instead of skipping them
+    data = pd.read_csv(file, on_bad_lines="skip", dtype=dtypes, names=ST_HEADERS)
+    data = data[ST_COLUMNS]
     data.rename(columns={'PLU NUMBER': 'UPC'}, inplace=True)
-    data = data.applymap(lambda x: str(x).strip())  # strip leading and trailing spaces
-    data = data.replace(r'[^0-9a-zA-Z\s.]', '', regex=True)  # remove all non-alphanumeric ch (except space and .)
+    data = clean_columns(data)
+
+    data['ORG'] = data['UPC']  # keep the UPC as the POS has it for the uploadables
+    data['UPC'] = upcE_to_upcA_batch(data['UPC'])  # UPC A is the key for merging with the SIL file
+    return data
+
+# processes the inventory file from the POS system, the cleaned inventory is kept as a snapshot in the db
+# and reused as long as the file's path, size and mtime (or else its hash) have not changed (the db keeps the
+# snapshots of the newest ST_SNAPSHOTS_KEPT exports)
+def process_storetender_file(file, dbPath, use_snapshot=True):
+    if not use_snapshot:
+        return decode_storetender_columns(read_storetender_file(file))
+    return decode_storetender_columns(load_storetender_snapshot(file, dbPath))
+
+# the snapshot info table of the db (one row per export)
+def snapshot_info_table(conn):
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS "{ST_SNAPSHOT_INFO_TABLE}" ("FILE" TEXT PRIMARY KEY, "SNAPSHOT" TEXT,
+        "VERSION" INTEGER, "FILE SIZE" INTEGER, "FILE MTIME" REAL, "FILE HASH" TEXT, "CREATED" TEXT)''')
+
+# drops the snapshots of exports that no longer exist and those older than the newest ST_SNAPSHOTS_KEPT
+def evict_snapshots(conn):
+    infos = conn.execute(f'SELECT "FILE", "SNAPSHOT" FROM "{ST_SNAPSHOT_INFO_TABLE}" ORDER BY "CREATED" DESC, rowid DESC').fetchall()
+    kept = 0
+    for file, snapshot in infos:
+        if kept < ST_SNAPSHOTS_KEPT and os.path.exists(file):
+            kept += 1
+        else:
+            conn.execute(f'DROP TABLE IF EXISTS "{snapshot}"')
+            conn.execute(f'DELETE FROM "{ST_SNAPSHOT_INFO_TABLE}" WHERE "FILE" = ?', (file,))
+
+# loads the cleaned (str) inventory from its snapshot in the db, the snapshot is rebuilt if the file changed
+def load_storetender_snapshot(file, dbPath):
+    path = os.path.abspath(file)
+    stat = os.stat(path)
+    conn = sqlite3.connect(dbPath)
+    try:
+        snapshot_info_table(conn)
+        info = conn.execute(f'''SELECT "SNAPSHOT", "VERSION", "FILE SIZE", "FILE MTIME", "FILE HASH" FROM "{ST_SNAPSHOT_INFO_TABLE}"
+            WHERE "FILE" = ?''', (path,)).fetchone()
+        snapshot = ST_SNAPSHOT_TABLE + ' ' + hashlib.sha256(path.encode()).hexdigest()[:16]
+        is_current = info is not None and info[0] == snapshot and info[1] == ST_SNAPSHOT_VERSION and info[2] == stat.st_size
+
+        if is_current and info[3] == stat.st_mtime:
+            conn.commit()
+            return pd.read_sql(f'SELECT * FROM "{snapshot}"', conn, dtype=str)
+
+        sha = file_hash(path)
+        if is_current and info[4] == sha:  # file was touched but not changed
+            conn.execute(f'UPDATE "{ST_SNAPSHOT_INFO_TABLE}" SET "FILE MTIME" = ? WHERE "FILE" = ?', (stat.st_mtime, path))
+            conn.commit()
+            return pd.read_sql(f'SELECT * FROM "{snapshot}"', conn, dtype=str)
+
+        data = read_storetender_file(path)
+        data.to_sql(snapshot, con=conn, if_exists='replace', index=False)
+        conn.execute(f'INSERT OR REPLACE INTO "{ST_SNAPSHOT_INFO_TABLE}" VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (path, snapshot, ST_SNAPSHOT_VERSION, stat.st_size, stat.st_mtime, sha,
+                      datetime.now().isoformat(timespec='seconds')))
+        evict_snapshots(conn)
+        conn.commit()
+    finally:
+        conn.close()
 
-    return data
\ No newline at end of file
+    return data
@@ -0,0 +1,40 @@
+import json
+import os
+import pytest
+import Batch as batch
+
+# run from src/ with python -m pytest -q
+
+def write_manifest(dir, manifest):
+    file = os.path.join(dir, 'stores.json')
+    with open(file, 'w') as f:
+        json.dump(manifest, f)
+    return file
+
+def store(name, **paths):
+    return {'name': name, 'inventory': f'{name}/INV.csv', 'sil': 'SIL.TXT', 'output_dir': f'{name}/uploadables',
+            'db': f'{name}/urm.db', **paths}
+
+def test_read_manifest(tmp_path):
+    file = write_manifest(tmp_path, {'defaults': {'min_tpr_margin': 40}, 'stores': [store('s1'), store('s2', min_tpr_margin=30)]})
+    stores = batch.read_manifest(file)
+    assert [s['min_tpr_margin'] for s in stores] == [40, 30]
+    assert stores[0]['db'] == os.path.join(tmp_path, 's1', 'urm.db')
+    assert stores[1]['sil'] == os.path.join(tmp_path, 'SIL.TXT')  # the SIL file can be shared
+
+def test_stores_can_not_share_a_db(tmp_path):
+    s1, s2 = store('s1'), store('s2')
+    del s1['db'], s2['db']
+    file = write_manifest(tmp_path, {'defaults': {'db': 'shared.db'}, 'stores': [s1, s2]})
+    with pytest.raises(ValueError, match='db'):
+        batch.read_manifest(file)
+
+def test_stores_can_not_share_an_output_dir(tmp_path):
+    file = write_manifest(tmp_path, {'stores': [store('s1', output_dir='out'), store('s2', output_dir='./out/')]})
+    with pytest.raises(ValueError, match='output_dir'):
+        batch.read_manifest(file)
+
+def test_store_names_are_unique(tmp_path):
+    file = write_manifest(tmp_path, {'stores': [store('s1'), store('s1', db='other.db', output_dir='other')]})
+    with pytest.raises(ValueError, match='names'):
+        batch.read_manifest(file)
@@ -0,0 +1,117 @@
+import json
+import os
+import urllib.request
+import pytest
+import Daemon as daemon
+import Generate as generate
+import Utils as utils
+
+# run from src/ with python -m pytest -q
+
+# a daemon on a drop dir with a generated SIL file and inventory export in it (not polled yet)
+@pytest.fixture
+def drop(tmp_path):
+    sil_file, st_file = generate.generate(200, str(tmp_path / 'drop'))
+    watcher = daemon.Daemon(str(tmp_path / 'drop'), str(tmp_path / 'out'), str(tmp_path / 'urm.db'), min_tpr_margin=40,
+                            only_do_if_cost_change=False)
+    return watcher, sil_file, st_file
+
+# counts the inventory loads
+@pytest.fixture
+def loads(monkeypatch):
+    files = []
+    load = utils.process_storetender_file
+    monkeypatch.setattr(utils, 'process_storetender_file', lambda file, dbPath: files.append(file) or load(file, dbPath))
+    return files
+
+# the queued SIL files, taken off the queue
+def queued(watcher):
+    items = []
+    while not watcher.sil_files.empty():
+        items.append(watcher.sil_files.get())
+    return items
+
+# sets a file's mtime to seconds after its current one, as if it was written again
+def touch(file, seconds=10):
+    mtime = os.path.getmtime(file) + seconds
+    os.utime(file, (mtime, mtime))
+
+def test_a_file_lands_once_it_stops_changing(tmp_path):
+    watcher = daemon.Daemon(str(tmp_path), str(tmp_path / 'out'), str(tmp_path / 'urm.db'))
+    file = tmp_path / 'SIL.TXT'
+    file.write_text('part')
+    assert watcher.landed([str(file)]) == []
+    assert watcher.landed([str(file)]) == [str(file)]
+    file.write_text('part and the rest')
+    assert watcher.landed([str(file)]) == []
+    assert watcher.landed([str(file)]) == [str(file)]
+    assert watcher.landed([str(tmp_path / 'gone.txt')]) == []
+
+def test_landed_sil_file_is_run_and_moved_to_processed(drop, loads):
+    watcher, sil_file, st_file = drop
+    watcher.poll()
+    assert queued(watcher) == [] and loads == []  # not landed yet
+    watcher.poll()
+    items = queued(watcher)
+    assert [file for file, _ in items] == [sil_file] and loads == [st_file]
+    watcher.run(*items[0])
+    status = watcher.get_status()
+    assert status['last run']['error'] is None and status['runs'] == 1 and status['queue depth'] == 0
+    assert not os.path.exists(sil_file)
+    assert os.path.exists(os.path.join(watcher.drop_dir, daemon.PROCESSED_DIR, os.path.basename(sil_file)))
+    assert set(daemon.UPLOADABLES.values()) <= set(os.listdir(watcher.output_dir))
+    watcher.poll()
+    assert queued(watcher) == []
+
+def test_inventory_is_only_reloaded_when_it_changes(drop, loads):
+    watcher, sil_file, st_file = drop
+    for _ in range(3):
+        watcher.poll()
+    assert loads == [st_file]
+    touch(st_file)
+    watcher.poll()
+    assert loads == [st_file]  # changed, not landed yet
+    watcher.poll()
+    assert loads == [st_file, st_file] and watcher.inventory[2] == os.path.getmtime(st_file)
+
+def test_failed_run_is_retried_once_the_sil_file_or_inventory_changes(drop, monkeypatch):
+    watcher, sil_file, st_file = drop
+    monkeypatch.setattr(daemon, 'parse', lambda *args, **kwargs: 1 / 0)
+    for _ in range(2):
+        watcher.poll()
+    watcher.run(*queued(watcher)[0])
+    status = watcher.get_status()
+    assert status['failed runs'] == 1 and 'ZeroDivisionError' in status['last run']['error']
+    assert os.path.exists(sil_file)  # left in the drop dir
+    watcher.poll()
+    assert queued(watcher) == []  # same file, same inventory
+    touch(sil_file)
+    for _ in range(2):
+        watcher.poll()
+    watcher.run(*queued(watcher)[0])
+    touch(st_file)
+    for _ in range(2):
+        watcher.poll()
+    assert [file for file, _ in queued(watcher)] == [sil_file]  # same file, new inventory
+
+def test_sil_file_without_an_inventory_fails(drop):
+    watcher, sil_file, st_file = drop
+    os.remove(st_file)
+    for _ in range(2):
+        watcher.poll()
+    watcher.run(*queued(watcher)[0])
+    assert 'no inventory export' in watcher.get_status()['last run']['error'] and sil_file in watcher.failed
+
+def test_status_endpoint(drop):
+    watcher, _, _ = drop
+    for _ in range(2):
+        watcher.poll()
+    server = daemon.start_status_server(watcher, 0)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/status', timeout=5) as response:
+            assert response.headers['Content-Type'] == 'application/json'
+            status = json.load(response)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert status['queue depth'] == 1 and status['runs'] == 0 and status['inventory'] == watcher.inventory[0]
@@ -0,0 +1,64 @@
+import threading
+import pytest
+from Graph import StageGraph
+
+# run from src/ with python -m pytest -q
+
+# a graph a -> b, a -> c, (b, c) -> d that records the order its stages ran in
+def diamond(results=None):
+    ran = []
+    lock = threading.Lock()
+    def stage(name, fn):
+        def run(*args):
+            with lock:
+                ran.append(name)
+            return fn(*args)
+        return run
+    graph = StageGraph(results)
+    graph.add('a', stage('a', lambda: 1))
+    graph.add('b', stage('b', lambda a: a + 1), 'a')
+    graph.add('c', stage('c', lambda a: a * 10), 'a')
+    graph.add('d', stage('d', lambda b, c: (b, c)), 'b', 'c')
+    return graph, ran
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_stages_run_after_their_dependencies(max_workers):
+    graph, ran = diamond()
+    assert graph.run(max_workers=max_workers) == {'a': 1, 'b': 2, 'c': 10, 'd': (2, 10)}
+    assert ran[0] == 'a' and ran[-1] == 'd' and sorted(ran[1:3]) == ['b', 'c']
+
+def test_a_shared_stage_runs_once():
+    graph, ran = diamond()
+    assert graph.run(['b', 'c']) == {'b': 2, 'c': 10}
+    assert graph.run(['d']) == {'d': (2, 10)}
+    assert ran.count('a') == 1 and len(ran) == 4
+
+def test_only_the_needed_stages_run():
+    graph, ran = diamond()
+    assert graph.needed(['b']) == ['a', 'b']
+    assert graph.run(['b']) == {'b': 2}
+    assert ran == ['a', 'b']
+
+def test_warm_results_are_not_run():
+    graph, ran = diamond({'a': 5, 'c': 0})
+    assert graph.needed(['d']) == ['b', 'd']
+    assert graph.run(['d']) == {'d': (6, 0)}
+    assert ran == ['b', 'd']
+
+def test_unknown_and_duplicate_stages_are_errors():
+    graph, _ = diamond()
+    with pytest.raises(ValueError, match='already in the graph: b'):
+        graph.add('b', lambda: 0)
+    with pytest.raises(ValueError, match='depends on unknown stages: x, y'):
+        graph.add('e', lambda *args: 0, 'a', 'x', 'y')
+    assert 'e' not in graph.stages
+
+def test_a_failing_stage_raises_from_run():
+    graph, _ = diamond()
+    def fail(a):
+        raise KeyError('UPC')
+    graph.add('e', fail, 'a')
+    graph.add('f', lambda e: e, 'e')
+    with pytest.raises(KeyError, match='UPC'):
+        graph.run(max_workers=2)
+    assert 'f' not in graph.results
@@ -0,0 +1,55 @@
+import os
+import sqlite3
+import pandas as pd
+import pytest
+import Generate as generate
+import History as history
+import Stream as stream
+import Urm as urm
+
+# run from src/ with python -m pytest -q
+
+# runs parse (or parse_streaming) on the files into dir/uploadables and dir/urm.db, returns the db's path
+def run(parse, sil_file, st_file, dir):
+    out_dir = dir / 'uploadables'
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = {arg: str(out_dir / (arg + '.csv')) for arg in ['uploadable_new_items', 'uploadable_pcu_items', 'uploadable_tprs', 'uploadable_ads']}
+    db = str(dir / 'urm.db')
+    parse(st_file, sil_file, dbPath=db, only_do_if_cost_change=False, min_tpr_margin=40, **paths)
+    return db
+
+def read(db, sql):
+    conn = sqlite3.connect(db)
+    try:
+        return pd.read_sql(sql, conn)
+    finally:
+        conn.close()
+
+# every row of a table, in the order of its columns
+def read_table(db, table):
+    data = read(db, f'SELECT * FROM "{table}"')
+    return data.sort_values(list(data.columns)).reset_index(drop=True)
+
+# a promotion that is still in the SIL file is in the history of the delta runs that skip it
+@pytest.mark.parametrize('parse', [urm.parse, stream.parse_streaming])
+def test_unchanged_promotions_stay_in_the_history(tmp_path, parse):
+    sil_file, st_file = generate.generate(1000, str(tmp_path / 'store'))
+    for _ in range(3):
+        db = run(parse, sil_file, st_file, tmp_path)
+    assert os.path.getsize(tmp_path / 'uploadables' / 'uploadable_tprs.csv') == 0  # nothing changed since the first run
+    for source, table in [('ALL TPR', history.TPR_HISTORY_TABLE), ('ALL SALE', history.SALE_HISTORY_TABLE)]:
+        counts = read(db, f'SELECT "RUN ID", count(*) AS "ROWS" FROM "{source}" GROUP BY "RUN ID"')
+        assert list(counts['RUN ID']) == [1, 2, 3] and counts['ROWS'].nunique() == 1
+        runs = read(db, f'SELECT "FIRST RUN ID", "LAST RUN ID" FROM "{table}"')
+        assert len(runs) > 0
+        assert (runs['FIRST RUN ID'] == 1).all() and (runs['LAST RUN ID'] == 3).all()
+
+def test_rebuilt_history_is_the_same(tmp_path):
+    sil_file, st_file = generate.generate(1000, str(tmp_path / 'store'))
+    for _ in range(2):
+        db = run(urm.parse, sil_file, st_file, tmp_path)
+    tables = [history.PRICE_HISTORY_TABLE, history.TPR_HISTORY_TABLE, history.SALE_HISTORY_TABLE]
+    recorded = {table: read_table(db, table) for table in tables}
+    assert history.rebuild(db) == 2
+    for table in tables:
+        pd.testing.assert_frame_equal(recorded[table], read_table(db, table), obj=table)
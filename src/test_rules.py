@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import pandas as pd
+import pytest
+import Generate as generate
+import Rules as rules
+import Urm as urm
+import Utils as utils
+
+# run from src/ with python -m pytest -q
+
+def test_db_rules_override_the_defaults(tmp_path):
+    db = str(tmp_path / 'urm.db')
+    rules.save_rules(db, {'UOM CODES': {'48': 'OUNCE', '99': 'CT'}})
+    uom_codes = rules.load_rules(db)['UOM CODES']
+    assert uom_codes['48'] == 'OUNCE' and uom_codes['99'] == 'CT' and uom_codes['32'] == 'SQFT'
+    assert rules.load_rules(db)['GROUP DEPARTMENTS'] == rules.DEFAULT_RULES['GROUP DEPARTMENTS']
+
+def test_null_removes_a_default_key(tmp_path):
+    db = str(tmp_path / 'urm.db')
+    rules.save_rules(db, {'UOM CODES': {'48': None}})
+    assert '48' not in rules.load_rules(db)['UOM CODES']
+    assert '48' in rules.load_rules()['UOM CODES']
+
+def test_keys_that_are_the_same_once_typed_are_an_error(tmp_path):
+    with pytest.raises(ValueError, match='GROUP DEPARTMENTS has the same key more than once'):
+        rules.compile_rules({'GROUP DEPARTMENTS': {'01': '3', '1': '4'}})
+    with pytest.raises(ValueError, match='more than once'):
+        rules.save_rules(str(tmp_path / 'urm.db'), {'GROUP DEPARTMENTS': {'317': '3', '0317': '4'}})
+    rules.compile_rules({'UOM CODES': {'01': 'EA', '1': 'EA'}})  # text keys are not the same
+
+def test_unknown_rule_sets_are_an_error(tmp_path):
+    db = str(tmp_path / 'urm.db')
+    with pytest.raises(ValueError, match='unknown rule sets: TAX RATES'):
+        rules.save_rules(db, {'TAX RATES': {'1': '0.07'}})
+    rules.save_rules(db, {})
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.execute(f'INSERT INTO "{rules.RULES_TABLE}" VALUES (?, ?, ?)', ('TAX RATES', '1', '0.07'))
+    conn.close()
+    with pytest.raises(ValueError, match='unknown rule set in RULES: TAX RATES'):
+        rules.load_rules(db)
+
+# a TPR is kept if its margin is over the min margin of its inventory department, or the run's if it has none
+def test_tpr_min_margins_by_department(tmp_path):
+    sil_file, st_file = generate.generate(1000, str(tmp_path / 'store'))
+    tpr = urm.format_table(urm.process_tpr, urm.parse_sil_txt(sil_file)['URM_TPN'], 'TPR')
+    st = utils.process_storetender_file(st_file, None, use_snapshot=False)
+    every = urm.get_tpr(tpr, st, 0, is_processed=True)
+    depts = every['UPC'].map(st.drop_duplicates('ORG').set_index('ORG')['DEPT NO'])
+    dept = depts[every['MARGIN'] <= 40].mode()[0]  # a department with TPRs under the run's min margin
+    compiled = rules.compile_rules({'TPR MIN MARGINS': {dept: '0'}})
+    kept = urm.get_tpr(tpr, st, 40, is_processed=True, compiled=compiled)
+    pd.testing.assert_frame_equal(kept, every[(depts == dept) | (every['MARGIN'] > 40)])
+    assert len(urm.get_tpr(tpr, st, 40, is_processed=True)) < len(kept)
+
+# runs parse on the files into dir/uploadables and dir/urm.db, returns the TPRs it wrote
+def run_tprs(sil_file, st_file, dir, **parse_args):
+    out_dir = dir / 'uploadables'
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = {arg: str(out_dir / (arg + '.csv')) for arg in ['uploadable_new_items', 'uploadable_pcu_items', 'uploadable_tprs', 'uploadable_ads']}
+    urm.parse(st_file, sil_file, dbPath=str(dir / 'urm.db'), only_do_if_cost_change=False, min_tpr_margin=40, **paths, **parse_args)
+    with open(paths['uploadable_tprs'], 'rb') as f:
+        return f.read()
+
+# the TPR MIN MARGINS rules look up the inventory's department, so a delta run does the TPRs of the items whose
+# department changed again
+def test_department_change_runs_the_tprs_again(tmp_path):
+    sil_file, st_file = generate.generate(1000, str(tmp_path / 'store'))
+    for dir in ['delta', 'full']:
+        os.makedirs(tmp_path / dir)
+        rules.save_rules(str(tmp_path / dir / 'urm.db'), {'TPR MIN MARGINS': {'99': '0'}})
+    for _ in range(2):
+        tprs = run_tprs(sil_file, st_file, tmp_path / 'delta')
+    assert tprs == b''  # nothing changed
+    inventory = pd.read_csv(st_file, header=None, dtype=str, keep_default_na=False)
+    inventory[6] = '99'  # DEPT
+    inventory.to_csv(st_file, header=False, index=False)
+    tprs = run_tprs(sil_file, st_file, tmp_path / 'delta')
+    assert tprs != b'' and tprs == run_tprs(sil_file, st_file, tmp_path / 'full', full_rebuild=True)
@@ -0,0 +1,139 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import pandas as pd
+import pytest
+import Generate as generate
+import Instrument as instrument
+import Stream as stream
+import Urm as urm
+from Spooler import ZplSpooler
+from zpl import render_labels
+
+# run from src/ with python -m pytest -q
+
+# a stand-in Zebra printer: accepts connections on localhost and keeps what each one sent
+class StandInPrinter:
+    def __init__(self):
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.address = '127.0.0.1:%d' % self.server.getsockname()[1]
+        self.received = []  # bytes of each connection
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            data = b''
+            with conn:
+                while True:
+                    block = conn.recv(1 << 16)
+                    if not block:
+                        break
+                    data += block
+            self.received.append(data)
+
+    def close(self):
+        self.server.close()
+
+# host:port that refuses connections
+def unreachable_printer():
+    sock = socket.create_server(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % sock.getsockname()[1]
+    sock.close()
+    return address
+
+# waits for the stand-in printers to have received n connections
+def wait_for(printer, n):
+    for _ in range(200):
+        if len(printer.received) >= n:
+            return
+        threading.Event().wait(0.01)
+
+def test_labels_reach_the_printer():
+    printer = StandInPrinter()
+    labels = ['^XA^FD%d^FS^XZ' % i for i in range(120)]
+    with ZplSpooler([printer.address], header='^XAHEADER^XZ', batch_size=50) as spooler:
+        for label in labels:
+            spooler.send(label)
+    wait_for(printer, 1)
+    printer.close()
+    assert printer.received == [('^XAHEADER^XZ' + ''.join(label + '\n' for label in labels)).encode()]
+
+def test_batches_go_round_robin():
+    printers = [StandInPrinter(), StandInPrinter()]
+    labels = ['^XA^FD%d^FS^XZ' % i for i in range(100)]
+    with ZplSpooler([printer.address for printer in printers], batch_size=10) as spooler:
+        for label in labels:
+            spooler.send(label)
+    for printer in printers:
+        wait_for(printer, 1)
+        printer.close()
+    sent = [printer.received[0].decode().splitlines() for printer in printers]
+    assert sent[0] == [label for idx, label in enumerate(labels) if idx // 10 % 2 == 0]
+    assert sent[1] == [label for idx, label in enumerate(labels) if idx // 10 % 2 == 1]
+
+def test_unreachable_printer_raises():
+    spooler = ZplSpooler([unreachable_printer()], retries=1, retry_delay=0)
+    spooler.send('^XA^XZ')
+    with pytest.raises(ConnectionError):
+        spooler.close()
+
+def test_tags_are_sent_a_block_at_a_time(tmp_path, monkeypatch):
+    printer = StandInPrinter()
+    blocks = []
+    send = urm.TagSpooler.send
+    monkeypatch.setattr(urm.TagSpooler, 'send', lambda spooler, labels: blocks.append(len(labels)) or send(spooler, labels))
+    monkeypatch.setattr(urm, 'TAG_BLOCK_ROWS', 10)
+    data = pd.DataFrame({'DESCRIPTION': ['ITEM %d' % i for i in range(35)], 'UPC': ['%012d' % i for i in range(35)],
+                         'VENDOR ITEM NUMBER': ['1234'] * 35, 'PRICE': ['1.99'] * 35})
+    zpl_file = tmp_path / urm.PRICE_TAGS_FILE
+    urm.write_price_tags(data, str(zpl_file), printers=[printer.address])
+    wait_for(printer, 1)
+    printer.close()
+    assert blocks == [10, 10, 10, 5]
+    template, _ = urm.price_tag_format()
+    labels = render_labels(template, {field: data[col] for field, col in urm.PRICE_TAG_FIELDS.items()}, 35)
+    assert zpl_file.read_text() == ''.join(label + '\n' for label in labels)
+    assert printer.received[0].split() == zpl_file.read_bytes().split()
+
+# runs parse (or parse_streaming) on a generated store with the tags sent to price_printers
+def parse_store(tmp_path, price_printers, parse=urm.parse):
+    sil_file, st_file = generate.generate(500, str(tmp_path / 'store'))
+    out_dir = tmp_path / 'uploadables'
+    out_dir.mkdir()
+    paths = {arg: str(out_dir / name) for arg, name in [('uploadable_new_items', 'new.csv'), ('uploadable_pcu_items', 'pcu.csv'),
+                                                       ('uploadable_tprs', 'tprs.csv'), ('uploadable_ads', 'ads.csv')]}
+    db = str(tmp_path / 'urm.db')
+    parse(st_file, sil_file, dbPath=db, only_do_if_cost_change=False, min_tpr_margin=40, price_printers=price_printers,
+              trace_memory=False, **paths)
+    with open(out_dir / instrument.REPORT_FILE) as f:
+        report = json.load(f)
+    return out_dir, db, report
+
+def test_run_prints_the_tags(tmp_path):
+    printer = StandInPrinter()
+    out_dir, db, report = parse_store(tmp_path, [printer.address])
+    wait_for(printer, 1)
+    printer.close()
+    assert report['FINISHED'] and report['ERRORS'] == []
+    assert len(printer.received) == 1
+    with open(out_dir / urm.PRICE_TAGS_FILE, 'rb') as f:
+        assert printer.received[0].split() == f.read().split()  # the file has a blank line after each label
+
+@pytest.mark.parametrize('parse', [urm.parse, stream.parse_streaming])
+def test_run_goes_on_without_the_printer(tmp_path, monkeypatch, parse):
+    monkeypatch.setitem(urm.SPOOLER_SETTINGS, 'retries', 0)
+    out_dir, db, report = parse_store(tmp_path, [unreachable_printer()], parse)
+    assert report['FINISHED']
+    assert [error['STAGE'] for error in report['ERRORS']] == ['ZPL: ' + urm.PRICE_TAGS_FILE]
+    assert os.path.getsize(out_dir / urm.PRICE_TAGS_FILE) > 0
+    conn = sqlite3.connect(db)
+    assert conn.execute('SELECT "FINISHED" FROM "RUNS"').fetchone()[0] is not None
+    assert conn.execute('SELECT count(*) FROM "FINGERPRINTS"').fetchone()[0] > 0
+    conn.close()
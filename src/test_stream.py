@@ -0,0 +1,52 @@
+import sqlite3
+import pandas as pd
+import pytest
+import Generate as generate
+import Stream as stream
+import Urm as urm
+
+# run from src/ with python -m pytest -q
+
+OUTPUT_FILES = ['new.csv', 'pcu.csv', 'tprs.csv', 'ads.csv', urm.PRICE_TAGS_FILE, urm.TPR_TAGS_FILE]
+DB_TABLES = ['FINAL NEW', 'FINAL PCU', 'ALL TPR', 'ALL SALE', urm.FINGERPRINTS_TABLE]
+
+# runs parse (or parse_streaming) into dir/uploadables and dir/urm.db
+def run(parse, sil_file, st_file, dir, **parse_args):
+    out_dir = dir / 'uploadables'
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = {arg: str(out_dir / name) for arg, name in zip(['uploadable_new_items', 'uploadable_pcu_items', 'uploadable_tprs',
+                                                            'uploadable_ads'], OUTPUT_FILES)}
+    parse(st_file, sil_file, dbPath=str(dir / 'urm.db'), only_do_if_cost_change=False, min_tpr_margin=40, **paths, **parse_args)
+    return out_dir
+
+# the rows a db table has for its last run (the whole table if it has no RUN ID)
+def last_run(dir, table):
+    conn = sqlite3.connect(dir / 'urm.db')
+    data = pd.read_sql(f'SELECT * FROM "{table}"', conn)
+    conn.close()
+    if 'RUN ID' in data:
+        data = data[data['RUN ID'] == data['RUN ID'].max()].drop(columns='RUN ID')
+    return data.sort_values(list(data.columns)).reset_index(drop=True)
+
+def assert_same_run(batch_dir, stream_dir):
+    for name in OUTPUT_FILES:
+        with open(batch_dir / 'uploadables' / name, 'rb') as a, open(stream_dir / 'uploadables' / name, 'rb') as b:
+            assert a.read() == b.read(), name
+    for table in DB_TABLES:
+        pd.testing.assert_frame_equal(last_run(batch_dir, table), last_run(stream_dir, table), obj=table)
+
+# a first run, a delta run on the same files (nothing changed) and one on other files, with chunk_rows smaller and
+# larger than a SIL section
+@pytest.mark.parametrize('chunk_rows', [7, 1000])
+def test_streaming_writes_what_parse_writes(tmp_path, chunk_rows):
+    for seed in [0, 0, 1]:
+        sil_file, st_file = generate.generate(1000, str(tmp_path / 'store'), seed=seed)
+        run(urm.parse, sil_file, st_file, tmp_path / 'batch')
+        run(stream.parse_streaming, sil_file, st_file, tmp_path / 'stream', chunk_rows=chunk_rows)
+        assert_same_run(tmp_path / 'batch', tmp_path / 'stream')
+
+def test_streaming_writes_the_stored_format_tags(tmp_path):
+    sil_file, st_file = generate.generate(1000, str(tmp_path / 'store'))
+    run(urm.parse, sil_file, st_file, tmp_path / 'batch', stored_zpl_format=True)
+    run(stream.parse_streaming, sil_file, st_file, tmp_path / 'stream', stored_zpl_format=True, chunk_rows=50)
+    assert_same_run(tmp_path / 'batch', tmp_path / 'stream')
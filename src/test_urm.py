@@ -0,0 +1,165 @@
+import json
+import pandas as pd
+import pytest
+import Generate as generate
+import Instrument as instrument
+import Urm as urm
+import Utils as utils
+
+# run from src/ with python -m pytest -q
+
+def test_sql_tuples():
+    rows, pos, is_done = urm.read_sql_tuples("('a,b','it''s','x;y',12,,NULL)\n,('z',2);")
+    assert rows[0][:4] == ['a,b', "it's", 'x;y', '12'] and pd.isna(rows[0][4]) and pd.isna(rows[0][5])
+    assert rows[1] == ['z', '2']
+    assert is_done and pos == 40
+
+def test_sql_tuple_continued_on_the_next_line():
+    buf = "('a', 1)\n,('b',"
+    rows, pos, is_done = urm.read_sql_tuples(buf)
+    assert rows == [['a', '1']] and not is_done
+    assert buf[pos:] == "('b',"  # read again once the next line is added
+
+def test_sql_text_that_is_not_a_tuple():
+    with pytest.raises(ValueError, match='unexpected SQL text'):
+        urm.read_sql_tuples("('a') x")
+
+# a SIL file of lines
+def sil_file(dir, lines):
+    file = dir / 'SIL.TXT'
+    file.write_text('\n'.join(lines) + '\n')
+    return str(file)
+
+# two sections of URM_X (one with a tuple over two lines) around a HEADER_DCT section
+SECTIONS = ['CREATE VIEW URM_X AS SELECT', ' F01  ,F02', 'FROM ITEM_DCT;',
+            'INSERT INTO URM_X VALUES', "(0001,'ONE, 1')", ",(0002,'TWO;", "2')", ',(0003,NULL);',
+            'INSERT INTO HEADER_DCT VALUES (', "'HM','000302',", '9,99999);',
+            'INSERT INTO URM_X VALUES', "(0004,'FOUR''S');"]
+
+def test_sil_rows_of_every_section(tmp_path):
+    columns = {}
+    found = list(urm.iter_sil_rows(sil_file(tmp_path, SECTIONS), columns, {}))
+    assert [table for table, _ in found] == ['URM_X', 'HEADER_DCT', 'URM_X']
+    assert found[0][1][:2] == [['0001', 'ONE, 1'], ['0002', 'TWO;\n2']]
+    assert found[0][1][2][0] == '0003' and pd.isna(found[0][1][2][1])
+    assert found[1][1] == [['HM', '000302', '9', '99999']]
+    assert found[2][1] == [['0004', "FOUR'S"]]
+    assert columns == {'URM_X': ['F01', 'F02']}
+
+def test_sil_rows_in_chunks(tmp_path):
+    found = list(urm.iter_sil_rows(sil_file(tmp_path, SECTIONS), {}, {}, chunk_rows=2))
+    assert [(table, [row[0] for row in rows]) for table, rows in found] == \
+        [('URM_X', ['0001', '0002']), ('URM_X', ['0003']), ('HEADER_DCT', ['HM']), ('URM_X', ['0004'])]
+
+def test_sil_sections_of_a_table_are_concatenated(tmp_path):
+    sil = urm.parse_sil_txt(sil_file(tmp_path, SECTIONS), typed=False)
+    assert list(sil['URM_X']['F01']) == ['0001', '0002', '0003', '0004']
+    assert list(sil['URM_X']['F02'][[0, 1, 3]]) == ['ONE, 1', 'TWO;\n2', "FOUR'S"]
+    assert sil['URM_PCU'].empty and list(sil['URM_PCU'].columns) == urm.PCU_HEADER.split(',')  # not in the file
+
+def test_sil_file_that_ends_inside_a_section(tmp_path):
+    with pytest.raises(ValueError, match='ended inside INSERT INTO URM_X'):
+        urm.parse_sil_txt(sil_file(tmp_path, SECTIONS[:6]))
+
+# a SIL file with a URM_PCU section whose CREATE TABLE declares the fields with field_types (e.g. 'F38 NUMBER(9,2)')
+def pcu_sil_file(dir, rows, field_types=()):
+    file = dir / 'SIL.TXT'
+    lines = ['CREATE TABLE ITEM_DCT (', *[field + ',' for field in field_types], 'F01 GPC(14));',
+             'CREATE VIEW URM_PCU AS SELECT', ' F01  ,F27  ,F30  ,F31  ,F38', 'FROM ITEM_DCT;',
+             'INSERT INTO URM_PCU VALUES', '\n,'.join(rows), ';']
+    file.write_text('\n'.join(lines) + '\n')
+    return str(file)
+
+# a POS inventory export of items (UPC without check digit, price, case cost, pack size)
+def inventory_file(dir, items):
+    upcs = [utils.add_check_digit(upc) for upc, _, _, _ in items]
+    file = dir / 'INV.csv'
+    generate.write_inventory(pd.DataFrame({'PLU': upcs, 'DESCRIPTION': ['TEST ITEM'] * len(items), 'DEPT': [1] * len(items),
+                                           'PACK': [pack for _, _, _, pack in items],
+                                           'PRICE': [price for _, price, _, _ in items],
+                                           'CASE COST': [cost for _, _, cost, _ in items],
+                                           'ITEM NO': ['1234'] * len(items)}), file)
+    return str(file)
+
+def test_sil_prices_are_cents_and_case_cost_is_text(tmp_path):
+    sil = urm.parse_sil_txt(pcu_sil_file(tmp_path, ["(0004369507107,'1',4.29,1,22.120)", "(0001122500957,'1',0.49,1,39.380)"]))
+    pcu = sil['URM_PCU']
+    assert list(pcu['PRICE']) == [429, 49]
+    assert list(pcu['CASE COST']) == ['22.120', '39.380']
+    out = urm.to_output_format(urm.process_pcu(pcu))
+    assert list(out['PRICE']) == ['4.29', '.49']
+    assert list(out['CASE COST']) == ['22.120', '39.380']
+
+def test_unused_columns_are_not_decoded(tmp_path):
+    sil = urm.parse_sil_txt(pcu_sil_file(tmp_path, ["(0004369507107,'1',4.29,1.5,22.120)"]))
+    assert list(sil['URM_PCU']['PRICE MULTIPLE']) == ['1.5']  # F31 NUMBER(3), not used
+    assert list(urm.process_pcu(sil['URM_PCU'])['PRICE']) == [429]
+
+def test_values_that_are_not_of_their_type_are_missing():
+    numbers = urm.decode_sil_column(pd.Series(['2', '1.5', 'x', None]), ('NUMBER', 3, 0))
+    assert numbers.dtype == 'Int64' and numbers[0] == 2 and numbers[1:].isna().all()
+    flags = urm.decode_sil_column(pd.Series(['1', '0', '2']), ('FLAG', 1, 0))
+    assert list(flags[:2]) == [True, False] and pd.isna(flags[2])
+
+def test_case_cost_declared_with_2_decimals(tmp_path):
+    sil_file = pcu_sil_file(tmp_path, ["(0004369507107,'1',4.29,1,22.120)"], ['F30 NUMBER(6,3)', 'F38 NUMBER(9,2)'])
+    st = utils.process_storetender_file(inventory_file(tmp_path, [('4369507107', 4.5, 20.0, 12)]), None, use_snapshot=False)
+    pcu = urm.get_pcu(urm.parse_sil_txt(sil_file)['URM_PCU'], st, pd.DataFrame(), None, 'PCU', new_keys=urm.new_item_keys(pd.Series(dtype=object)))
+    assert list(pcu['PRICE']) == [429]
+    assert list(pcu['CASE COST']) == ['22.120']
+    assert list(pcu['MARGIN']) == [57.11]  # 1 - 1.84 / 4.29
+
+def test_price_dif_as_dollars():
+    pcu = pd.DataFrame({'PRICE': pd.array([1039, 1069, None], dtype='Int64'), 'OLD PRICE': pd.array([1069, 1069, 100], dtype='Int64')})
+    dif = urm.price_dif(pcu)
+    assert dif[0] == 10.39 - 10.69
+    assert dif[1] == 0
+    assert pd.isna(dif[2])
+
+def test_inventory_price_is_written_as_a_number():
+    out = urm.to_output_format(pd.DataFrame({'PRICE': pd.array([49, 1050], dtype='Int64'),
+                                             'OLD PRICE': pd.array([1050, None], dtype='Int64')}))
+    assert list(out['PRICE']) == ['.49', '10.50']
+    assert list(out['OLD PRICE'][:1]) == ['10.5'] and pd.isna(out['OLD PRICE'][1])
+
+@pytest.mark.filterwarnings('error::FutureWarning')
+def test_missing_department_is_dropped(tmp_path):
+    file = inventory_file(tmp_path, [('4369507107', 4.5, 20.0, 12), ('1122500957', 0.5, 39.38, 1)])
+    inventory = pd.read_csv(file, header=None, dtype=str, keep_default_na=False)
+    inventory.loc[1, 6] = ''  # DEPT
+    inventory.to_csv(file, header=False, index=False)
+    st = utils.process_storetender_file(file, None, use_snapshot=False)
+    assert 'nan' not in st['DEPT NO'].cat.categories and pd.isna(st['DEPT NO'][1])
+    kept = urm.drop_missing(st.rename(columns={'DEPT NO': 'POS DEPARTMENT'}), ['POS DEPARTMENT'], 'TEST')
+    assert list(kept['UPC']) == [st['UPC'][0]]
+
+# 40 and 40.0 (and a rule value of '40' and '40.0') are the same settings, so a run with either skips the same rows
+def test_same_settings_have_the_same_fingerprints(tmp_path):
+    st = utils.process_storetender_file(inventory_file(tmp_path, [('4369507107', 4.5, 20.0, 12)]), None, use_snapshot=False)
+    data = pd.DataFrame({'UPC': ['0004369507107', '0001122500957'], 'PRICE': pd.array([429, 50], dtype='Int64')})
+    def fingerprints(*settings):
+        return list(urm.fingerprint_rows(data, urm.inventory_hashes(st), urm.fingerprint_settings(*settings)))
+    margins = {'TPR MIN MARGINS': {'10': '40'}}
+    assert fingerprints(False, 40, margins) == fingerprints(0, 40.0, {'TPR MIN MARGINS': {'10': '40.0'}})
+    assert fingerprints(False, 40, margins) != fingerprints(False, 41, margins)
+    assert fingerprints(False, 40, margins) != fingerprints(False, 40, {'TPR MIN MARGINS': {'10': '45'}})
+
+# the max_workers parse runs the stage graph with
+def graph_workers(tmp_path, monkeypatch, **parse_args):
+    workers = []
+    run = urm.StageGraph.run
+    monkeypatch.setattr(urm.StageGraph, 'run', lambda graph, max_workers=None: workers.append(max_workers) or run(graph, max_workers=max_workers))
+    sil_file, st_file = generate.generate(200, str(tmp_path / 'store'))
+    paths = {arg: str(tmp_path / (arg + '.csv')) for arg in ['uploadable_new_items', 'uploadable_pcu_items', 'uploadable_tprs', 'uploadable_ads']}
+    urm.parse(st_file, sil_file, dbPath=str(tmp_path / 'urm.db'), only_do_if_cost_change=False, min_tpr_margin=40, **paths, **parse_args)
+    return workers
+
+def test_memory_tracing_runs_the_stages_one_at_a_time(tmp_path, monkeypatch):
+    assert graph_workers(tmp_path, monkeypatch, trace_memory=True, max_workers=4) == [1]
+    with open(tmp_path / instrument.REPORT_FILE) as f:
+        assert all(stage['PEAK MB'] is not None for stage in json.load(f)['STAGES'])
+
+def test_memory_is_not_traced_by_default(tmp_path, monkeypatch):
+    assert graph_workers(tmp_path, monkeypatch, max_workers=4) == [4]
+    with open(tmp_path / instrument.REPORT_FILE) as f:
+        assert all(stage['PEAK MB'] is None for stage in json.load(f)['STAGES'])
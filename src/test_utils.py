@@ -0,0 +1,135 @@
+import numpy as np
+import os
+import pandas as pd
+import pytest
+import sqlite3
+import Generate as generate
+import Utils as utils
+
+# run from src/ with python -m pytest -q
+
+# random digit strings of every length from 1 to 14, with and without leading zeroes
+def random_upcs(rng, n):
+    lengths = rng.integers(1, 15, n)
+    return [''.join(rng.choice(list('0123456789'), length)) for length in lengths]
+
+# the scalar function applied to every value, as a list
+def scalar(func, upcs):
+    return [func(upc) for upc in upcs]
+
+# the batch function's result as a list, with NaN kept as NaN so that lists compare
+def batch(func, upcs):
+    return list(func(upcs))
+
+def assert_same(expected, actual):
+    assert len(expected) == len(actual)
+    for e, a in zip(expected, actual):
+        if isinstance(e, float) and np.isnan(e):
+            assert isinstance(a, float) and np.isnan(a)
+        else:
+            assert type(e) == type(a) and e == a
+
+def test_add_check_digit_batch_random():
+    upcs = random_upcs(np.random.default_rng(0), 5000)
+    assert_same(scalar(utils.add_check_digit, upcs), batch(utils.add_check_digit_batch, upcs))
+
+def test_add_check_digit_batch_edges():
+    upcs = ['', '0', '1', '00000000000', '7', '12345', '03600054308', '036000543087', '0036000543087',
+            '12345678901234', None, np.nan, 12345, 4.0]
+    assert_same(scalar(utils.add_check_digit, upcs), batch(utils.add_check_digit_batch, pd.Series(upcs, dtype=object)))
+
+def test_add_check_digit_batch_int_input():
+    upcs = np.array([0, 7, 3600054308, 36000543087, 12345678901234], dtype=np.int64)
+    assert_same(scalar(utils.add_check_digit, [str(upc) for upc in upcs]), batch(utils.add_check_digit_batch, upcs))
+
+def test_add_check_digit_batch_non_digit():
+    with pytest.raises(ValueError):
+        utils.add_check_digit('0360A054308')
+    with pytest.raises(ValueError):
+        utils.add_check_digit_batch(['03600054308', '0360A054308'])
+
+def test_add_check_digit_batch_keeps_index():
+    upcs = pd.Series(['12345', None, '03600054308'], index=[10, 5, 7])
+    result = utils.add_check_digit_batch(upcs)
+    assert list(result.index) == [10, 5, 7]
+
+def test_upcE_to_upcA_batch_random():
+    rng = np.random.default_rng(1)
+    upcs = random_upcs(rng, 2000) + [''.join(rng.choice(list('0123456789'), 8)) for _ in range(5000)]
+    assert_same(scalar(utils.upcE_to_upcA, upcs), batch(utils.upcE_to_upcA_batch, upcs))
+
+def test_upcE_to_upcA_batch_every_rule():
+    upcs = ['0123450' + d for d in '0123456789'] + ['012345' + d + '7' for d in '0123456789']
+    assert_same(scalar(utils.upcE_to_upcA, upcs), batch(utils.upcE_to_upcA_batch, upcs))
+
+def test_upcE_to_upcA_batch_edges():
+    upcs = ['', '1234567', '123456789', '036000543087', 'ABCDEFGH', '01234X67', '0123456X', 'ÄBCDEFGH',
+            None, np.nan, 1234567, 8.0]
+    assert_same(scalar(utils.upcE_to_upcA, upcs), batch(utils.upcE_to_upcA_batch, pd.Series(upcs, dtype=object)))
+
+def test_upcE_to_upcA_batch_int_input():
+    upcs = pd.Series([1234505, 12345675, 123456789], dtype='int64')
+    assert_same(scalar(utils.upcE_to_upcA, [str(upc) for upc in upcs]), batch(utils.upcE_to_upcA_batch, upcs))
+
+# a POS inventory export of n items written to dir/name, with the given mtime
+def inventory_file(dir, name, n, mtime=1700000000, seed=0):
+    file = os.path.join(dir, name)
+    generate.write_inventory(generate.make_items(np.random.default_rng(seed), n), file)
+    os.utime(file, (mtime, mtime))
+    return file
+
+def test_snapshot_is_reused(tmp_path):
+    file = inventory_file(tmp_path, 'INV.csv', 100)
+    db = str(tmp_path / 'urm.db')
+    built = utils.process_storetender_file(file, db)
+    pd.testing.assert_frame_equal(built, utils.process_storetender_file(file, db))
+    pd.testing.assert_frame_equal(built, utils.process_storetender_file(file, db, use_snapshot=False))
+
+def test_snapshot_of_same_mtime_exports(tmp_path):
+    db = str(tmp_path / 'urm.db')
+    big = inventory_file(tmp_path, 'INV100.csv', 100, seed=1)
+    small = inventory_file(tmp_path, 'INV50.csv', 50, seed=2)
+    assert len(utils.process_storetender_file(big, db)) == 100
+    assert len(utils.process_storetender_file(small, db)) == 50
+    assert len(utils.process_storetender_file(big, db)) == 100  # each export keeps its own snapshot
+
+def test_snapshot_of_replaced_export(tmp_path):
+    db = str(tmp_path / 'urm.db')
+    file = inventory_file(tmp_path, 'INV.csv', 100, seed=1)
+    utils.process_storetender_file(file, db)
+    inventory_file(tmp_path, 'INV.csv', 50, seed=2)  # same path and mtime, other size
+    assert len(utils.process_storetender_file(file, db)) == 50
+
+def test_snapshot_of_touched_export(tmp_path):
+    db = str(tmp_path / 'urm.db')
+    file = inventory_file(tmp_path, 'INV.csv', 100)
+    built = utils.process_storetender_file(file, db)
+    os.utime(file, (1800000000, 1800000000))
+    pd.testing.assert_frame_equal(built, utils.process_storetender_file(file, db))
+    conn = sqlite3.connect(db)
+    assert conn.execute(f'SELECT "FILE MTIME" FROM "{utils.ST_SNAPSHOT_INFO_TABLE}"').fetchone()[0] == 1800000000
+    conn.close()
+
+def test_snapshot_of_older_version_is_rebuilt(tmp_path, monkeypatch):
+    db = str(tmp_path / 'urm.db')
+    file = inventory_file(tmp_path, 'INV.csv', 100)
+    utils.process_storetender_file(file, db)
+    monkeypatch.setattr(utils, 'read_storetender_file', lambda f: pd.DataFrame({'UPC': ['1'], 'ORG': ['1']}))
+    assert len(utils.load_storetender_snapshot(file, db)) == 100
+    monkeypatch.setattr(utils, 'ST_SNAPSHOT_VERSION', utils.ST_SNAPSHOT_VERSION + 1)
+    assert len(utils.load_storetender_snapshot(file, db)) == 1
+
+def test_old_snapshots_are_dropped(tmp_path):
+    db = str(tmp_path / 'urm.db')
+    files = [inventory_file(tmp_path, f'INV{day}.csv', 20, seed=day) for day in range(5)]
+    for file in files:
+        utils.process_storetender_file(file, db)
+    os.remove(files[4])
+    utils.process_storetender_file(inventory_file(tmp_path, 'INV5.csv', 20, seed=5), db)
+    conn = sqlite3.connect(db)
+    snapshots = [row[0] for row in conn.execute(f'SELECT "FILE" FROM "{utils.ST_SNAPSHOT_INFO_TABLE}" ORDER BY "FILE"')]
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? AND name != ?",
+                                             (utils.ST_SNAPSHOT_TABLE + ' %', utils.ST_SNAPSHOT_INFO_TABLE))]
+    conn.close()
+    assert [os.path.basename(file) for file in snapshots] == ['INV2.csv', 'INV3.csv', 'INV5.csv']  # INV4.csv is gone
+    assert len(tables) == 3
@@ -0,0 +1,40 @@
+import re
+import numpy as np
+import pandas as pd
+import pytest
+from zpl import PRICE_ZPL, TPR_ZPL, VARIABLE_FIELD, compile_template, render_labels, stored_format
+
+# run from src/ with python -m pytest -q
+
+STORED_FIELD = re.compile(r'\^FN(\d+)\^FD(.*?)\^FS')
+
+# columns for every field of a template: text, numbers and missing values of the dtypes the tags get
+def template_fields(template):
+    names = sorted({field for _, field, _, _ in compile_template(template) if field})
+    values = [pd.Series(['SOUP 10.5OZ', 'ITEM, TWO', np.nan, pd.NA], dtype=object),
+              pd.Series([1.99, 0.5, np.nan, 10.0]),
+              pd.array([12, None, 3, 4], dtype='Int64'),
+              pd.Series(['1.99', '.49', None, '08/27/2024'], dtype=object)]
+    return {name: values[idx % len(values)] for idx, name in enumerate(names)}
+
+# the labels as str.format makes them, one row at a time
+def formatted(template, fields):
+    count = len(next(iter(fields.values())))
+    return [template.format(**{name: values[row] for name, values in fields.items()}) for row in range(count)]
+
+@pytest.mark.parametrize('template', [TPR_ZPL, PRICE_ZPL], ids=['TPR', 'PRICE'])
+def test_labels_are_those_of_str_format(template):
+    fields = template_fields(template)
+    assert render_labels(compile_template(template), fields, 4) == formatted(template, fields)
+
+@pytest.mark.parametrize('template', [TPR_ZPL, PRICE_ZPL], ids=['TPR', 'PRICE'])
+def test_stored_format_labels_have_the_same_values(template):
+    header, label = stored_format(template, 'TEST')
+    fields = template_fields(template)
+    texts = VARIABLE_FIELD.findall(template.strip())  # the ^FD text of every variable field, in order
+    for row, rendered in enumerate(render_labels(compile_template(label), fields, 4)):
+        values = STORED_FIELD.findall(rendered)
+        assert [int(num) for num, _ in values] == list(range(1, len(texts) + 1))
+        assert [value for _, value in values] == \
+            [text.format(**{name: column[row] for name, column in fields.items()}) for text in texts]
+    assert '{' not in header and all(f'^FN{num}^FS' in header for num in range(1, len(texts) + 1))
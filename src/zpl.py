@@ -1,3 +1,8 @@
+import itertools
+import pandas as pd
+import re
+import string
+
 TPR_ZPL = '''
 ^XA
 ^FO10,690^GFA,86400,86400,120,,:::::::::::::::::::::T03C7IFE,S0FFE3KF8,Q01JF1LFC,Q0KF8MF8,P0LFC7MF,O03LFE3MFC,N01NF00MF8,N07LFL03JFE,M01KFCN01JF8,M07JFCI0FE3FE001IFE,M03IFE007IF1IF803IF8,L033IF007JF8JF80IFC,L079FFC03KFC7JF01IF,K01F8FE01LFE3JFE07FF8,K03FC7C0JFCK07IFC1FFC,K07FE303IFN03IF07FE,K0IF007FF8O07FF83FF,J01IF8U081E0FF8,J03FFE0671E00CF003CC003DF07FC,J07FFC06F0F00CF807DC003DFC3FE,J0IF832F0F80EJFDC003DFE1FF,J0IF070F07C0E7IF9C003CFF0FF,I01IF0F8F03E0E7IFBC003CFF87F8,I01FFE1FCF01E0F3E1F3C003C3FC7FC,I03FFC1FCF01FDF3C1F3C183C1FE3FC,I03FFC3FCF03IF3E1E3C3C3C1FE1FC,I07FF87F8F07IF1E3E3C7F3C0FF1FE,I07FF87F0F0F80F1F3E3CFF3C07F0FE,I07FF07F0F1F00F0F7C3FE7FC07F0FE,I0IF0FE0F1F00F0FFC3FC3FC03F8FF,I0IF0FC0F0F80F07F83F81FC03F87F,I0IF0FCFFCJF07F83F00FC03F87F,I0IF0FCFFE7IF07F03E007C03F87F,I0IF0FCFFE1FFE03F03C003C03F87F,I0IF0FCX03F87F,I0IF07CX07F87F,I0IF07E6073FF00381F00FC007F0FF,I07FF07E7077FF00387FC3FF007F0FE,I07FF83F7873FF0038FFE7FF80FE0FE,I07FF83F3870070038F1E78781FE1FE,I03FF81FBC70070039E0E78103FC1FE,I03FFC0F9CF00703F9C0F78001F83FC,I03FFE079FF07F0FF9C0F7F008F03FC,I01FFE033FF1FF1FF9C0F3FC1C607F8,I01IF017FF1FF3C39C0F0FF3E00FF8,J0IF807070073C39C0F03F7F01FF,J07FFC0F270073839C0F00F3F03FE,J03FFE07070073C39C0F0073C03FE,J01IF07FF05F1FF9C0E3CF3003FC,J01IF87FF3FF1FF9C0E3FF2011F8,K07FFE1FF3FF07F9C061FC0078F,K03IFI014K01E2K0FC6,K01IFCJ0E60I1F2FI03FE,L0JFI03FF1LFI0IF,L07IFEI01F9JFCI03FFE,L01JF8K0IFK0IF8,M0KFR07IF,M03KFP07IFC,N0LFN07JF,N03LFEK0KFC,O07MFC7MF,O01MFE3LFC,P03MF3KFE,Q07LF9KF,R07KF8JF,S03JFC7FE,U03FFE3,,::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::^FS
@@ -44,4 +49,59 @@ PRICE_ZPL_NRS = '''
 ^FT380,25^A0I,20,20^FB250,1,0,L^FD{Upc}^FS
 ^FT170.25,72^A0I,80,40^FB150,1,0,C^FD${Price}^FS
 ^XZ
-'''
\ No newline at end of file
+'''
+GRAPHIC = re.compile(r'\^GFA,(\d+),\d+,(\d+),([^^]*)')
+VARIABLE_FIELD = re.compile(r'\^FD([^^]*\{[^^]*)\^FS')
+PRINT_QUANTITY = re.compile(r'\^PQ[^^]*')
+
+# splits a label template into a job header that downloads its graphic (~DG) and stores the rest of the
+# label as a format (^DF) on the printer, and a label template that recalls them (^XF) with only its
+# variable fields (^FN), so the graphic is sent once per job instead of once per label
+def stored_format(template, name):
+    body = template.strip()
+    header = ''
+    graphic = GRAPHIC.search(body)
+    if graphic:
+        total_bytes, row_bytes, data = graphic.groups()
+        header += f'~DGR:{name}.GRF,{total_bytes},{row_bytes},{data.strip()}\n'
+        body = body.replace(graphic.group(0), f'^XGR:{name}.GRF,1,1')
+
+    fields = VARIABLE_FIELD.findall(body)
+    for num, field in enumerate(fields, start=1):
+        body = body.replace('^FD' + field + '^FS', f'^FN{num}^FS', 1)
+    print_quantity = ''.join(pq.strip() for pq in PRINT_QUANTITY.findall(body))  # print quantity is per label, not stored
+    body = PRINT_QUANTITY.sub('', body)
+
+    header += body.replace('^XA', f'^XA\n^DFR:{name}.ZPL^FS', 1) + '\n'
+    label = f'^XA^XFR:{name}.ZPL^FS' + ''.join(f'^FN{num}^FD{field}^FS' for num, field in enumerate(fields, start=1))
+    label += print_quantity + '^XZ'
+    return header, label
+
+TPR_ZPL_HEADER, TPR_ZPL_STORED = stored_format(TPR_ZPL, 'TPR')
+PRICE_ZPL_HEADER, PRICE_ZPL_STORED = stored_format(PRICE_ZPL, 'PRICE')
+
+# compiles a label template once into the static text and the fields between them
+def compile_template(template):
+    return list(string.Formatter().parse(template))
+
+# renders a compiled template for every row of the field columns (field name -> column values) at once,
+# each label is joined from its static text and the row's field values instead of formatting the template per row
+def render_labels(compiled, fields, count):
+    parts = []
+    for literal, field, spec, conversion in compiled:
+        if literal:
+            parts.append(itertools.repeat(literal, count))
+        if field is None:
+            continue
+        values = pd.Series(fields[field], copy=False)
+        if spec or conversion:
+            fmt = '{0' + ('!' + conversion if conversion else '') + (':' + spec if spec else '') + '}'
+            parts.append([fmt.format(value) for value in values])
+        else:
+            parts.append(values.astype(str).tolist())
+    return [''.join(label) for label in zip(*parts)]
+
+TPR_ZPL_COMPILED = compile_template(TPR_ZPL)
+TPR_ZPL_STORED_COMPILED = compile_template(TPR_ZPL_STORED)
+PRICE_ZPL_COMPILED = compile_template(PRICE_ZPL)
+PRICE_ZPL_STORED_COMPILED = compile_template(PRICE_ZPL_STORED)